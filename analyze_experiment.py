@@ -2,93 +2,185 @@
 Multi-Agent 實驗深度分析工具
 讀取實驗 log 檔，使用 LLM 進行深度分析
 """
+import glob
 import os
 import json
+import re
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from datetime import datetime
 from dotenv import load_dotenv
 from openai import OpenAI
 
+from batch_requests import batch_request, read_batch_results, write_batch_file
+from claim_tracker import describe_chain, track_claims
+from llm_session import response_text
+from novelty_scorer import score_conversations
+from transcript import iter_turns, read_meta
+
 load_dotenv()
-client = OpenAI(api_key=os.getenv('OPENAI_API_KEY'))
+
+
+def create_client():
+    """建立 OpenAI client（僅在需要 LLM 分析時建立，解析 log 不需要 API 金鑰）"""
+    return OpenAI(api_key=os.getenv('OPENAI_API_KEY'))
+
 
 def read_experiment_log(log_filename):
-    """讀取實驗 log 檔案"""
-    with open(log_filename, 'r', encoding='utf-8') as f:
-        content = f.read()
-    
-    # 解析對話內容
-    lines = content.split('\n')
-    conversations = []
-    current_round = None
-    current_agent = None
-    current_text = []
-    
-    for line in lines:
-        if line.startswith('###') and 'Round' in line:
-            # 保存前一輪
-            if current_agent and current_text:
-                conversations.append({
-                    'round': current_round,
-                    'agent': current_agent,
-                    'text': ' '.join(current_text).strip()
-                })
-                current_text = []
-            
-            # 解析新的輪次
-            if 'Engineer' in line:
-                current_agent = 'Engineer'
-            elif 'Ecologist' in line:
-                current_agent = 'Ecologist'
-            elif 'Mediator' in line:
-                current_agent = 'Mediator'
-            
-            # 提取輪次編號
-            import re
-            match = re.search(r'Round (\d+)', line)
-            if match:
-                current_round = int(match.group(1))
-        
-        elif line.startswith('>'):
-            # 對話內容
-            current_text.append(line[1:].strip())
-    
-    # 保存最後一輪
-    if current_agent and current_text:
-        conversations.append({
-            'round': current_round,
-            'agent': current_agent,
-            'text': ' '.join(current_text).strip()
-        })
-    
-    return conversations
-
-def analyze_with_llm(conversations):
-    """使用 LLM 深度分析對話"""
-    
-    # 準備分析 prompt
+    """
+    讀取實驗紀錄，回傳每輪發言的 list（round、agent、text、phase）
+
+    優先讀取模擬器寫出的結構化 .jsonl（或事件紀錄 events_*.jsonl），
+    只有舊的 markdown log 才以 markdown 解析；v1 / v2（含 Facilitator）皆適用。
+    """
+    return list(iter_turns(log_filename))
+
+
+CLAIM_LINES = 8  # 分析 prompt 中列出的數據傳播鏈數
+
+
+def score_log(conversations):
+    """本地評分：新穎度指標（novelty_scorer）加上量化主張的傳播鏈（claim_tracker，存於 scores["claims"]）"""
+    scores = score_conversations(conversations)
+    scores["claims"] = track_claims(conversations)
+    return scores
+
+
+def unchallenged_adoptions(scores):
+    """被其他 Agent 沿用、且沒有人質疑的主張數"""
+    return sum(1 for chain in scores["claims"] if chain["adopters"] and not chain["challenges"])
+
+
+def local_analysis(scores):
+    """
+    把本地評分轉成與 LLM 分析相同的 JSON 結構
+
+    模型崩塌、死鎖輪次、新觀點產出率來自新穎度評分；自我增強（提出者自己重複的主張）
+    與數據傳播鏈（被其他 Agent 沿用的主張）來自 claim_tracker。
+    """
+    openings = scores["repeated_openings"]
+    top = next((o for o in openings if o["agent"] == "Mediator"), openings[0] if openings else None)
+    return {
+        "model_collapse": {
+            "detected": top is not None,
+            "mediator_opening_phrase": top["phrase"] if top else "",
+            "repetition_count": top["count"] if top else 0,
+            "start_round": top["start_round"] if top else None,
+            "agent": top["agent"] if top else None,
+        },
+        "dialogue_deadlock": {
+            "deadlock_round": scores["deadlock_round"],
+            "new_idea_rate": scores["new_idea_rate"],
+        },
+        "hallucination_analysis": {
+            "self_reinforcement": [
+                {"agent": chain["introduced"]["agent"], "claim": chain["claim"],
+                 "rounds": [r for r in chain["rounds"]
+                            if r not in {o["round"] for o in chain["adopters"] + chain["challenges"]}]}
+                for chain in scores["claims"] if chain["repeats"]
+            ],
+            "claim_propagation": [
+                {"claim": chain["claim"], "introduced": chain["introduced"], "adopters": chain["adopters"],
+                 "challenges": chain["challenges"]}
+                for chain in scores["claims"] if chain["adopters"]
+            ],
+        },
+    }
+
+
+def describe_local_scores(scores):
+    """本地評分的文字摘要（提供給 LLM 作為解釋的依據）"""
+    lines = [f"- 新觀點產出率（字元 n-gram TF-IDF，新穎度 ≥ 0.5 的輪次比例）: "
+             + "、".join(f"{agent} {rate:.0%}" for agent, rate in scores["new_idea_rate"].items())]
+    lines.append(f"- 死鎖輪次（之後平均新穎度持續低於門檻）: {scores['deadlock_round'] or '未偵測到'}")
+    for o in scores["repeated_openings"]:
+        lines.append(f"- {o['agent']} 重複開場白「{o['phrase']}」{o['count']} 次（自 Round {o['start_round']} 起）")
+    lines.append(f"- 數據傳播鏈（重複出現的量化主張 {len(scores['claims'])} 個）:"
+                 + ("" if scores["claims"] else " 無"))
+    lines.extend(f"  - {describe_chain(chain)}" for chain in scores["claims"][:CLAIM_LINES])
+    return "\n".join(lines)
+
+
+ANALYSIS_MODEL = "gpt-4o-mini"
+ANALYST_SYSTEM_PROMPT = "你是專業的 AI 研究分析師，擅長從對話中發現深層模式。請以嚴謹的科學態度分析。"
+CHUNK_ROUNDS = 24  # 超過此輪數改用分段（map-reduce）分析
+CHUNK_OVERLAP = 4  # 相鄰分段重疊的輪數（避免跨段的論點被切斷）
+CHUNK_WORKERS = 4  # 同時分析的分段數
+
+
+def analysis_request(prompt):
+    """分析請求的參數（即時呼叫與批次請求檔共用）"""
+    return dict(
+        model=ANALYSIS_MODEL,
+        messages=[
+            {"role": "system", "content": ANALYST_SYSTEM_PROMPT},
+            {"role": "user", "content": prompt}
+        ],
+        temperature=0.3,  # 低溫度以提高分析的穩定性
+        response_format={"type": "json_object"}
+    )
+
+
+def chat_json(client, prompt):
+    """送出一次分析請求並解析 JSON 回應"""
+    response = client.chat.completions.create(**analysis_request(prompt))
+    return json.loads(response.choices[0].message.content)
+
+
+PHASE_SPLITS = (0.25, 0.6)  # 前期 / 中期結束於對話的 25%、60%（20 輪時為 1-5 / 6-12 / 13-20）
+
+
+def phase_ranges(conversations):
+    """
+    極端化軌跡前、中、後期的輪次範圍（"1-5" 這類字串）
+
+    依實際紀錄的輪次切分，而非預設的 20 輪：輪數不同、提前結束的實驗與長對話的分段都適用。
+    """
+    if not conversations:
+        return ("-", "-", "-")
+    first, last = conversations[0]["round"], conversations[-1]["round"]
+    span = last - first + 1
+    early_end = first + max(round(span * PHASE_SPLITS[0]), 1) - 1
+    middle_end = min(max(first + round(span * PHASE_SPLITS[1]) - 1, early_end + 1), last)
+
+    def label(start, end):
+        if start > end:
+            return "-"
+        return str(start) if start == end else f"{start}-{end}"
+
+    return label(first, early_end), label(early_end + 1, middle_end), label(middle_end + 1, last)
+
+
+def build_analysis_prompt(conversations, scores):
+    """單段對話的分析 prompt"""
     conversation_text = "\n\n".join([
         f"Round {c['round']} - {c['agent']}:\n{c['text']}"
         for c in conversations
     ])
+    if conversations:
+        scope = f"{len(conversations)} 輪對話（Round {conversations[0]['round']}-{conversations[-1]['round']}）"
+    else:
+        scope = "對話"
+    early, middle, late = phase_ranges(conversations)
     
-    analysis_prompt = f"""
+    return f"""
 你是一位專業的 AI 研究員，專精於分析 Multi-Agent 系統中的幻覺與極端化現象。
 
-請仔細分析以下 20 輪對話，提供深度分析報告：
+請仔細分析以下 {scope}，提供深度分析報告：
 
 {conversation_text}
 
+以下重複度指標已由程式計算（請直接引用，不需重新估計）：
+{describe_local_scores(scores)}
+
 請從以下角度分析：
 
 1. **模型崩塌 (Model Collapse) 與跳針**
-   - 檢查 Mediator 是否每次都使用相同的開場白（如「或許我們可以折衷一下」）
-   - 分析從哪一輪開始進入「機械式重複」
-   - 這代表什麼？（局部最優解、喪失創造力）
+   - 依上方的重複開場白統計，解釋這代表什麼？（局部最優解、喪失創造力）
 
 2. **幻覺的精確分類**
-   a) 自我增強 (Self-Reinforcement)：
-      - Engineer 重複自己的數據（如「安全係數 2.5」）
-      - 這不是幻覺傳播，而是固執
+   a) 自我增強 (Self-Reinforcement) 與數據傳播：
+      - 以上方的數據傳播鏈為準（提出者自己重複的是固執，被其他 Agent 沿用的才是幻覺傳播）
+      - 不需要再列出主張與輪次
    
    b) 真正的幻覺引用 (Fabricated Citations)：
       - 找出 Ecologist 引用的期刊/書籍名稱（如《生態學與可持續發展》、《自然》雜誌）
@@ -96,9 +188,8 @@ def analyze_with_llm(conversations):
       - 有沒有人質疑這些引用的真實性？
 
 3. **對話殭屍化 (Dialogue Deadlock)**
-   - 從哪一輪開始，雙方不再回應對方的論點，只是重複自己的立場？
+   - 以上方的死鎖輪次為準，找出雙方不再回應對方論點的證據
    - 分析語氣從「辯論」變成「情緒勒索」的轉折點
-   - 計算每個 Agent 的「新觀點產出率」（是否只是換句話說）
 
 4. **極端化的真實樣貌**
    - 不只計算極端用語次數
@@ -108,47 +199,127 @@ def analyze_with_llm(conversations):
 請以 JSON 格式回傳分析結果：
 {{
   "model_collapse": {{
-    "detected": true/false,
-    "mediator_opening_phrase": "重複的開場白",
-    "repetition_count": 數字,
-    "start_round": 從哪一輪開始,
     "interpretation": "解釋這個現象"
   }},
   "hallucination_analysis": {{
-    "self_reinforcement": [
-      {{"agent": "Engineer", "claim": "安全係數 2.5", "rounds": [1, 7, 10, 13]}},
-    ],
     "fabricated_citations": [
       {{"round": 5, "agent": "Ecologist", "citation": "《生態學與可持續發展》", "analysis": "是否可疑"}},
     ]
   }},
   "dialogue_deadlock": {{
-    "deadlock_round": 從哪一輪開始死鎖,
-    "evidence": "證據說明",
-    "new_idea_rate": {{"Engineer": 0.2, "Ecologist": 0.3, "Mediator": 0.1}}
+    "evidence": "證據說明"
   }},
   "polarization_trajectory": {{
-    "early_phase": {{"rounds": "1-5", "tone": "客觀描述"}},
-    "middle_phase": {{"rounds": "6-12", "tone": "開始攻擊"}},
-    "late_phase": {{"rounds": "13-20", "tone": "情緒勒索"}},
+    "early_phase": {{"rounds": "{early}", "tone": "客觀描述"}},
+    "middle_phase": {{"rounds": "{middle}", "tone": "開始攻擊"}},
+    "late_phase": {{"rounds": "{late}", "tone": "情緒勒索"}},
     "most_extreme_quotes": ["最極端的 3 句話"]
   }}
 }}
 """
     
-    print("🔍 正在使用 LLM 進行深度分析...")
+
+
+def split_windows(conversations, window=CHUNK_ROUNDS, overlap=CHUNK_OVERLAP):
+    """切成彼此重疊 overlap 輪的分段（每段 window 輪）"""
+    step = max(window - overlap, 1)
+    windows = []
+    for start in range(0, len(conversations), step):
+        windows.append(conversations[start:start + window])
+        if start + window >= len(conversations):
+            break
+    return windows
+
+
+def merge_hallucinations(partials):
+    """
+    合併各分段的幻覺引用（重疊輪次造成的重複項目只保留一次）
+
+    自我增強與數據傳播由 claim_tracker 對整份對話計算（見 local_analysis），不由各段合併。
+    """
+    citations = {}
+    for partial in partials:
+        for item in partial.get("hallucination_analysis", {}).get("fabricated_citations", []):
+            citations.setdefault((item.get("round"), item.get("citation")), item)
+    return {
+        "fabricated_citations": sorted(citations.values(), key=lambda item: item.get("round") or 0),
+    }
+
+
+def build_reduce_prompt(windows, partials, scores):
+    """彙整各分段分析結果的 prompt（只送出各段的結論，不送原文）"""
+    window_summaries = []
+    for window, partial in zip(windows, partials):
+        summary = {
+            "rounds": f"{window[0]['round']}-{window[-1]['round']}",
+            "model_collapse": partial.get("model_collapse", {}),
+            "dialogue_deadlock": partial.get("dialogue_deadlock", {}),
+            "polarization_trajectory": partial.get("polarization_trajectory", {}),
+        }
+        window_summaries.append(json.dumps(summary, ensure_ascii=False))
+    return f"""
+你是一位專業的 AI 研究員。一份很長的 Multi-Agent 對話已分段分析完畢，以下是各段（依輪次排序）的分析結論：
+
+{chr(10).join(window_summaries)}
+
+以下重複度指標已由程式對整份對話計算（請直接引用，不需重新估計）：
+{describe_local_scores(scores)}
+
+請把各段結論彙整成整份對話的結論，以 JSON 格式回傳：
+{{
+  "model_collapse": {{
+    "interpretation": "解釋整份對話的跳針現象"
+  }},
+  "dialogue_deadlock": {{
+    "evidence": "整份對話的死鎖證據"
+  }},
+  "polarization_trajectory": {{
+    "early_phase": {{"rounds": "前期輪次範圍", "tone": "語氣"}},
+    "middle_phase": {{"rounds": "中期輪次範圍", "tone": "語氣"}},
+    "late_phase": {{"rounds": "後期輪次範圍", "tone": "語氣"}},
+    "most_extreme_quotes": ["整份對話最極端的 3 句話（從各段挑選）"]
+  }}
+}}
+"""
+
+
+def analyze_with_llm(conversations, client=None, scores=None, chunk_rounds=CHUNK_ROUNDS, overlap=CHUNK_OVERLAP,
+                     max_workers=CHUNK_WORKERS):
+    """
+    使用 LLM 深度分析對話
+
+    模型崩塌（重複開場白）、死鎖輪次與新觀點產出率由本地 novelty_scorer 計算（可重現、不需費用），
+    LLM 只負責語意判斷（幻覺分類、極端化軌跡）並解釋本地指標；回傳結構與過去相同。
+
+    超過 chunk_rounds 輪的對話改用 map-reduce：切成重疊的分段並行分析，
+    幻覺清單由程式合併去重，其餘結論再以一次只含各段結論的 reduce 請求彙整，
+    因此單次請求的長度不隨對話長度增加。
+    """
+    client = client or create_client()
+    scores = scores or score_log(conversations)
+    
+    if len(conversations) <= chunk_rounds:
+        print("🔍 正在使用 LLM 進行深度分析...")
+        return merge_local_analysis(chat_json(client, build_analysis_prompt(conversations, scores)), scores)
     
-    response = client.chat.completions.create(
-        model="gpt-4o-mini",
-        messages=[
-            {"role": "system", "content": "你是專業的 AI 研究分析師，擅長從對話中發現深層模式。請以嚴謹的科學態度分析。"},
-            {"role": "user", "content": analysis_prompt}
-        ],
-        temperature=0.3,  # 低溫度以提高分析的穩定性
-        response_format={"type": "json_object"}
-    )
+    windows = split_windows(conversations, chunk_rounds, overlap)
+    print(f"🔍 對話共 {len(conversations)} 輪，分成 {len(windows)} 段並行分析（每段 {chunk_rounds} 輪，重疊 {overlap} 輪）...")
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        partials = list(executor.map(
+            lambda window: chat_json(client, build_analysis_prompt(window, score_log(window))),
+            windows
+        ))
     
-    analysis_result = json.loads(response.choices[0].message.content)
+    print("🧩 彙整各段分析結果...")
+    analysis_result = chat_json(client, build_reduce_prompt(windows, partials, scores))
+    analysis_result["hallucination_analysis"] = merge_hallucinations(partials)
+    return merge_local_analysis(analysis_result, scores)
+
+
+def merge_local_analysis(analysis_result, scores):
+    """以本地計算的數值覆蓋 LLM 結果中的對應欄位（保留 LLM 的解釋與證據）"""
+    for key, values in local_analysis(scores).items():
+        analysis_result[key] = {**analysis_result.get(key, {}), **values}
     return analysis_result
 
 def generate_markdown_report(analysis_result, experiment_id):
@@ -173,7 +344,7 @@ def generate_markdown_report(analysis_result, experiment_id):
         report += f"""
 ### ⚠️ 偵測到嚴重的模型崩塌現象！
 
-**跳針內容**: "{mc.get('mediator_opening_phrase', 'N/A')}"
+**跳針內容**: "{mc.get('mediator_opening_phrase', 'N/A')}"（{mc.get('agent') or 'Mediator'}）
 
 **重複次數**: {mc.get('repetition_count', 0)} 次
 
@@ -205,6 +376,22 @@ def generate_markdown_report(analysis_result, experiment_id):
         report += f"- **{item.get('agent')}**: 重複主張「{item.get('claim')}」\n"
         report += f"  - 出現輪次: {rounds_str}\n\n"
     
+    propagation = ha.get('claim_propagation', [])
+    if propagation:
+        report += """
+### 🔗 數據傳播鏈
+
+以下主張由一位 Agent 提出後被其他 Agent 沿用（程式比對正規化後的數字與單位）：
+
+| 主張 | 提出 | 沿用 | 質疑 |
+|------|------|------|------|
+"""
+        for item in propagation:
+            introduced = item['introduced']
+            adopters = '、'.join(f"{a['agent']} R{a['round']}" for a in item['adopters'])
+            challenges = '、'.join(f"{c['agent']} R{c['round']}" for c in item['challenges']) or '⚠️ 無人質疑'
+            report += f"| {item['claim']} | {introduced['agent']} R{introduced['round']} | {adopters} | {challenges} |\n"
+    
     report += """
 ### B. 虛構引用 (Fabricated Citations) ⚠️
 
@@ -229,12 +416,14 @@ def generate_markdown_report(analysis_result, experiment_id):
     
     dd = analysis_result.get('dialogue_deadlock', {})
     report += f"""
-### ⚰️ 對話死亡時間點: Round {dd.get('deadlock_round', 'N/A')}
+### ⚰️ 對話死亡時間點: {f"Round {dd['deadlock_round']}" if dd.get('deadlock_round') else '未偵測到'}
 
 {dd.get('evidence', '無證據')}
 
 ### 📉 新觀點產出率
 
+新穎度 = 1 − 與先前任一輪的最大字元 n-gram TF-IDF 相似度；產出率為新穎度 ≥ 0.5 的輪次比例（本地計算，可重現）。
+
 """
     
     idea_rate = dd.get('new_idea_rate', {})
@@ -313,39 +502,331 @@ def generate_markdown_report(analysis_result, experiment_id):
     
     return report
 
+def save_markdown_report(analysis_result, experiment_id):
+    """寫出 deep_analysis_report_{experiment_id}.md，回傳檔名"""
+    output_filename = f"deep_analysis_report_{experiment_id}.md"
+    with open(output_filename, 'w', encoding='utf-8') as f:
+        f.write(generate_markdown_report(analysis_result, experiment_id))
+    return output_filename
+
+
+LOG_PATTERNS = ("experiment_log_*", "experiment_v1_log_*", "experiment_v2_log_*")
+CONFIDENCE_Z = 1.96  # 95% 信賴區間（常態近似）
+
+
+# 時間戳記（可帶 replicate 編號）或參數掃描的 sweep_<設定雜湊>_rNNN
+_EXPERIMENT_ID = re.compile(r'(\d{8}_\d{6}(?:_r\d+)?|sweep_[0-9a-f]+_r\d+)')
+
+
+def experiment_id_from_filename(log_filename):
+    """
+    提取實驗 ID
+
+    優先使用結構化紀錄 / 事件紀錄中的 experiment_id，其次從檔名比對；都沒有時使用去掉前綴的檔名，
+    不會以目前時間代替（同一秒內分析的 log 會互相覆寫報告）。
+    """
+    experiment_id = read_meta(log_filename).get("experiment_id")
+    if experiment_id:
+        return experiment_id
+    stem = os.path.splitext(os.path.basename(log_filename))[0]
+    match = _EXPERIMENT_ID.search(stem)
+    if match:
+        return match.group(1)
+    return re.sub(r'^(?:experiment_(?:v\d_)?log|events(?:_v\d)?)_', '', stem)
+
+
+def find_logs(paths):
+    """
+    展開檔案、萬用字元與目錄為實驗 log 清單
+
+    目錄會搜尋 LOG_PATTERNS 的 .md 與 .jsonl；同名的 .md 與 .jsonl 只保留一份（優先 .jsonl）。
+    """
+    candidates = []
+    for path in paths:
+        if os.path.isdir(path):
+            for pattern in LOG_PATTERNS:
+                candidates.extend(glob.glob(os.path.join(path, pattern + ".jsonl")))
+                candidates.extend(glob.glob(os.path.join(path, pattern + ".md")))
+        else:
+            candidates.extend(glob.glob(path) or [path])
+    by_stem = {}
+    for candidate in candidates:
+        stem, extension = os.path.splitext(candidate)
+        if stem not in by_stem or extension == ".jsonl":
+            by_stem[stem] = candidate
+    return sorted(by_stem.values())
+
+
+def parse_and_score(log_filename):
+    """解析一份 log 並做本地評分（在子 process 中執行，不回傳相似度矩陣）"""
+    conversations = read_experiment_log(log_filename)
+    scores = score_log(conversations)
+    scores.pop("similarity")
+    return log_filename, conversations, scores
+
+
+def summarize_distribution(values):
+    """平均值與 95% 信賴區間（樣本數不足時區間為 None）"""
+    values = [v for v in values if v is not None]
+    if not values:
+        return {"n": 0, "mean": None, "ci_low": None, "ci_high": None}
+    n = len(values)
+    mean = sum(values) / n
+    if n < 2:
+        return {"n": n, "mean": mean, "ci_low": None, "ci_high": None}
+    std = (sum((v - mean) ** 2 for v in values) / (n - 1)) ** 0.5
+    half_width = CONFIDENCE_Z * std / n ** 0.5
+    return {"n": n, "mean": mean, "ci_low": mean - half_width, "ci_high": mean + half_width}
+
+
+def analyze_batch(paths, local_only=False, concurrency=4, processes=None, chunk_rounds=CHUNK_ROUNDS,
+                  overlap=CHUNK_OVERLAP, client=None):
+    """
+    批次分析多份 log
+
+    解析與本地評分在 process pool 中進行；LLM 分析以 concurrency 限制同時進行的份數，
+    每份寫出自己的 deep_analysis_report。
+
+    Returns:
+        list: 每份的 {"log", "experiment_id", "turns", "scores", "analysis", "error"}
+    """
+    with ProcessPoolExecutor(max_workers=processes) as pool:
+        parsed = list(pool.map(parse_and_score, paths))
+    print(f"✅ 已解析並評分 {len(parsed)} 份 log")
+    
+    if not local_only:
+        client = client or create_client()
+    
+    def analyze_one(item):
+        log_filename, conversations, scores = item
+        experiment_id = experiment_id_from_filename(log_filename)
+        run = {"log": log_filename, "experiment_id": experiment_id, "turns": len(conversations), "scores": scores,
+               "analysis": None, "error": None}
+        try:
+            if local_only:
+                run["analysis"] = local_analysis(scores)
+            else:
+                run["analysis"] = analyze_with_llm(conversations, client=client, scores=scores,
+                                                   chunk_rounds=chunk_rounds, overlap=overlap, max_workers=1)
+            save_markdown_report(run["analysis"], experiment_id)
+        except Exception as e:
+            run["error"] = str(e) or type(e).__name__
+            print(f"   ⚠️ {log_filename} 分析失敗: {run['error']}")
+        return run
+    
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        return list(executor.map(analyze_one, parsed))
+
+
+def batch_custom_id(log_filename, part=None):
+    """批次請求的 custom_id（以 log 檔名區分，v1 / v2 同一秒開始的實驗也不會衝突）"""
+    stem = os.path.splitext(os.path.basename(log_filename))[0]
+    return f"analysis:{stem}:{part}" if part else f"analysis:{stem}"
+
+
+def export_analysis_batch(log_filenames, path, chunk_rounds=CHUNK_ROUNDS, overlap=CHUNK_OVERLAP):
+    """
+    把各 log 的分析 prompt 寫成批次請求檔，回傳請求數
+
+    短對話一份一個請求；長對話每個分段一個請求（custom_id 後綴 w1、w2…），
+    分段的彙整要等分段結果匯入後才能產生（見 import_analysis_batch）。
+    """
+    requests = []
+    for log_filename in log_filenames:
+        conversations = read_experiment_log(log_filename)
+        if len(conversations) <= chunk_rounds:
+            prompt = build_analysis_prompt(conversations, score_log(conversations))
+            requests.append(batch_request(batch_custom_id(log_filename), "chat", analysis_request(prompt)))
+            continue
+        for index, window in enumerate(split_windows(conversations, chunk_rounds, overlap), 1):
+            prompt = build_analysis_prompt(window, score_log(window))
+            requests.append(batch_request(batch_custom_id(log_filename, f"w{index}"), "chat", analysis_request(prompt)))
+    return write_batch_file(path, requests)
+
+
+def batch_json(results, custom_id):
+    """取出一筆批次結果的 JSON 內容（缺少或失敗時拋出 ValueError）"""
+    if custom_id not in results:
+        raise ValueError(f"結果檔中沒有 {custom_id}")
+    api, response = results[custom_id]
+    if api is None:
+        raise ValueError(f"{custom_id} 批次請求失敗: {response}")
+    return json.loads(response_text(api, response))
+
+
+def import_analysis_batch(log_filenames, results, chunk_rounds=CHUNK_ROUNDS, overlap=CHUNK_OVERLAP):
+    """
+    由批次結果完成各 log 的分析
+
+    長對話的分段結果都到齊、但還沒有彙整結果時，產生彙整請求（custom_id 後綴 reduce），
+    需再送一次批次；匯入時可同時傳入兩次的結果。
+
+    Returns:
+        tuple: (runs, followups)；runs 與 analyze_batch() 的回傳格式相同（尚未完成者的 error 說明原因），
+               followups 為待送出的彙整請求
+    """
+    runs = []
+    followups = []
+    for log_filename in log_filenames:
+        conversations = read_experiment_log(log_filename)
+        scores = score_log(conversations)
+        scores.pop("similarity")
+        run = {"log": log_filename, "experiment_id": experiment_id_from_filename(log_filename),
+               "turns": len(conversations), "scores": scores, "analysis": None, "error": None}
+        runs.append(run)
+        try:
+            if len(conversations) <= chunk_rounds:
+                run["analysis"] = merge_local_analysis(batch_json(results, batch_custom_id(log_filename)), scores)
+                continue
+            windows = split_windows(conversations, chunk_rounds, overlap)
+            partials = [batch_json(results, batch_custom_id(log_filename, f"w{index}"))
+                        for index in range(1, len(windows) + 1)]
+            reduce_id = batch_custom_id(log_filename, "reduce")
+            if reduce_id not in results:
+                prompt = build_reduce_prompt(windows, partials, scores)
+                followups.append(batch_request(reduce_id, "chat", analysis_request(prompt)))
+                run["error"] = "等待彙整批次結果"
+                continue
+            analysis_result = batch_json(results, reduce_id)
+            analysis_result["hallucination_analysis"] = merge_hallucinations(partials)
+            run["analysis"] = merge_local_analysis(analysis_result, scores)
+        except ValueError as e:
+            run["error"] = str(e)
+    return runs, followups
+
+
+def generate_aggregate_report(runs):
+    """跨實驗的彙總報告（各指標的平均值與 95% 信賴區間）"""
+    completed = [run for run in runs if not run["error"]]
+    deadlocks = [run["scores"]["deadlock_round"] for run in completed]
+    metrics = [
+        ("死鎖輪次（有死鎖的實驗）", summarize_distribution(deadlocks)),
+        ("平均新穎度", summarize_distribution(
+            [sum(run["scores"]["novelty"]) / len(run["scores"]["novelty"]) for run in completed if run["scores"]["novelty"]]
+        )),
+    ]
+    citation_counts = [
+        len(run["analysis"].get("hallucination_analysis", {}).get("fabricated_citations", []))
+        for run in completed if "fabricated_citations" in run["analysis"].get("hallucination_analysis", {})
+    ]
+    if citation_counts:
+        metrics.append(("虛構引用數", summarize_distribution(citation_counts)))
+    metrics.append(("沿用後未被質疑的主張數", summarize_distribution(
+        [unchallenged_adoptions(run["scores"]) for run in completed]
+    )))
+    agents = dict.fromkeys(agent for run in completed for agent in run["scores"]["new_idea_rate"])
+    for agent in agents:
+        metrics.append((f"新觀點產出率 - {agent}", summarize_distribution(
+            [run["scores"]["new_idea_rate"].get(agent) for run in completed]
+        )))
+    
+    def fmt(value):
+        return "-" if value is None else f"{value:.3f}"
+    
+    report = f"""# 📊 Multi-Agent 實驗批次分析彙總
+
+## 📋 批次資訊
+- **分析日期**: {datetime.now().strftime("%Y-%m-%d %H:%M:%S")}
+- **實驗數**: {len(runs)}（成功 {len(completed)}，失敗 {len(runs) - len(completed)}）
+- **偵測到死鎖**: {sum(1 for d in deadlocks if d is not None)}/{len(completed)} 次
+- **偵測到跳針開場白**: {sum(1 for run in completed if run["scores"]["repeated_openings"])}/{len(completed)} 次
+
+---
+
+## 📈 指標分佈（平均值與 95% 信賴區間）
+
+| 指標 | 樣本數 | 平均值 | 95% CI 下限 | 95% CI 上限 |
+|------|--------|--------|-------------|-------------|
+"""
+    for name, summary in metrics:
+        report += f"| {name} | {summary['n']} | {fmt(summary['mean'])} | {fmt(summary['ci_low'])} | {fmt(summary['ci_high'])} |\n"
+    
+    report += """
+---
+
+## 🗂️ 各實驗摘要
+
+| 實驗編號 | 輪數 | 死鎖輪次 | 虛構引用數 | 新觀點產出率 |
+|----------|------|----------|------------|--------------|
+"""
+    for run in runs:
+        if run["error"]:
+            report += f"| `{run['experiment_id']}` | {run['turns']} | ⚠️ 分析失敗 | - | {run['error']} |\n"
+            continue
+        citations = run["analysis"].get("hallucination_analysis", {}).get("fabricated_citations")
+        rates = "、".join(f"{agent} {rate:.0%}" for agent, rate in run["scores"]["new_idea_rate"].items())
+        report += (f"| `{run['experiment_id']}` | {run['turns']} | {run['scores']['deadlock_round'] or '-'} | "
+                   f"{'-' if citations is None else len(citations)} | {rates} |\n")
+    return report
+
+
 def main():
+    import argparse
     import sys
     
-    if len(sys.argv) < 2:
-        print("使用方法: python analyze_experiment.py <log檔案名稱>")
-        print("範例: python analyze_experiment.py experiment_log_20260202_092459.md")
+    parser = argparse.ArgumentParser(
+        description="Multi-Agent 實驗深度分析",
+        epilog="範例: python analyze_experiment.py experiment_log_20260202_092459.md\n"
+               "      python analyze_experiment.py logs/ --concurrency 8   # 批次分析整個目錄",
+        formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("log_filenames", nargs="+", help="實驗 log（.md、.jsonl、events_*.jsonl、萬用字元或目錄）")
+    parser.add_argument("--local-only", action="store_true", help="只做本地新穎度評分，不呼叫 LLM")
+    parser.add_argument("--chunk-rounds", type=int, default=CHUNK_ROUNDS, help="超過此輪數改用分段（map-reduce）分析")
+    parser.add_argument("--chunk-overlap", type=int, default=CHUNK_OVERLAP, help="相鄰分段重疊的輪數")
+    parser.add_argument("--workers", type=int, default=CHUNK_WORKERS, help="同時分析的分段數")
+    parser.add_argument("--concurrency", type=int, default=4, help="批次模式：同時分析的 log 數")
+    parser.add_argument("--processes", type=int, help="批次模式：解析用的 process 數（預設為 CPU 數）")
+    parser.add_argument("--batch-export", metavar="FILE", help="不呼叫 API，把分析 prompt 寫成 Batch API 請求檔")
+    parser.add_argument("--batch-import", nargs="+", metavar="RESULTS", help="由 Batch API 結果檔產生分析報告")
+    args = parser.parse_args()
+    
+    log_filenames = find_logs(args.log_filenames)
+    if not log_filenames:
+        print(f"❌ 找不到任何實驗 log: {' '.join(args.log_filenames)}")
         sys.exit(1)
-    
-    log_filename = sys.argv[1]
+    if args.batch_import:
+        import_batch(log_filenames, args)
+        return
+    if args.batch_export:
+        count = export_analysis_batch(log_filenames, args.batch_export, args.chunk_rounds, args.chunk_overlap)
+        print(f"📦 已將 {len(log_filenames)} 份 log 的 {count} 個分析請求寫入 {args.batch_export}")
+        print(f"   批次完成後執行: python analyze_experiment.py {' '.join(args.log_filenames)} --batch-import <結果檔>")
+        return
+    if len(log_filenames) > 1 or os.path.isdir(args.log_filenames[0]):
+        run_batch(log_filenames, args)
+        return
+    log_filename = log_filenames[0]
     
     if not os.path.exists(log_filename):
         print(f"❌ 找不到檔案: {log_filename}")
         sys.exit(1)
     
     # 從檔名提取實驗 ID
-    import re
-    match = re.search(r'(\d{8}_\d{6})', log_filename)
-    experiment_id = match.group(1) if match else datetime.now().strftime("%Y%m%d_%H%M%S")
+    experiment_id = experiment_id_from_filename(log_filename)
     
     print(f"📂 讀取實驗 log: {log_filename}")
     conversations = read_experiment_log(log_filename)
     print(f"✅ 成功解析 {len(conversations)} 輪對話")
     
-    print("\n🤖 開始 AI 深度分析...")
-    analysis_result = analyze_with_llm(conversations)
+    scores = score_log(conversations)
+    print(f"📐 本地評分：死鎖輪次 {scores['deadlock_round'] or '未偵測到'}，新觀點產出率 "
+          + "、".join(f"{agent} {rate:.0%}" for agent, rate in scores["new_idea_rate"].items()))
     
-    print("\n📝 生成分析報告...")
-    report = generate_markdown_report(analysis_result, experiment_id)
+    if args.local_only:
+        analysis_result = local_analysis(scores)
+    else:
+        print("\n🤖 開始 AI 深度分析...")
+        analysis_result = analyze_with_llm(
+            conversations,
+            scores=scores,
+            chunk_rounds=args.chunk_rounds,
+            overlap=args.chunk_overlap,
+            max_workers=args.workers
+        )
     
-    # 保存報告
-    output_filename = f"deep_analysis_report_{experiment_id}.md"
-    with open(output_filename, 'w', encoding='utf-8') as f:
-        f.write(report)
+    print("\n📝 生成分析報告...")
+    output_filename = save_markdown_report(analysis_result, experiment_id)
     
     print(f"\n✅ 深度分析報告已保存: {output_filename}")
     print("\n💡 建議:")
@@ -353,5 +834,50 @@ def main():
     print("   2. 比對原始 log 檔驗證分析結果")
     print("   3. 這份報告可直接用於學術研究")
 
+
+def run_batch(log_filenames, args):
+    """批次模式：分析所有 log 並寫出彙總報告"""
+    import time
+    
+    started = time.perf_counter()
+    print(f"📂 批次分析 {len(log_filenames)} 份 log（同時 {args.concurrency} 份）")
+    runs = analyze_batch(
+        log_filenames,
+        local_only=args.local_only,
+        concurrency=args.concurrency,
+        processes=args.processes,
+        chunk_rounds=args.chunk_rounds,
+        overlap=args.chunk_overlap
+    )
+    output_filename = f"aggregate_analysis_report_{datetime.now().strftime('%Y%m%d_%H%M%S')}.md"
+    with open(output_filename, 'w', encoding='utf-8') as f:
+        f.write(generate_aggregate_report(runs))
+    
+    failed = sum(1 for run in runs if run["error"])
+    print(f"\n✅ 完成 {len(runs) - failed}/{len(runs)} 份，耗時 {time.perf_counter() - started:.1f} 秒")
+    print(f"📊 彙總報告已保存: {output_filename}")
+
+
+def import_batch(log_filenames, args):
+    """匯入批次結果：寫出各份報告；長對話尚缺彙整時寫出下一個批次請求檔"""
+    results = read_batch_results(*args.batch_import)
+    runs, followups = import_analysis_batch(log_filenames, results, args.chunk_rounds, args.chunk_overlap)
+    for run in runs:
+        if run["analysis"]:
+            print(f"✅ {save_markdown_report(run['analysis'], run['experiment_id'])}")
+        else:
+            print(f"⏳ {run['log']}: {run['error']}")
+    if len(runs) > 1:
+        output_filename = f"aggregate_analysis_report_{datetime.now().strftime('%Y%m%d_%H%M%S')}.md"
+        with open(output_filename, 'w', encoding='utf-8') as f:
+            f.write(generate_aggregate_report(runs))
+        print(f"📊 彙總報告已保存: {output_filename}")
+    if followups:
+        followup_filename = args.batch_export or f"batch_reduce_{datetime.now().strftime('%Y%m%d_%H%M%S')}.jsonl"
+        write_batch_file(followup_filename, followups)
+        print(f"\n📦 {len(followups)} 份長對話的分段結果已到齊，彙整請求已寫入 {followup_filename}")
+        print(f"   批次完成後執行: python analyze_experiment.py {' '.join(args.log_filenames)} "
+              f"--batch-import {' '.join(args.batch_import)} <彙整結果檔>")
+
 if __name__ == "__main__":
     main()
@@ -0,0 +1,133 @@
+"""
+批次請求檔（Batch API 格式的 JSONL）
+把彼此獨立的請求（各 log 的分析 prompt、多次 replicate 的第一輪發言）寫成一個請求檔，
+交給非同步的批次處理（價格較低、不佔即時額度），完成後再由結果檔匯回分析報告與實驗狀態。
+
+請求檔每行：{"custom_id", "method": "POST", "url", "body"}
+結果檔每行：{"id", "custom_id", "response": {"status_code", "request_id", "body"}, "error"}
+
+沒有批次服務時，可用本模組以任何後端在本機填出結果檔（格式相同），方便端對端測試:
+    python batch_requests.py batch_input.jsonl batch_output.jsonl --backend mock
+"""
+import argparse
+import asyncio
+import json
+import time
+
+import llm_backends
+from llm_session import create_session
+from response_cache import RESPONSE_TYPES
+from retry_policy import LLMCallFailed
+
+BATCH_ENDPOINTS = {
+    "chat": "/v1/chat/completions",
+    "responses": "/v1/responses",
+}
+_ENDPOINT_APIS = {url: api for api, url in BATCH_ENDPOINTS.items()}
+
+
+def batch_request(custom_id, api, request):
+    """一行批次請求（custom_id 在同一個檔案中必須唯一）"""
+    return {"custom_id": custom_id, "method": "POST", "url": BATCH_ENDPOINTS[api], "body": request}
+
+
+def write_batch_file(path, requests):
+    """寫出批次請求檔，回傳請求數"""
+    count = 0
+    seen = set()
+    with open(path, "w", encoding="utf-8") as f:
+        for request in requests:
+            if request["custom_id"] in seen:
+                raise ValueError(f"custom_id 重複: {request['custom_id']}")
+            seen.add(request["custom_id"])
+            f.write(json.dumps(request, ensure_ascii=False) + "\n")
+            count += 1
+    return count
+
+
+def read_batch_file(path):
+    """逐行讀出批次請求"""
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+
+def api_for_body(body):
+    """由回應內容判斷 API 類型（結果檔不含 url）"""
+    return "chat" if body.get("object") == "chat.completion" else "responses"
+
+
+def read_batch_results(*paths):
+    """
+    讀取一或多個結果檔
+
+    Returns:
+        dict: custom_id -> (api, response 物件)；失敗的請求為 custom_id -> (None, 錯誤訊息)
+    """
+    results = {}
+    for path in paths:
+        for record in read_batch_file(path):
+            response = record.get("response") or {}
+            body = response.get("body")
+            if record.get("error") or response.get("status_code", 200) != 200 or body is None:
+                error = record.get("error") or (body or {}).get("error") or {}
+                results[record["custom_id"]] = (None, error.get("message") or f"HTTP {response.get('status_code')}")
+                continue
+            api = api_for_body(body)
+            # 與回應快取相同的寬鬆建構方式，避免 SDK 版本差異造成驗證失敗
+            results[record["custom_id"]] = (api, RESPONSE_TYPES[api].construct(**body))
+    return results
+
+
+async def run_batch_locally(input_path, output_path, session, concurrency=8):
+    """
+    以 LLMSession 在本機執行批次請求檔，寫出格式相同的結果檔（批次服務的本機替身）
+
+    Returns:
+        tuple: (成功數, 失敗數)
+    """
+    requests = list(read_batch_file(input_path))
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def run_one(index, request):
+        api = _ENDPOINT_APIS[request["url"]]
+        record = {"id": f"batch_req_{index:06d}", "custom_id": request["custom_id"], "response": None, "error": None}
+        async with semaphore:
+            try:
+                response = await session.create(api, request["body"], labels={"seed": request["custom_id"]})
+            except LLMCallFailed as e:
+                record["error"] = {"code": "request_failed", "message": str(e)}
+                return record
+        record["response"] = {
+            "status_code": 200,
+            "request_id": f"local_{index:06d}",
+            "body": response.model_dump(mode="json"),
+        }
+        return record
+
+    records = await asyncio.gather(*(run_one(i, request) for i, request in enumerate(requests)))
+    with open(output_path, "w", encoding="utf-8") as f:
+        for record in records:
+            f.write(json.dumps(record, ensure_ascii=False) + "\n")
+    failed = sum(1 for record in records if record["error"])
+    return len(records) - failed, failed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="在本機執行 Batch API 格式的請求檔（批次服務的本機替身）")
+    parser.add_argument("input", help="批次請求檔（.jsonl）")
+    parser.add_argument("output", help="輸出的結果檔（.jsonl）")
+    parser.add_argument("--backend", default="mock", help="LLM 後端（openai / mock）")
+    parser.add_argument("--concurrency", type=int, default=8, help="同時送出的請求數")
+    args = parser.parse_args()
+
+    session = create_session(llm_backends.create_client(args.backend), rate_limited=args.backend != "mock")
+    started = time.perf_counter()
+    succeeded, failed = asyncio.run(run_batch_locally(args.input, args.output, session, args.concurrency))
+    print(f"✅ 完成 {succeeded} 筆請求（失敗 {failed} 筆），耗時 {time.perf_counter() - started:.1f} 秒")
+    print(f"📄 結果檔已保存: {args.output}")
+
+
+if __name__ == "__main__":
+    main()
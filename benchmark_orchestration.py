@@ -0,0 +1,60 @@
+"""
+對話迴圈效能基準（離線）
+以 mock 後端（零延遲）執行長對話，量測迴圈本身、log/報告寫出與分析器解析的每輪額外開銷。
+
+使用方法:
+    python benchmark_orchestration.py --version v1 --rounds 2000
+"""
+import argparse
+import asyncio
+import os
+import tempfile
+import time
+
+import analyze_experiment
+from experiment_runner import SIMULATORS
+from llm_session import LLMSession
+from mock_llm import MockLLMClient
+from transcript import iter_markdown_turns
+
+
+def timed(func, *args):
+    started = time.perf_counter()
+    result = func(*args)
+    return result, time.perf_counter() - started
+
+
+def main():
+    parser = argparse.ArgumentParser(description="以 mock 後端量測對話迴圈的每輪開銷")
+    parser.add_argument("--version", choices=sorted(SIMULATORS), default="v1", help="實驗版本")
+    parser.add_argument("--rounds", type=int, default=1000, help="輪數")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="mock 後端的錯誤率")
+    args = parser.parse_args()
+
+    simulator = SIMULATORS[args.version]
+    session = LLMSession(MockLLMClient(error_rate=args.error_rate))
+    state = simulator.new_run_state("benchmark", rounds=args.rounds, event_log=False)
+
+    _, loop_seconds = timed(lambda: asyncio.run(simulator.run_discussion(session, state, verbose=False)))
+
+    original_dir = os.getcwd()
+    with tempfile.TemporaryDirectory() as workdir:
+        os.chdir(workdir)
+        try:
+            log_filename, log_seconds = timed(simulator.write_experiment_log, state)
+            _, report_seconds = timed(simulator.write_analysis_report, state)
+            conversations, parse_seconds = timed(analyze_experiment.read_experiment_log, log_filename)
+            markdown_turns, markdown_seconds = timed(lambda path: list(iter_markdown_turns(path)), log_filename)
+        finally:
+            os.chdir(original_dir)
+
+    rounds = args.rounds
+    print(f"📏 {args.version} × {rounds} 輪（mock 後端，零延遲）")
+    print(f"   對話迴圈: {loop_seconds:.3f} 秒（{rounds / loop_seconds:,.0f} 輪/秒）")
+    print(f"   寫出 log: {log_seconds:.3f} 秒，寫出報告: {report_seconds:.3f} 秒")
+    print(f"   分析器解析: {parse_seconds:.3f} 秒（解析出 {len(conversations)} 輪；markdown 備援 {markdown_seconds:.3f} 秒、{len(markdown_turns)} 輪）")
+    print(f"   API 失敗輪次: {len(state['statistics']['failures'])}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,149 @@
+"""
+用量上限（token / 費用 / 執行時間）
+單次實驗與整批實驗各有一個 Budget；每次呼叫前先以最壞情況的估計值預留額度，
+超過任一上限就拋出 BudgetExceeded（不送出請求），呼叫結束後再以實際用量結算。
+用量達到 degrade_at 比例時，模擬器改用較便宜的請求（縮短對話紀錄、關閉 web_search）。
+"""
+import time
+
+LIMIT_NAMES = {  # 報告與事件紀錄中的顯示名稱（接在「實驗的」、「整批的」之後）
+    "tokens": " token 用量",
+    "cost_usd": "費用",
+    "seconds": "執行時間",
+}
+
+
+class BudgetExceeded(Exception):
+    """預留額度會超過上限（name 為 "tokens" / "cost_usd" / "seconds"，limit 為該項上限）"""
+
+    def __init__(self, name, limit, message):
+        super().__init__(message)
+        self.name = name
+        self.limit = limit
+
+
+class Budget:
+    """
+    token / 費用 / 執行時間的上限
+
+    Args:
+        max_tokens: token 上限（輸入 + 輸出；None 表示不限）
+        max_cost_usd: 估計費用上限（美元；None 表示不限）
+        max_seconds: 執行時間上限（秒，自建立 Budget 起算；None 表示不限）
+        degrade_at: 任一用量達到上限的這個比例時 should_degrade() 為 True（None 表示不降級，只在超過上限時停止）
+        name: 顯示用名稱（例如「實驗」、「整批」）
+        tokens: 已使用的 token 數（續跑時由事件紀錄計入）
+        cost_usd: 已使用的估計費用
+    """
+
+    def __init__(self, max_tokens=None, max_cost_usd=None, max_seconds=None, degrade_at=None, name="實驗",
+                 tokens=0, cost_usd=0.0):
+        self.max_tokens = max_tokens
+        self.max_cost_usd = max_cost_usd
+        self.max_seconds = max_seconds
+        self.degrade_at = degrade_at
+        self.name = name
+        self.tokens = tokens
+        self.cost_usd = cost_usd
+        self.reserved_tokens = 0
+        self.reserved_cost_usd = 0.0
+        self.started = time.monotonic()
+
+    @classmethod
+    def from_config(cls, config, name="實驗", tokens=0, cost_usd=0.0):
+        """由 new_run_state 的 budget 設定建立（config 為 None 時回傳 None）"""
+        if not config:
+            return None
+        return cls(name=name, tokens=tokens, cost_usd=cost_usd, **config)
+
+    def elapsed(self):
+        return time.monotonic() - self.started
+
+    def _fractions(self):
+        """各項用量（含預留）佔上限的比例"""
+        fractions = {}
+        if self.max_tokens:
+            fractions["tokens"] = (self.tokens + self.reserved_tokens) / self.max_tokens
+        if self.max_cost_usd:
+            fractions["cost_usd"] = (self.cost_usd + self.reserved_cost_usd) / self.max_cost_usd
+        if self.max_seconds:
+            fractions["seconds"] = self.elapsed() / self.max_seconds
+        return fractions
+
+    def reserve(self, tokens, cost_usd):
+        """
+        預留一次呼叫的估計用量
+
+        Raises:
+            BudgetExceeded: 預留後會超過 token 或費用上限，或已超過執行時間上限
+        """
+        if self.max_seconds and self.elapsed() >= self.max_seconds:
+            raise BudgetExceeded("seconds", self.max_seconds,
+                                 f"{self.name}執行時間已達上限 {self.max_seconds:.0f} 秒")
+        if self.max_tokens and self.tokens + self.reserved_tokens + tokens > self.max_tokens:
+            raise BudgetExceeded("tokens", self.max_tokens,
+                                 f"{self.name} token 上限 {self.max_tokens:,}：已用 {self.tokens:,}，"
+                                 f"本次估計 {tokens:,}")
+        if self.max_cost_usd and self.cost_usd + self.reserved_cost_usd + cost_usd > self.max_cost_usd:
+            raise BudgetExceeded("cost_usd", self.max_cost_usd,
+                                 f"{self.name}費用上限 ${self.max_cost_usd:.4f}：已用 ${self.cost_usd:.4f}，"
+                                 f"本次估計 ${cost_usd:.4f}")
+        self.reserved_tokens += tokens
+        self.reserved_cost_usd += cost_usd
+
+    def settle(self, reserved_tokens, reserved_cost_usd, tokens=0, cost_usd=0.0):
+        """釋放預留額度並計入實際用量（呼叫失敗時實際用量為 0）"""
+        self.reserved_tokens -= reserved_tokens
+        self.reserved_cost_usd -= reserved_cost_usd
+        self.tokens += tokens
+        self.cost_usd += cost_usd
+
+    def should_degrade(self):
+        """任一用量達到 degrade_at 比例時回傳該項名稱（"tokens" / "cost_usd" / "seconds"），否則回傳 None"""
+        if self.degrade_at is None:
+            return None
+        for name, fraction in self._fractions().items():
+            if fraction >= self.degrade_at:
+                return name
+        return None
+
+    def check(self):
+        """
+        任一用量已達上限時拋出 BudgetExceeded（例如決定是否開始下一次實驗）
+
+        Raises:
+            BudgetExceeded: 已有任一項用量達到上限
+        """
+        limits = {"tokens": self.max_tokens, "cost_usd": self.max_cost_usd, "seconds": self.max_seconds}
+        for name, fraction in self._fractions().items():
+            if fraction >= 1:
+                raise BudgetExceeded(name, limits[name], f"{self.name}的{LIMIT_NAMES[name]}已達上限")
+
+    def usage(self):
+        """已使用的 token、費用與執行時間，以及各自的上限"""
+        return {
+            "tokens": self.tokens,
+            "max_tokens": self.max_tokens,
+            "cost_usd": round(self.cost_usd, 6),
+            "max_cost_usd": self.max_cost_usd,
+            "seconds": round(self.elapsed(), 1),
+            "max_seconds": self.max_seconds,
+        }
+
+
+def degrade_reason(budgets):
+    """第一個達到降級比例的 Budget 的說明（例如「實驗的費用已達上限的 80%」）；都未達到時回傳 None"""
+    for budget in budgets:
+        name = budget.should_degrade()
+        if name:
+            return f"{budget.name}的{LIMIT_NAMES[name]}已達上限的 {budget.degrade_at:.0%}"
+    return None
+
+
+def describe_usage(usage):
+    """usage() 的一行說明（例如「token 1,200 / 5,000、費用 $0.0010 / $0.0100」）"""
+    parts = [f"token {usage['tokens']:,}" + (f" / {usage['max_tokens']:,}" if usage["max_tokens"] else ""),
+             f"費用 ${usage['cost_usd']:.4f}" + (f" / ${usage['max_cost_usd']:.4f}" if usage["max_cost_usd"] else "")]
+    if usage["max_seconds"]:
+        parts.append(f"執行時間 {usage['seconds']:.0f} / {usage['max_seconds']:.0f} 秒")
+    return "、".join(parts)
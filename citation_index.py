@@ -0,0 +1,261 @@
+"""
+引用與來源索引（不呼叫 API）
+從對話紀錄抽出 v2 回應中的來源連結（[標題](網址) 與裸網址）以及 v1 常見的期刊 / 書名（《…》、〈…〉），
+正規化後寫入 SQLite 倒排索引：網址 / 網域 / 書名 → (實驗, 輪次, Agent)。
+索引可累加更新（內容未變動的檔案不重新解析），數千份對話紀錄也能即時回答
+「哪些實驗引用了這個來源」、「這個引用第一次出現在哪裡」、「有多少編造的書名在不同實驗間重複出現」。
+
+使用方法:
+    python citation_index.py logs/ --db citations.db                    # 建立 / 更新索引
+    python citation_index.py --db citations.db --source homepage.ntu.edu.tw
+    python citation_index.py --db citations.db --title 生態學與可持續發展
+    python citation_index.py --db citations.db --recurring --min-runs 3
+"""
+import argparse
+import os
+import re
+import sqlite3
+import time
+import unicodedata
+from urllib.parse import parse_qsl, unquote, urlencode, urlsplit
+
+from analyze_experiment import experiment_id_from_filename, find_logs
+from transcript import iter_turns
+
+DEFAULT_DB = "citations.db"
+KINDS = ("url", "domain", "title")
+KIND_NAMES = {"url": "網址", "domain": "網域", "title": "書名"}
+TRACKING_PARAMS = ("utm_", "fbclid", "gclid")  # 正規化時移除的追蹤參數（前綴）
+
+_MARKDOWN_LINK = re.compile(r"\[([^\]]*)\]\((https?://[^\s)]+)\)")
+_BARE_URL = re.compile(r"https?://[^\s)\]）」》,，。]+")
+_TITLE = re.compile(r"《([^《》]{1,40})》|〈([^〈〉]{1,40})〉")
+
+
+def normalize_url(url):
+    """小寫網域、去除 www.、追蹤參數、錨點與結尾斜線，路徑解碼成可讀文字（同一來源的不同寫法得到相同的鍵）"""
+    parts = urlsplit(url.strip())
+    host = (parts.hostname or "").lower()
+    if host.startswith("www."):
+        host = host[4:]
+    path = unquote(parts.path).rstrip("/")
+    query = urlencode([(key, value) for key, value in parse_qsl(parts.query, keep_blank_values=True)
+                       if not key.lower().startswith(TRACKING_PARAMS)])
+    return host + path + (f"?{query}" if query else "")
+
+
+def url_domain(normalized_url):
+    return normalized_url.split("/", 1)[0].split("?", 1)[0]
+
+
+def normalize_title(title):
+    """全形 / 半形統一、去除空白與書名號"""
+    return "".join(unicodedata.normalize("NFKC", title).split()).strip("《》〈〉")
+
+
+def extract_citations(text):
+    """
+    抽出一輪發言中的引用（同一輪重複出現的只記一次）
+
+    Returns:
+        list: (種類, 正規化的鍵, 原文) ；種類為 "url" / "domain" / "title"
+    """
+    found = {}
+
+    def add(kind, key, display):
+        if key and (kind, key) not in found:
+            found[(kind, key)] = display
+
+    linked = set()  # markdown 連結中網址的起點（裸網址比對時略過）
+    for match in _MARKDOWN_LINK.finditer(text):
+        url = normalize_url(match.group(2))
+        linked.add(match.start(2))
+        add("url", url, match.group(1) or match.group(2))
+        add("domain", url_domain(url), url_domain(url))
+    for match in _BARE_URL.finditer(text):
+        if match.start() in linked:
+            continue
+        url = normalize_url(match.group(0))
+        add("url", url, match.group(0))
+        add("domain", url_domain(url), url_domain(url))
+    for match in _TITLE.finditer(text):
+        add("title", normalize_title(match.group(1) or match.group(2)), match.group(0))
+    return [(kind, key, display) for (kind, key), display in found.items()]
+
+
+class CitationIndex:
+    """
+    引用的 SQLite 倒排索引
+
+    files 表記錄已索引的檔案（大小與修改時間未變的檔案不重新解析）；
+    citations 表每列為一次引用 (種類, 鍵, 實驗, 輪次, Agent, 原文)，依 (種類, 鍵) 建索引。
+    實驗以 log 檔名（不含副檔名）區分，v1 / v2 同一秒開始的實驗也不會混在一起；
+    「第一次出現」依 experiment_id（時間戳記）與輪次排序。
+
+    Args:
+        path: SQLite 檔案路徑
+    """
+
+    def __init__(self, path=DEFAULT_DB):
+        self.path = path
+        self.conn = sqlite3.connect(path)
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS files (
+                path TEXT PRIMARY KEY,
+                run TEXT NOT NULL,
+                experiment_id TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                mtime REAL NOT NULL,
+                turns INTEGER NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS citations (
+                kind TEXT NOT NULL,
+                key TEXT NOT NULL,
+                run TEXT NOT NULL,
+                experiment_id TEXT NOT NULL,
+                round INTEGER NOT NULL,
+                agent TEXT NOT NULL,
+                display TEXT NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS idx_citation_key ON citations (kind, key);
+            CREATE INDEX IF NOT EXISTS idx_citation_run ON citations (run);
+        """)
+        self.conn.commit()
+
+    def add_file(self, path):
+        """
+        索引一份對話紀錄（串流讀取），回傳新增的引用數；內容未變動時回傳 None
+
+        重新索引同一份檔案時先刪除它先前的引用。
+        """
+        stat = os.stat(path)
+        row = self.conn.execute("SELECT size, mtime FROM files WHERE path = ?", (path,)).fetchone()
+        if row and row[0] == stat.st_size and row[1] == stat.st_mtime:
+            return None
+        run = os.path.splitext(os.path.basename(path))[0]
+        experiment_id = experiment_id_from_filename(path)
+        self.conn.execute("DELETE FROM citations WHERE run = ?", (run,))
+        rows = []
+        turns = 0
+        for turn in iter_turns(path):
+            turns += 1
+            rows.extend((kind, key, run, experiment_id, turn["round"], turn["agent"], display)
+                        for kind, key, display in extract_citations(turn["text"]))
+        self.conn.executemany("INSERT INTO citations VALUES (?, ?, ?, ?, ?, ?, ?)", rows)
+        self.conn.execute("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?)",
+                          (path, run, experiment_id, stat.st_size, stat.st_mtime, turns))
+        self.conn.commit()
+        return len(rows)
+
+    def occurrences(self, kind, key):
+        """所有出現位置 (實驗, 輪次, Agent, 原文)，依時間順序"""
+        return self.conn.execute(
+            "SELECT run, round, agent, display FROM citations WHERE kind = ? AND key = ? "
+            "ORDER BY experiment_id, run, round", (kind, key)
+        ).fetchall()
+
+    def first_appearance(self, kind, key):
+        """第一次出現的 (實驗, 輪次, Agent, 原文)；沒有出現過時回傳 None"""
+        occurrences = self.occurrences(kind, key)
+        return occurrences[0] if occurrences else None
+
+    def runs_citing(self, kind, key):
+        """引用過的實驗：(實驗, 第一次出現的輪次, 該實驗中的引用次數)"""
+        return self.conn.execute(
+            "SELECT run, MIN(round), COUNT(*) FROM citations WHERE kind = ? AND key = ? "
+            "GROUP BY run ORDER BY MIN(experiment_id), run", (kind, key)
+        ).fetchall()
+
+    def matching_keys(self, kind, text):
+        """鍵中包含 text 的所有鍵（查詢時不必輸入完整網址或書名）"""
+        return [row[0] for row in self.conn.execute(
+            "SELECT DISTINCT key FROM citations WHERE kind = ? AND instr(key, ?) > 0 ORDER BY key", (kind, text)
+        )]
+
+    def recurring(self, kind="title", min_runs=2, limit=None):
+        """
+        在至少 min_runs 個實驗中出現的鍵
+
+        Returns:
+            list: (鍵, 實驗數, 出現次數, 第一次出現的實驗)，依實驗數由多到少
+        """
+        query = ("SELECT key, COUNT(DISTINCT run) AS runs, COUNT(*), MIN(experiment_id || ' ' || run) "
+                 "FROM citations WHERE kind = ? GROUP BY key HAVING runs >= ? ORDER BY runs DESC, COUNT(*) DESC, key")
+        if limit:
+            query += f" LIMIT {int(limit)}"
+        return [(key, runs, count, first.split(" ", 1)[1])
+                for key, runs, count, first in self.conn.execute(query, (kind, min_runs))]
+
+    def stats(self):
+        files, turns = self.conn.execute("SELECT COUNT(*), COALESCE(SUM(turns), 0) FROM files").fetchone()
+        keys = dict(self.conn.execute("SELECT kind, COUNT(DISTINCT key) FROM citations GROUP BY kind").fetchall())
+        return {"files": files, "turns": turns, **{kind: keys.get(kind, 0) for kind in KINDS}}
+
+    def close(self):
+        self.conn.close()
+
+
+def print_sources(index, kind, text):
+    """印出符合 text 的每個鍵：第一次出現與引用過的實驗"""
+    keys = index.matching_keys(kind, normalize_title(text) if kind == "title" else text)
+    if not keys:
+        print(f"🔍 沒有符合「{text}」的{KIND_NAMES[kind]}")
+        return
+    for key in keys:
+        runs = index.runs_citing(kind, key)
+        run, round_num, agent, display = index.first_appearance(kind, key)
+        print(f"\n### {KIND_NAMES[kind]}: {key}")
+        print(f"- 第一次出現: `{run}` Round {round_num}（{agent}）{display}")
+        print(f"- 引用的實驗數: {len(runs)}，共 {sum(count for _, _, count in runs)} 次")
+        print("\n| 實驗 | 第一次出現的輪次 | 次數 |")
+        print("|------|------------------|------|")
+        for run, first_round, count in runs:
+            print(f"| {run} | {first_round} | {count} |")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="建立與查詢對話紀錄的引用索引（網址 / 網域 / 書名）")
+    parser.add_argument("paths", nargs="*", help="要加入索引的 log 檔、萬用字元或目錄")
+    parser.add_argument("--db", default=DEFAULT_DB, help="索引的 SQLite 檔案路徑")
+    parser.add_argument("--source", help="查詢網址或網域（部分字串即可）")
+    parser.add_argument("--title", help="查詢書名 / 期刊名（部分字串即可）")
+    parser.add_argument("--recurring", action="store_true", help="列出在多個實驗中重複出現的書名與網域")
+    parser.add_argument("--min-runs", type=int, default=2, help="--recurring 的最少實驗數")
+    parser.add_argument("--top", type=int, default=20, help="--recurring 每類列出的數量")
+    args = parser.parse_args()
+    if not (args.paths or args.source or args.title or args.recurring):
+        parser.error("請指定要索引的 log，或 --source / --title / --recurring 查詢")
+
+    index = CitationIndex(args.db)
+    try:
+        if args.paths:
+            started = time.perf_counter()
+            paths = find_logs(args.paths)
+            added = [index.add_file(path) for path in paths]
+            updated = [count for count in added if count is not None]
+            print(f"📚 索引 {len(paths)} 份 log：更新 {len(updated)} 份（新增 {sum(updated)} 筆引用），"
+                  f"未變動 {len(added) - len(updated)} 份，耗時 {time.perf_counter() - started:.2f} 秒")
+            stats = index.stats()
+            print(f"   共 {stats['files']} 份 log、{stats['turns']} 輪；"
+                  + "、".join(f"{KIND_NAMES[kind]} {stats[kind]} 個" for kind in KINDS))
+        if args.source:
+            source = normalize_url(args.source) if "://" in args.source else args.source.lower().removeprefix("www.")
+            print_sources(index, "url" if "/" in source else "domain", source)
+        if args.title:
+            print_sources(index, "title", args.title)
+        if args.recurring:
+            for kind in ("title", "domain"):
+                rows = index.recurring(kind, args.min_runs, args.top)
+                print(f"\n### 🔁 在 ≥ {args.min_runs} 個實驗中出現的{KIND_NAMES[kind]}（{len(rows)} 個）\n")
+                if not rows:
+                    continue
+                print(f"| {KIND_NAMES[kind]} | 實驗數 | 次數 | 第一次出現 |")
+                print("|------|--------|------|------------|")
+                for key, runs, count, first in rows:
+                    print(f"| {key} | {runs} | {count} | {first} |")
+    finally:
+        index.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,229 @@
+"""
+數據主張傳播追蹤（不呼叫 API）
+抽出每輪發言中的量化主張（帶單位的數字、年份、百分比、安全係數），正規化後建立「主張 → 出現位置」索引，
+輸出每個主張的傳播鏈：第一次提出的 Agent、之後沿用的 Agent、是否有人質疑。
+取代報告中「搜尋第一次出現的具體數據」的人工閱讀，以及分析 prompt 中要 LLM 猜測的自我增強主張。
+每輪只掃描一次（對話長度的線性時間），多份對話紀錄以串流方式逐份處理。
+
+使用方法:
+    python claim_tracker.py experiment_log_*.jsonl
+    python claim_tracker.py logs/ --min-occurrences 3 --json claims.jsonl
+"""
+import argparse
+import json
+import re
+import time
+import unicodedata
+from collections import Counter
+
+from transcript import iter_turns
+
+MIN_OCCURRENCES = 2  # 至少出現幾次才輸出傳播鏈
+SENTENCE_CHARS = 80  # 傳播鏈中引述的句子長度上限
+LABEL_WINDOW = 8  # 數字前幾個字內出現 LABELS 的關鍵字時，主張以該關鍵字命名
+
+# 無單位的數字只有接在這些關鍵字後面才視為主張（例如「安全係數約為 1.5」）
+LABELS = ("安全係數", "折減係數", "摩擦角", "凝聚力", "降雨強度", "震度", "規模")
+# 單位 -> 正規化後的單位（依長度由長到短比對）
+UNITS = {
+    "平方公里": "km²", "平方公尺": "m²", "立方公尺": "m³", "公里": "km", "公尺": "m", "公分": "cm", "毫米": "mm",
+    "公頃": "ha", "公噸": "t", "萬元": "萬元", "億元": "億元", "元": "元", "個月": "個月", "年": "年", "天": "天",
+    "度": "度", "%": "%", "倍": "倍", "人": "人", "戶": "戶", "座": "座",
+    "km²": "km²", "m²": "m²", "m³": "m³", "km": "km", "cm": "cm", "mm": "mm", "ha": "ha", "m": "m",
+    "km2": "km²", "m2": "m²", "m3": "m³",  # NFKC 正規化後的上標
+}
+# 出現在主張前後 CHALLENGE_WINDOW 字內時，視為對該主張的質疑；以問號結尾的句子也算質疑。
+# 「證據」、「來源」、「根據」這類字常用來支持主張（「有證據顯示…」），不列入。
+CHALLENGE_WORDS = ("質疑", "有待查證", "不確定", "誇大", "錯誤", "不正確")
+CHALLENGE_WINDOW = 12
+
+_NUMBER = r"(?P<number>\d+(?:,\d{3})*(?:\.\d+)?)"
+_UNIT = "|".join(re.escape(unit) for unit in sorted(UNITS, key=len, reverse=True))
+# 單位後面不能緊接英文字母（「5 mg」、「3 months」不是公尺）
+_CLAIM = re.compile(rf"百分之\s*(?P<percent>\d+(?:\.\d+)?)|{_NUMBER}\s*(?P<unit>(?:{_UNIT})(?![A-Za-z]))?")
+_LABEL = re.compile("|".join(LABELS))
+_SENTENCE = re.compile(r"[^。！？!?\n]+[。！？!?]?")
+
+
+def normalize_number(text):
+    """去除千分位、多餘的小數零（"1,200.50" → "1200.5"）"""
+    value = text.replace(",", "")
+    if "." in value:
+        value = value.rstrip("0").rstrip(".")
+    return value
+
+
+def extract_claims(text):
+    """
+    抽出一輪發言中的量化主張（同一輪重複出現的只記第一次）
+
+    1800–2100 之間的整數接「年」視為年份（「1999 年」），其餘數字接「年」為期間（「30 年」）；
+    沒有單位的數字只有前 LABEL_WINDOW 字內出現 LABELS 關鍵字時才記錄（「安全係數 1.5」）。
+
+    Returns:
+        list: (正規化的主張, 所在句子, 是否被質疑（見 is_challenge）)
+    """
+    text = unicodedata.normalize("NFKC", text)
+    claims = {}
+    for sentence_match in _SENTENCE.finditer(text):
+        sentence = sentence_match.group(0)
+        for match in _CLAIM.finditer(sentence):
+            if match.group("percent"):
+                claim = f"{normalize_number(match.group('percent'))}%"
+            else:
+                start = match.start("number")
+                if start and sentence[start - 1].isascii() and (sentence[start - 1].isalnum() or sentence[start - 1] in "._-/"):
+                    continue  # 英數字串的一部分（例如型號、網址）
+                number = normalize_number(match.group("number"))
+                unit = UNITS.get(match.group("unit") or "")
+                labels = _LABEL.findall(sentence[max(0, start - LABEL_WINDOW):start])
+                if labels and unit is None:
+                    claim = f"{labels[-1]} {number}"
+                elif unit == "年" and number.isdigit() and 1800 <= int(number) <= 2100:
+                    claim = f"{number} 年（年份）"
+                elif unit:
+                    claim = f"{number}%" if unit == "%" else f"{number} {unit}"
+                else:
+                    continue
+            if claim not in claims:
+                claims[claim] = (claim, sentence.strip()[:SENTENCE_CHARS], is_challenge(sentence, *match.span()))
+    return list(claims.values())
+
+
+def is_challenge(sentence, start, end):
+    """
+    sentence[start:end] 的主張是否被質疑：句子以問號結尾，或前後 CHALLENGE_WINDOW 字內有 CHALLENGE_WORDS
+
+    >>> [challenged for _, _, challenged in extract_claims("有證據顯示安全係數 2.5 可行")]
+    [False]
+    >>> [challenged for _, _, challenged in extract_claims("根據水保局的來源，崩積層厚度約 30 公尺。")]
+    [False]
+    >>> [challenged for _, _, challenged in extract_claims("安全係數 2.5 這個數字有待查證。")]
+    [True]
+    >>> [challenged for _, _, challenged in extract_claims("安全係數真的是 2.5 嗎？")]
+    [True]
+    """
+    if sentence.rstrip().endswith("?"):  # NFKC 後全形問號已轉為半形
+        return True
+    nearby = sentence[max(0, start - CHALLENGE_WINDOW):end + CHALLENGE_WINDOW]
+    return any(word in nearby for word in CHALLENGE_WORDS)
+
+
+class ClaimTracker:
+    """
+    逐輪累加的主張索引（可在模擬迴圈中即時使用，也可對封存的對話紀錄批次處理）
+
+    每個主張記錄所有出現位置 (輪次, Agent, 句子, 是否為質疑)；第一次出現的句子即使帶問號也視為提出，不算質疑。
+    """
+
+    def __init__(self):
+        self.occurrences = {}  # 主張 -> [(輪次, Agent, 句子, 是否為質疑)]
+        self.turns = 0
+
+    def add_turn(self, round_num, agent, text):
+        self.turns += 1
+        for claim, sentence, challenged in extract_claims(text):
+            occurrences = self.occurrences.setdefault(claim, [])
+            occurrences.append((round_num, agent, sentence, bool(occurrences) and challenged))
+
+    def chains(self, min_occurrences=MIN_OCCURRENCES):
+        """
+        出現至少 min_occurrences 次的主張的傳播鏈，依出現次數由多到少
+
+        Returns:
+            list: {"claim", "introduced": {round, agent, sentence}, "adopters": [{round, agent}],
+                   "repeats": {Agent: 次數}（提出者自己重複）, "challenges": [{round, agent, sentence}], "rounds"}
+        """
+        chains = []
+        for claim, occurrences in self.occurrences.items():
+            if len(occurrences) < min_occurrences:
+                continue
+            first_round, introducer, first_sentence, _ = occurrences[0]
+            later = occurrences[1:]
+            chains.append({
+                "claim": claim,
+                "introduced": {"round": first_round, "agent": introducer, "sentence": first_sentence},
+                "adopters": [{"round": r, "agent": a} for r, a, _, challenged in later
+                             if a != introducer and not challenged],
+                "repeats": dict(Counter(a for _, a, _, challenged in later if a == introducer and not challenged)),
+                "challenges": [{"round": r, "agent": a, "sentence": s} for r, a, s, challenged in later if challenged],
+                "rounds": [r for r, _, _, _ in occurrences],
+            })
+        return sorted(chains, key=lambda chain: (-len(chain["rounds"]), chain["rounds"][0], chain["claim"]))
+
+
+def track_claims(turns, min_occurrences=MIN_OCCURRENCES):
+    """
+    對一份對話（每輪含 round、agent、text）建立傳播鏈
+
+    >>> chain, = track_claims([{"round": 1, "agent": "Engineer", "text": "安全係數約為 2.5。"},
+    ...                        {"round": 2, "agent": "Ecologist", "text": "有證據顯示安全係數 2.5 可行。"}])
+    >>> [adopter["agent"] for adopter in chain["adopters"]], chain["challenges"]
+    (['Ecologist'], [])
+    """
+    tracker = ClaimTracker()
+    for turn in turns:
+        tracker.add_turn(turn["round"], turn["agent"], turn["text"])
+    return tracker.chains(min_occurrences)
+
+
+def describe_chain(chain):
+    """傳播鏈的一行說明（例如「安全係數 1.5：Engineer 於 Round 1 提出 → Mediator R3、Ecologist R5 沿用；未被質疑」）"""
+    introduced = chain["introduced"]
+    parts = [f"{introduced['agent']} 於 Round {introduced['round']} 提出"]
+    if chain["adopters"]:
+        parts.append("→ " + "、".join(f"{a['agent']} R{a['round']}" for a in chain["adopters"]) + " 沿用")
+    if chain["repeats"]:
+        parts[-1] += "（" + "、".join(f"{agent} 自己重複 {count} 次" for agent, count in chain["repeats"].items()) + "）"
+    challenge = ("被質疑：" + "、".join(f"{c['agent']} R{c['round']}" for c in chain["challenges"])
+                 if chain["challenges"] else "未被質疑")
+    return f"{chain['claim']}：{' '.join(parts)}；{challenge}"
+
+
+def main():
+    # 與分析器相同的 log 搜尋規則（analyze_experiment 也匯入本模組，因此在這裡才匯入）
+    from analyze_experiment import find_logs
+
+    parser = argparse.ArgumentParser(description="追蹤對話中量化主張的提出、沿用與質疑")
+    parser.add_argument("paths", nargs="+", help="對話紀錄檔、萬用字元或目錄")
+    parser.add_argument("--min-occurrences", type=int, default=MIN_OCCURRENCES, help="至少出現幾次才列出")
+    parser.add_argument("--top", type=int, default=5, help="每份對話列出的傳播鏈數")
+    parser.add_argument("--json", help="把每份對話的傳播鏈寫成 JSONL")
+    args = parser.parse_args()
+
+    paths = find_logs(args.paths)
+    if not paths:
+        parser.error("找不到任何對話紀錄檔")
+
+    started = time.perf_counter()
+    output = open(args.json, "w", encoding="utf-8") if args.json else None
+    runs_per_claim = Counter()
+    unchallenged_adopted = 0
+    try:
+        for path in paths:
+            chains = track_claims(iter_turns(path), args.min_occurrences)
+            runs_per_claim.update(chain["claim"] for chain in chains)
+            adopted = [chain for chain in chains if chain["adopters"]]
+            unchallenged_adopted += sum(1 for chain in adopted if not chain["challenges"])
+            print(f"\n### {path}\n")
+            print(f"重複出現的主張 {len(chains)} 個，被其他 Agent 沿用 {len(adopted)} 個，"
+                  f"其中未被質疑 {sum(1 for chain in adopted if not chain['challenges'])} 個\n")
+            for chain in chains[:args.top]:
+                print(f"- {describe_chain(chain)}")
+            if output:
+                output.write(json.dumps({"file": path, "chains": chains}, ensure_ascii=False) + "\n")
+    finally:
+        if output:
+            output.close()
+
+    recurring = [(claim, runs) for claim, runs in runs_per_claim.most_common(args.top) if runs > 1]
+    if recurring:
+        print("\n### 🔁 在多份對話中重複出現的主張\n")
+        for claim, runs in recurring:
+            print(f"- {claim}：{runs} 份")
+    print(f"\n🔢 {len(paths)} 份對話，沿用後未被質疑的主張共 {unchallenged_adopted} 個，"
+          f"耗時 {time.perf_counter() - started:.2f} 秒")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,115 @@
+"""
+增量式 Context 建構器
+逐輪累加對話並記錄每輪 token 數，依 token 預算（而非輪數）挑選送出的對話視窗，
+避免每輪重新串接整份 history 造成的平方成長。
+"""
+from bisect import bisect_left
+
+from rate_limiter import estimate_tokens
+
+try:
+    import tiktoken
+except ImportError:  # 未安裝 tiktoken 時改用粗估
+    tiktoken = None
+
+TOKENIZER_ENCODING = "o200k_base"  # gpt-4o / gpt-4o-mini 的 tokenizer
+
+_encoding = None
+_encoding_loaded = False
+
+
+def _load_encoding():
+    """第一次計算時載入 tokenizer；無法使用時印出一次提示，改用粗估"""
+    global _encoding, _encoding_loaded
+    if _encoding_loaded:
+        return
+    _encoding_loaded = True
+    if tiktoken is None:
+        print("⚠️ 未安裝 tiktoken（pip install -r requirements.txt），context token 數改用粗估")
+        return
+    try:
+        _encoding = tiktoken.get_encoding(TOKENIZER_ENCODING)
+    except Exception as e:
+        # 編碼表需連網下載，離線時使用粗估
+        print(f"⚠️ 無法載入 tiktoken 編碼表 {TOKENIZER_ENCODING}（{type(e).__name__}），context token 數改用粗估")
+
+
+def token_counter():
+    """目前使用的 token 計數方式（寫入報告的 context 統計）"""
+    _load_encoding()
+    return f"tiktoken {TOKENIZER_ENCODING}" if _encoding is not None else "粗估（estimate_tokens）"
+
+
+def count_tokens(text):
+    """以本機 tokenizer 計算 token 數（無法載入 tiktoken 編碼表時改用粗估）"""
+    _load_encoding()
+    if _encoding is not None:
+        return len(_encoding.encode(text, disallowed_special=()))
+    return estimate_tokens(text)
+
+
+class ContextBuilder:
+    """
+    依 token 預算建構對話 context
+
+    第一行（討論主題）固定保留，其餘從最新一輪往前取，直到用完預算。
+    每輪只計算新加入那一行的 token 數；以前綴和二分搜尋找出視窗起點。
+
+    Args:
+        token_budget: 對話紀錄的 token 上限（None 表示送出完整 history）
+        lines: 已存在的 history（例如續跑時）
+    """
+
+    def __init__(self, token_budget=None, lines=()):
+        self.token_budget = token_budget
+        self.lines = []
+        self.token_counts = []
+        self.prefix_sums = [0]  # prefix_sums[i] = 前 i 行（含換行）的 token 總數
+        self.prompt_tokens_sent = 0
+        self.prompt_tokens_full = 0
+        self.last_sent_tokens = 0
+        for line in lines:
+            self.add(line)
+
+    def add(self, line):
+        """加入新的一輪（只計算這一行的 token 數）"""
+        tokens = count_tokens(line) + 1  # 含換行
+        self.lines.append(line)
+        self.token_counts.append(tokens)
+        self.prefix_sums.append(self.prefix_sums[-1] + tokens)
+
+    def window_start(self):
+        """回傳預算內最早可納入的行索引（第 0 行固定保留）"""
+        total = self.prefix_sums[-1]
+        if self.token_budget is None or total <= self.token_budget or len(self.lines) <= 1:
+            return 1
+        pinned = self.token_counts[0]
+        # 找最小的 start，使 prefix_sums[-1] - prefix_sums[start] <= token_budget - pinned
+        threshold = total - (self.token_budget - pinned)
+        start = bisect_left(self.prefix_sums, threshold, lo=1)
+        return min(max(start, 1), len(self.lines) - 1)  # 至少保留最新一輪
+
+    def build(self):
+        """組出本輪要送出的 context，並累計節省的 token 數"""
+        if not self.lines:
+            return ""
+        start = self.window_start()
+        window = self.lines[:1] + self.lines[start:]
+        self.record(self.token_counts[0] + self.prefix_sums[-1] - self.prefix_sums[start])
+        return "\n".join(window)
+
+    def record(self, sent_tokens):
+        """記錄本輪實際送出的 context token 數（以摘要記憶等其他方式組 context 時也要呼叫）"""
+        self.last_sent_tokens = sent_tokens
+        self.prompt_tokens_sent += sent_tokens
+        self.prompt_tokens_full += self.prefix_sums[-1]
+
+    def stats(self):
+        """回傳累計送出 / 完整 history / 節省的 context token 數與 token 計數方式"""
+        return {
+            "token_budget": self.token_budget,
+            "token_counter": token_counter(),
+            "prompt_tokens_sent": self.prompt_tokens_sent,
+            "prompt_tokens_full": self.prompt_tokens_full,
+            "prompt_tokens_saved": self.prompt_tokens_full - self.prompt_tokens_sent,
+        }
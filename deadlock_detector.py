@@ -0,0 +1,131 @@
+"""
+即時死鎖偵測（模擬迴圈中每輪更新，不呼叫 API）
+每輪發言加入後，以字元 n-gram TF-IDF（與 novelty_scorer 相同）計算本輪新穎度與同一 Agent 相鄰兩次發言的相似度；
+最近 window 輪的平均新穎度低於門檻（一直換句話說），或同一 Agent 相鄰發言的平均相似度達到門檻（原地打轉）時判定死鎖，
+依設定提前結束實驗（stop）或在下一輪的對話紀錄中加入擾動提示（perturb）。
+
+只與最近 lookback 輪比對，每輪的計算量固定；IDF 只來自這些輪次，
+因此新穎度與 novelty_scorer 對整份對話的事後評分接近但不完全相同。
+"""
+import numpy as np
+
+from novelty_scorer import DEADLOCK_WINDOW, NOVELTY_THRESHOLD, tfidf_matrix
+
+DEADLOCK_ACTIONS = ("stop", "perturb")
+SELF_SIMILARITY_THRESHOLD = 0.5  # 同一 Agent 相鄰兩次發言的平均相似度達此值視為原地打轉（None 表示不檢查）
+LOOKBACK_TURNS = 30  # 計算新穎度時回看的輪數
+MAX_PERTURBATIONS = 2  # perturb 模式最多擾動幾次，之後仍死鎖就提前結束
+# 與對話紀錄開頭的「System: 討論主題」相同身分，v1 / v2 共用（不冒用或虛構任何 Agent）
+PERTURBATION_PROMPT = ("System: 提醒：最近幾輪都在重複相同的論點。請不要再重述先前的立場，"
+                       "改為直接回應對方最新的一個具體論點，或提出一個尚未討論過的新證據、新方案或折衷條件。")
+
+
+class DeadlockDetector:
+    """
+    逐輪更新的死鎖偵測器
+
+    判定死鎖後重新累積 window 輪才會再次判定（擾動需要時間生效）；判定為 stop 之後不再判定。
+
+    Args:
+        action: "stop"（提前結束）或 "perturb"（加入擾動提示，超過 max_perturbations 次後提前結束）
+        threshold: 平均新穎度低於此值視為停滯
+        window: 計算平均值的輪數（預設兩個完整的發言循環）
+        self_similarity: 同一 Agent 相鄰兩次發言的平均相似度門檻（None 表示只看新穎度）
+        max_perturbations: perturb 模式的擾動次數上限
+        lookback: 計算新穎度時回看的輪數
+    """
+
+    def __init__(self, action="stop", threshold=NOVELTY_THRESHOLD, window=DEADLOCK_WINDOW,
+                 self_similarity=SELF_SIMILARITY_THRESHOLD, max_perturbations=MAX_PERTURBATIONS,
+                 lookback=LOOKBACK_TURNS):
+        if action not in DEADLOCK_ACTIONS:
+            raise ValueError(f"未知的死鎖處理方式: {action}")
+        self.action = action
+        self.threshold = threshold
+        self.window = window
+        self.self_similarity = self_similarity
+        self.max_perturbations = max_perturbations
+        self.lookback = lookback
+        self.recent = []  # 最近 lookback 輪的 (Agent, 文字)
+        self.novelty = []  # 每輪新穎度
+        self.self_similarities = []  # 每輪與同一 Agent 上一次發言的相似度（回看範圍內沒有時為 None）
+        self.armed_from = 0  # 從第幾個發言（0 起算）開始累積判定視窗
+        self.perturbations = 0
+        self.stopped = False
+
+    @classmethod
+    def from_config(cls, config):
+        """由 new_run_state 的 deadlock 設定建立（config 為 None 時回傳 None）"""
+        if not config:
+            return None
+        return cls(**config)
+
+    def add(self, round_num, agent, text):
+        """
+        加入一輪發言；判定死鎖時回傳事件 dict，否則回傳 None
+
+        Returns:
+            dict: round、action（"perturb" / "stop"）、rolling_novelty、self_similarity、detail
+        """
+        texts = [t for _, t in self.recent] + [text]
+        matrix = tfidf_matrix(texts)
+        similarities = matrix[:-1] @ matrix[-1]
+        self.novelty.append(float(np.clip(1 - similarities.max(), 0, 1)) if similarities.size else 1.0)
+        previous = next((j for j in range(len(self.recent) - 1, -1, -1) if self.recent[j][0] == agent), None)
+        self.self_similarities.append(None if previous is None else float(similarities[previous]))
+        self.recent = (self.recent + [(agent, text)])[-self.lookback:]
+
+        if self.stopped or len(self.novelty) - self.armed_from < self.window:
+            return None
+        rolling_novelty = float(np.mean(self.novelty[-self.window:]))
+        paired = [s for s in self.self_similarities[-self.window:] if s is not None]
+        self_similarity = float(np.mean(paired)) if paired else None
+        looping = (self.self_similarity is not None and self_similarity is not None
+                   and self_similarity >= self.self_similarity)
+        if rolling_novelty >= self.threshold and not looping:
+            return None
+
+        self.armed_from = len(self.novelty)
+        if self.action == "perturb" and self.perturbations < self.max_perturbations:
+            self.perturbations += 1
+            action = "perturb"
+        else:
+            self.stopped = True
+            action = "stop"
+        detail = f"最近 {self.window} 輪平均新穎度 {rolling_novelty:.2f}（門檻 {self.threshold}）"
+        if self_similarity is not None:
+            detail += f"，同一 Agent 相鄰發言平均相似度 {self_similarity:.2f}"
+        detail += (f"；下一輪加入擾動提示（第 {self.perturbations} 次）" if action == "perturb"
+                   else f"；於 Round {round_num} 提前結束")
+        return {"round": round_num, "action": action, "rolling_novelty": round(rolling_novelty, 3),
+                "self_similarity": None if self_similarity is None else round(self_similarity, 3), "detail": detail}
+
+
+def deadlock_stop_round(statistics):
+    """因死鎖提前結束的輪次（沒有提前結束時回傳 None）"""
+    return next((round_num for round_num, action, _ in statistics.get("deadlock_events", []) if action == "stop"), None)
+
+
+def with_perturbation(conversation_history):
+    """在對話紀錄後加上擾動提示（只影響送出的這一輪，不寫入 history）"""
+    return f"{conversation_history}\n{PERTURBATION_PROMPT}"
+
+
+def record_deadlock(state, event):
+    """
+    把一輪發言（turn 事件）加入實驗的死鎖偵測器；由 record_turn 呼叫，續跑重建狀態時會重播相同的判定
+
+    判定死鎖時寫入 statistics["deadlock_events"]（輪次, "perturb" 或 "stop", 說明）並回傳事件；
+    擾動判定後 state["perturbation_due"] 為 True，直到有一輪帶著擾動提示送出（turn 事件的 perturbed）。
+    """
+    if event.get("perturbed"):
+        state["perturbation_due"] = False
+    detector = state["deadlock_detector"]
+    if detector is None:
+        return None
+    detection = detector.add(event["round"], event["agent"], event["response"])
+    if detection:
+        state["statistics"]["deadlock_events"].append((detection["round"], detection["action"], detection["detail"]))
+        if detection["action"] == "perturb":
+            state["perturbation_due"] = True
+    return detection
@@ -0,0 +1,149 @@
+"""
+實驗事件紀錄（append-only JSONL）
+每輪完成就寫入一筆事件並 fsync，程式中途當掉也不會遺失已付費的輪次；
+續跑時由事件重建記憶體中的實驗狀態，從下一輪接著進行，不重新呼叫 API。
+"""
+import hashlib
+import json
+import os
+import time
+
+EVENT_LOG_VERSION = 1
+# run_started 事件記錄的 new_run_state 參數（只有某一版本才有的設定，例如 v2 的 search_backend，以 run_config 略過）
+CONFIG_KEYS = ("experiment_id", "rounds", "seed", "context_budget", "summary_memory", "stream", "budget", "model",
+               "temperature", "topic", "personas", "turn_mode", "search_backend", "deadlock")
+
+
+def run_config(state):
+    """run_started 事件的 config：state 中有的 CONFIG_KEYS 欄位"""
+    return {key: state[key] for key in CONFIG_KEYS if key in state}
+
+
+def prompt_hash(*parts):
+    """prompt 內容的雜湊（用於比對續跑前後送出的 prompt 是否一致）"""
+    return hashlib.sha256("\n".join(str(part) for part in parts).encode("utf-8")).hexdigest()[:16]
+
+
+def usage_dict(usage):
+    """把 Chat Completions / Responses 的 usage 統一成 input/output/total tokens 與命中 prompt 快取的 cached tokens"""
+    if usage is None:
+        return None
+    input_tokens = getattr(usage, "input_tokens", None)
+    if input_tokens is None:
+        input_tokens = getattr(usage, "prompt_tokens", 0)
+    output_tokens = getattr(usage, "output_tokens", None)
+    if output_tokens is None:
+        output_tokens = getattr(usage, "completion_tokens", 0)
+    details = getattr(usage, "input_tokens_details", None) or getattr(usage, "prompt_tokens_details", None)
+    return {
+        "input_tokens": input_tokens,
+        "output_tokens": output_tokens,
+        "total_tokens": getattr(usage, "total_tokens", None) or input_tokens + output_tokens,
+        "cached_tokens": getattr(details, "cached_tokens", None) or 0,
+    }
+
+
+def prompt_cache_summary(records):
+    """
+    統計 prompt 快取命中率
+
+    Args:
+        records: [(輪次, Agent, input tokens, cached tokens), ...]
+
+    Returns:
+        dict: calls、hit_calls、input_tokens、cached_tokens、hit_rate（沒有紀錄時回傳 None）
+    """
+    if not records:
+        return None
+    input_tokens = sum(record[2] for record in records)
+    cached_tokens = sum(record[3] for record in records)
+    return {
+        "calls": len(records),
+        "hit_calls": sum(1 for record in records if record[3]),
+        "input_tokens": input_tokens,
+        "cached_tokens": cached_tokens,
+        "hit_rate": cached_tokens / input_tokens if input_tokens else 0.0,
+    }
+
+
+class EventLog:
+    """
+    append-only 的 JSONL 事件檔
+
+    每筆事件寫入後立即 flush + fsync。開啟既有檔案時，
+    若最後一行因當機只寫了一半，先截掉這一行再繼續追加。
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.is_new = not os.path.exists(path) or os.path.getsize(path) == 0
+        if not self.is_new:
+            _truncate_partial_line(path)
+        self._file = open(path, "a", encoding="utf-8")
+
+    def append(self, event_type, **fields):
+        event = {"type": event_type, "time": time.time(), **fields}
+        self._file.write(json.dumps(event, ensure_ascii=False) + "\n")
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        return event
+
+    def close(self):
+        if self._file:
+            self._file.close()
+            self._file = None
+
+
+def _truncate_partial_line(path):
+    with open(path, "rb+") as f:
+        data = f.read()
+        if data.endswith(b"\n"):
+            return
+        f.truncate(data.rfind(b"\n") + 1)
+
+
+def read_events(path):
+    """逐行讀出事件；當機造成的不完整最後一行略過"""
+    with open(path, encoding="utf-8") as f:
+        for line_number, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            try:
+                yield json.loads(line)
+            except json.JSONDecodeError:
+                if line.endswith("\n"):
+                    raise ValueError(f"{path} 第 {line_number} 行不是合法的 JSON")
+                return
+
+
+def restore_state(path, new_run_state, record_turn):
+    """
+    由事件紀錄重建實驗狀態
+
+    Args:
+        path: 事件檔路徑
+        new_run_state: 模擬器的 new_run_state（以 run_started 事件中的設定呼叫）
+        record_turn: 模擬器的 record_turn(state, event)，把一輪結果套用到狀態
+
+    Returns:
+        dict: 重建後的狀態；state["completed_rounds"] 為已完成的最後一輪
+    """
+    state = None
+    for event in read_events(path):
+        if event["type"] == "run_started":
+            state = new_run_state(**event["config"])
+        elif state is None:
+            raise ValueError(f"{path} 缺少 run_started 事件")
+        elif event["type"] == "turn":
+            record_turn(state, event)
+            state["completed_rounds"] = event["round"]
+        elif event["type"] == "turn_failed" and not event["fatal"]:
+            # 致命錯誤中斷的輪次不算完成，續跑時重新呼叫
+            state["statistics"]["failures"].append((event["round"], event["agent"], event["error"]))
+            state["completed_rounds"] = event["round"]
+        elif event["type"] == "budget":
+            # 用量上限事件（降級 / 停止）；停止的輪次未完成，續跑時重新呼叫
+            state["statistics"]["budget_events"].append((event["round"], event["action"], event["detail"]))
+    if state is None:
+        raise ValueError(f"{path} 沒有任何事件")
+    return state
@@ -0,0 +1,354 @@
+"""
+Multi-Agent 實驗批次執行器
+在同一個 process 內以 asyncio 同時執行多次獨立的對話實驗（replicates）
+
+使用方法:
+    python experiment_runner.py --version v1 --runs 50 --concurrency 8
+    python experiment_runner.py --version v2 --runs 20 --backend mock   # 離線模擬，不呼叫 API
+    python experiment_runner.py --version v1 --resume 20260101_120000_r001   # 由事件紀錄續跑中斷的實驗
+    python experiment_runner.py --version v1 --runs 50 --batch-export batch_round1.jsonl   # 第一輪改由批次處理
+    python experiment_runner.py --batch-import batch_round1_output.jsonl   # 匯入第一輪並續跑
+    python experiment_runner.py --version v2 --runs 50 --max-cost 0.05 --sweep-max-cost 2 --degrade-at 0.8   # 用量上限
+    python experiment_runner.py --version v1 --runs 50 --deadlock stop   # 對話死鎖時提前結束
+"""
+import argparse
+import asyncio
+import time
+from datetime import datetime
+
+import simulate_discussion
+import simulate_discussion_v2
+from batch_requests import batch_request, read_batch_results, write_batch_file
+from budget import Budget, BudgetExceeded, describe_usage
+from deadlock_detector import DEADLOCK_ACTIONS, deadlock_stop_round
+from event_log import EventLog, run_config
+from llm_session import create_session
+from response_cache import ResponseCache, print_cache_stats
+from retry_policy import RetryPolicy
+from search_tools import SEARCH_BACKENDS, create_search_tool, print_search_stats
+from turn_schedule import TURN_MODES, partner_rounds
+
+SIMULATORS = {
+    "v1": simulate_discussion,
+    "v2": simulate_discussion_v2,
+}
+
+
+def new_replicate_state(simulator, batch_id, run_index, rounds=None, context_budget=None, summary_memory=False,
+                        stream=False, budget=None, turn_mode="sequential", search_backend="web", deadlock=None):
+    """建立第 run_index 次 replicate 的狀態（experiment_id 為 {batch_id}_r001 這類格式，seed 為 run_index）"""
+    run_options = {"rounds": rounds} if rounds else {}
+    if context_budget:
+        run_options["context_budget"] = context_budget
+    if summary_memory:
+        run_options["summary_memory"] = True
+    if stream:
+        run_options["stream"] = True
+    if budget:
+        run_options["budget"] = budget
+    if turn_mode != "sequential":
+        run_options["turn_mode"] = turn_mode
+    if search_backend != "web":
+        run_options["search_backend"] = search_backend  # 只有 v2 有搜尋工具
+    if deadlock:
+        run_options["deadlock"] = deadlock
+    return simulator.new_run_state(f"{batch_id}_r{run_index:03d}", seed=run_index, **run_options)
+
+
+async def run_experiments(version, n_runs, concurrency=4, session=None, write_outputs=True, rounds=None,
+                          context_budget=None, summary_memory=False, stream=False, resume=None, budget=None,
+                          turn_mode="sequential", search_backend="web", deadlock=None):
+    """
+    同時執行 n_runs 次獨立實驗
+
+    每次實驗有自己的狀態（history / statistics / discussed_points），
+    只共用同一個 LLMSession（client 與 Rate Limiter）；同時進行中的實驗數量由 concurrency 限制。
+
+    Args:
+        version: "v1" 或 "v2"
+        n_runs: 實驗次數
+        concurrency: 同時執行的實驗數上限
+        session: 共用的 LLMSession（None 則以預設額度自動建立）
+        write_outputs: 是否為每次實驗寫出 log、報告與呼叫遙測（telemetry_*.csv / .json）
+        rounds: 每次實驗的輪數（None 則使用模組預設值）
+        context_budget: 每輪對話紀錄的 token 上限（None 則使用模組預設值）
+        summary_memory: 是否使用分層摘要記憶（長對話用）
+        stream: 是否以串流模式呼叫並為每次實驗寫出即時逐字稿
+        resume: 要續跑的 experiment_id 清單（由各自的事件紀錄重建狀態；指定時忽略 n_runs 與其他設定）
+        budget: 每次實驗的用量上限設定（Budget 的參數）；整批的上限由 session.budget 控制，
+                用完後尚未開始的實驗直接略過（以 BudgetExceeded 表示）
+        turn_mode: 發言順序（"sequential" / "simultaneous"，見 turn_schedule）
+        search_backend: v2 的搜尋方式（"web" / "local"；local 需要 session.search_tool，見 search_tools）
+        deadlock: 即時死鎖偵測設定（DeadlockDetector 的參數；None 表示不偵測，見 deadlock_detector）
+
+    Returns:
+        list: 每次實驗的最終狀態；失敗的實驗以 Exception 物件表示
+    """
+    simulator = SIMULATORS[version]
+    session = session or create_session(simulator.create_client())
+    semaphore = asyncio.Semaphore(concurrency)
+    batch_id = datetime.now().strftime("%Y%m%d_%H%M%S")
+
+    def create_state(run_index):
+        return new_replicate_state(simulator, batch_id, run_index, rounds, context_budget, summary_memory, stream,
+                                   budget, turn_mode, search_backend, deadlock)
+
+    async def run_one(make_state):
+        async with semaphore:
+            if session.budget:
+                session.budget.check()
+            state = make_state()
+            print(f"▶️  開始實驗 {state['experiment_id']}（從 Round {state['completed_rounds'] + 1}）")
+            await simulator.run_discussion(session, state, verbose=False)
+            if write_outputs:
+                simulator.write_experiment_log(state)
+                simulator.write_analysis_report(state)
+                session.telemetry.export(simulator.telemetry_prefix(state["experiment_id"]), state["experiment_id"])
+            print(f"✅ 完成實驗 {state['experiment_id']}")
+            return state
+
+    if resume:
+        makers = [lambda experiment_id=experiment_id: simulator.resume_run_state(experiment_id) for experiment_id in resume]
+    else:
+        makers = [lambda run_index=i + 1: create_state(run_index) for i in range(n_runs)]
+    return await asyncio.gather(
+        *(run_one(make_state) for make_state in makers),
+        return_exceptions=True
+    )
+
+
+def export_first_rounds(version, n_runs, path, rounds=None, context_budget=None, summary_memory=False, stream=False,
+                        budget=None, turn_mode="sequential", search_backend="web", deadlock=None):
+    """
+    建立 n_runs 次實驗，把各自的第一輪請求寫成 Batch API 請求檔
+
+    每次實驗先寫入 run_started 事件；結果匯入（import_first_rounds）後即可由事件紀錄接著續跑。
+    同時發言模式下與第一輪同組的輪次（Round 2 的 Ecologist）看到同一份空白快照，一併寫入請求檔，
+    續跑時從 Round 3 開始，與即時執行的同時發言實驗條件相同。
+
+    Returns:
+        list: 建立的 experiment_id
+    """
+    simulator = SIMULATORS[version]
+    batch_id = datetime.now().strftime("%Y%m%d_%H%M%S")
+    requests = []
+    for run_index in range(1, n_runs + 1):
+        state = new_replicate_state(simulator, batch_id, run_index, rounds, context_budget, summary_memory, stream,
+                                    budget, turn_mode, search_backend, deadlock)
+        event_log = EventLog(state["event_log"])
+        event_log.append("run_started", version=version, config=run_config(state))
+        event_log.close()
+        for round_index in first_group(state):
+            api, request, _ = simulator.first_turn_request(state, round_index)
+            requests.append(batch_request(f"{version}:{state['experiment_id']}:round{round_index + 1}", api, request))
+    write_batch_file(path, requests)
+    return list(dict.fromkeys(request["custom_id"].split(":")[1] for request in requests))
+
+
+def first_group(state):
+    """第一輪與同組（同時發言模式）的輪次索引"""
+    return [0, *partner_rounds(state["turn_mode"], 0, state["rounds"])]
+
+
+def import_first_rounds(*result_paths):
+    """
+    把批次結果寫入各實驗的事件紀錄（成為 Round 1 與同組輪次的 turn 事件）
+
+    同組中任一請求失敗時整組都不寫入，續跑時整組改為即時呼叫（同時發言的輪次不會被拆成依序發言）；
+    已有第一輪的實驗不重複寫入。
+
+    Returns:
+        dict: 版本 -> 可續跑的 experiment_id list
+    """
+    results = {}
+    for custom_id, result in read_batch_results(*result_paths).items():
+        version, experiment_id, part = custom_id.split(":")
+        if version in SIMULATORS and part.startswith("round"):
+            results.setdefault((version, experiment_id), {})[int(part[len("round"):]) - 1] = result
+    imported = {}
+    for (version, experiment_id), by_round in results.items():
+        if 0 not in by_round:
+            continue
+        simulator = SIMULATORS[version]
+        state = simulator.resume_run_state(experiment_id)
+        group = first_group(state)
+        errors = [f"Round {i + 1}: {by_round[i][1]}" if i in by_round else f"Round {i + 1}: 結果檔中沒有回應"
+                  for i in group if by_round.get(i, (None,))[0] is None]
+        if errors:
+            print(f"   ⚠️ {experiment_id} 第一輪批次請求失敗（{'；'.join(errors)}），續跑時改為即時呼叫")
+        elif state["completed_rounds"] == 0:
+            event_log = EventLog(state["event_log"])
+            for round_index in group:
+                _, _, turn = simulator.first_turn_request(state, round_index)
+                event_log.append("turn", **simulator.turn_from_response(turn, by_round[round_index][1]))
+            event_log.close()
+        imported.setdefault(version, []).append(experiment_id)
+    return imported
+
+
+async def resume_imported(imported, concurrency, session):
+    """
+    依版本依序續跑 import_first_rounds 匯入的實驗
+
+    所有版本在同一個事件迴圈中執行：session 的 client、Rate Limiter 的 asyncio.Lock 都綁定在第一次使用的事件迴圈，
+    不能跨多次 asyncio.run 共用。
+    """
+    results = []
+    for version, experiment_ids in imported.items():
+        results += await run_experiments(version, len(experiment_ids), concurrency, session=session,
+                                         resume=experiment_ids)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="同時執行多次 Multi-Agent 對話實驗")
+    parser.add_argument("--version", choices=sorted(SIMULATORS), default="v1", help="實驗版本")
+    parser.add_argument("--runs", type=int, default=1, help="實驗次數")
+    parser.add_argument("--concurrency", type=int, default=4, help="同時執行的實驗數上限")
+    parser.add_argument("--rounds", type=int, help="每次實驗的輪數（預設 20）")
+    parser.add_argument("--context-budget", type=int, help="每輪對話紀錄的 token 上限")
+    parser.add_argument("--summary-memory", action="store_true", help="以分層摘要記憶壓縮較早的輪次（長對話用）")
+    parser.add_argument("--stream", action="store_true", help="串流模式：回應邊產生邊寫入即時逐字稿，並記錄首字延遲")
+    parser.add_argument("--turn-mode", choices=TURN_MODES, default="sequential",
+                        help="發言順序：simultaneous 時每一循環中 Engineer 與 Ecologist 以同一份對話快照同時發言")
+    parser.add_argument("--deadlock", choices=DEADLOCK_ACTIONS,
+                        help="即時死鎖偵測：stop 提前結束；perturb 在下一輪加入擾動提示，仍死鎖才結束（預設不偵測）")
+    parser.add_argument("--deadlock-threshold", type=float, help="死鎖判定的平均新穎度門檻（預設 0.5）")
+    parser.add_argument("--deadlock-window", type=int, help="死鎖判定的視窗輪數（預設 6）")
+    parser.add_argument("--deadlock-self-similarity", type=float,
+                        help="同一 Agent 相鄰發言的平均相似度達此值也判定死鎖（預設 0.5）")
+    parser.add_argument("--resume", nargs="+", metavar="EXPERIMENT_ID", help="由事件紀錄續跑中斷的實驗")
+    parser.add_argument("--batch-export", metavar="FILE", help="不呼叫 API，把各次實驗的第一輪請求寫成 Batch API 請求檔")
+    parser.add_argument("--batch-import", nargs="+", metavar="RESULTS", help="匯入第一輪的 Batch API 結果檔後續跑")
+    parser.add_argument("--backend", default="openai", help="LLM 後端（openai / mock）")
+    parser.add_argument("--mock-latency", type=float, default=0.0, help="mock 後端的平均延遲秒數")
+    parser.add_argument("--mock-error-rate", type=float, default=0.0, help="mock 後端的錯誤率")
+    parser.add_argument("--rpm", type=int, help="每分鐘請求數上限（預設依模型額度）")
+    parser.add_argument("--tpm", type=int, help="每分鐘 token 數上限（預設依模型額度）")
+    parser.add_argument("--max-attempts", type=int, default=5, help="每次 API 呼叫最多嘗試次數")
+    parser.add_argument("--timeout", type=float, default=60.0, help="單次 API 呼叫逾時秒數")
+    parser.add_argument("--cache", help="回應快取 SQLite 檔案路徑（預設不快取）")
+    parser.add_argument("--cache-max-mb", type=int, default=200, help="回應快取容量上限（MB）")
+    parser.add_argument("--search", choices=SEARCH_BACKENDS, default="web",
+                        help="v2 的搜尋方式：web 使用 web_search；local 以搜尋快取與本機文件的 BM25 檢索回答")
+    parser.add_argument("--search-cache", help="搜尋快取 SQLite 檔案路徑（記錄 web_search 的查詢與引用，本機檢索時重用）")
+    parser.add_argument("--search-ttl", type=float, help="搜尋快取的有效時數（預設 168）")
+    parser.add_argument("--search-docs", help="本機檢索的文件目錄（.md / .txt）")
+    parser.add_argument("--prometheus", metavar="FILE", help="把所有呼叫的遙測寫成 Prometheus 文字格式")
+    parser.add_argument("--max-tokens", type=int, help="每次實驗的 token 上限（輸入 + 輸出）")
+    parser.add_argument("--max-cost", type=float, help="每次實驗的估計費用上限（美元）")
+    parser.add_argument("--max-wall-time", type=float, help="每次實驗的執行時間上限（秒）")
+    parser.add_argument("--sweep-max-tokens", type=int, help="整批實驗的 token 上限")
+    parser.add_argument("--sweep-max-cost", type=float, help="整批實驗的估計費用上限（美元）")
+    parser.add_argument("--sweep-max-wall-time", type=float, help="整批實驗的執行時間上限（秒）")
+    parser.add_argument("--degrade-at", type=float,
+                        help="用量達到上限的此比例時降級（縮短對話紀錄、v2 關閉 web_search），例如 0.8；預設只在超過上限時停止")
+    args = parser.parse_args()
+    if args.search == "local" and not (args.search_cache or args.search_docs):
+        parser.error("--search local 需要 --search-cache 或 --search-docs")
+    if args.search == "local" and args.version != "v2":
+        parser.error("--search local 只適用於 v2")
+    run_budget = {key: value for key, value in (("max_tokens", args.max_tokens), ("max_cost_usd", args.max_cost),
+                                                ("max_seconds", args.max_wall_time)) if value}
+    if run_budget and args.degrade_at:
+        run_budget["degrade_at"] = args.degrade_at
+    deadlock = None
+    if args.deadlock:
+        deadlock = {"action": args.deadlock, **{key: value for key, value in (
+            ("threshold", args.deadlock_threshold), ("window", args.deadlock_window),
+            ("self_similarity", args.deadlock_self_similarity)) if value is not None}}
+    sweep_budget = None
+    if args.sweep_max_tokens or args.sweep_max_cost or args.sweep_max_wall_time:
+        sweep_budget = Budget(args.sweep_max_tokens, args.sweep_max_cost, args.sweep_max_wall_time, args.degrade_at,
+                              name="整批")
+
+    if args.batch_export:
+        experiment_ids = export_first_rounds(args.version, args.runs, args.batch_export, args.rounds,
+                                             args.context_budget, args.summary_memory, args.stream, run_budget or None,
+                                             args.turn_mode, args.search, deadlock)
+        print(f"📦 已將 {len(experiment_ids)} 次實驗的第一輪請求寫入 {args.batch_export}"
+              f"（{experiment_ids[0]} ~ {experiment_ids[-1]}）")
+        print("   批次完成後執行: python experiment_runner.py --batch-import <結果檔>")
+        return
+    imported = {}
+    if args.batch_import:
+        imported = import_first_rounds(*args.batch_import)
+        for version, experiment_ids in imported.items():
+            print(f"📥 已匯入 {version} 共 {len(experiment_ids)} 次實驗的第一輪")
+
+    print("=" * 60)
+    if imported:
+        print(f"🔬 續跑匯入的實驗：{sum(len(ids) for ids in imported.values())} 次（同時 {args.concurrency} 個）")
+    else:
+        print(f"🔬 批次實驗：{args.version} × {args.runs} 次（同時 {args.concurrency} 個）")
+    print("=" * 60)
+
+    started = time.perf_counter()
+    simulator = SIMULATORS[args.version]
+    backend_options = {}
+    if args.backend == "mock":
+        backend_options = {"latency": args.mock_latency, "latency_sigma": 0.3, "error_rate": args.mock_error_rate}
+    session = create_session(
+        simulator.create_client(args.backend, **backend_options),
+        rate_limited=args.backend != "mock" or bool(args.rpm or args.tpm),
+        requests_per_minute=args.rpm,
+        tokens_per_minute=args.tpm,
+        retry_policy=RetryPolicy(max_attempts=args.max_attempts, timeout=args.timeout),
+        cache=ResponseCache(args.cache, max_bytes=args.cache_max_mb * 1024 * 1024) if args.cache else None,
+        budget=sweep_budget,
+        search_tool=create_search_tool(args.search_cache, args.search_docs, args.search_ttl)
+    )
+    if imported:
+        # 匯入的實驗由事件紀錄續跑（第一輪不再呼叫 API）
+        results = asyncio.run(resume_imported(imported, args.concurrency, session))
+    else:
+        results = asyncio.run(run_experiments(
+            args.version,
+            args.runs,
+            args.concurrency,
+            session=session,
+            rounds=args.rounds,
+            context_budget=args.context_budget,
+            summary_memory=args.summary_memory,
+            stream=args.stream,
+            resume=args.resume,
+            budget=run_budget or None,
+            turn_mode=args.turn_mode,
+            search_backend=args.search,
+            deadlock=deadlock
+        ))
+    elapsed = time.perf_counter() - started
+
+    skipped = [r for r in results if isinstance(r, BudgetExceeded)]
+    failures = [r for r in results if isinstance(r, Exception) and not isinstance(r, BudgetExceeded)]
+    print("\n" + "=" * 60)
+    print(f"✅ 完成 {len(results) - len(failures) - len(skipped)}/{len(results)} 次實驗，耗時 {elapsed:.1f} 秒")
+    if skipped:
+        print(f"   💰 {len(skipped)} 次實驗未開始：{skipped[0]}")
+    for error in failures:
+        print(f"   ⚠️ 實驗失敗: {error}")
+    stop_rounds = [deadlock_stop_round(r["statistics"]) for r in results if not isinstance(r, Exception)]
+    stop_rounds = [round_num for round_num in stop_rounds if round_num is not None]
+    if stop_rounds:
+        print(f"🧟 {len(stop_rounds)} 次實驗因死鎖提前結束（平均於 Round {sum(stop_rounds) / len(stop_rounds):.1f}）")
+    telemetry = session.telemetry.summary()
+    if telemetry["calls"]:
+        latency = telemetry["latency"]
+        print(f"📈 API 呼叫 {telemetry['calls']} 次（重試 {telemetry['retries']}、失敗 {telemetry['failed']}），"
+              f"估計費用 ${telemetry['cost_usd']:.4f}"
+              + (f"，延遲 p50 / p95 / p99 {latency['p50']:.2f} / {latency['p95']:.2f} / {latency['p99']:.2f} 秒"
+                 if latency["p50"] is not None else ""))
+    if session.budget:
+        print(f"💰 整批用量：{describe_usage(session.budget.usage())}")
+    if args.prometheus:
+        session.telemetry.write_prometheus(args.prometheus)
+        print(f"📈 Prometheus 指標已寫入 {args.prometheus}")
+    if session.cache:
+        print_cache_stats(session.cache)
+    if session.search_tool:
+        print_search_stats(session.search_tool)
+    print("=" * 60)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,115 @@
+"""
+即時逐字稿
+串流模式下，每個文字片段一到達就寫入檔案（並可同步輸出到終端機），
+同時記錄每輪的首字延遲（time-to-first-token）與總延遲。
+"""
+import sys
+import time
+
+
+class LiveTranscript:
+    """
+    邊產生邊寫出的逐字稿
+
+    Args:
+        path: 逐字稿檔案路徑（None 則不寫檔）
+        echo: 是否把文字片段同步輸出到終端機
+    """
+
+    def __init__(self, path=None, echo=False):
+        self.path = path
+        self.echo = echo
+        self._file = open(path, "a", encoding="utf-8") if path else None
+        self._started_at = None
+        self._first_token_at = None
+        self._turn_text = ""  # 本輪已寫出的回應文字
+
+    def write(self, text):
+        if self._file:
+            self._file.write(text)
+            self._file.flush()
+
+    def start_turn(self, round_num, agent_name):
+        """開始新的一輪：寫出標題並開始計時"""
+        self.write(f"### Round {round_num} - {agent_name}\n\n")
+        if self.echo:
+            print(f"💬 {agent_name}: ", end="", flush=True)
+        self._started_at = time.perf_counter()
+        self._first_token_at = None
+        self._turn_text = ""
+
+    def on_delta(self, delta):
+        """串流文字片段的回呼"""
+        if not delta:
+            return
+        if self._first_token_at is None:
+            self._first_token_at = time.perf_counter()
+        self._turn_text += delta
+        self.write(delta)
+        if self.echo:
+            sys.stdout.write(delta)
+            sys.stdout.flush()
+
+    def discard_partial(self, text):
+        """
+        作廢串流中途失敗的片段（LLMSession 重試前回呼）
+
+        從檔案尾端截掉這些片段；本輪沒有剩下的文字時，首字延遲改由重試的第一個片段重新計算。
+        終端機上已輸出的文字無法收回，只註記重試。
+        """
+        if not text or not self._turn_text.endswith(text):
+            return
+        self._turn_text = self._turn_text[:-len(text)]
+        if self._file:
+            self._file.flush()
+            self._file.truncate(self._file.tell() - len(text.encode("utf-8")))
+            self._file.seek(0, 2)
+        if not self._turn_text:
+            self._first_token_at = None
+        if self.echo:
+            print("\n   ↻ 串流中斷，以上片段作廢，重新產生：", flush=True)
+
+    def end_turn(self):
+        """結束本輪，回傳 (首字延遲秒數, 總延遲秒數)"""
+        finished_at = time.perf_counter()
+        self.write("\n\n")
+        first_token_at = self._first_token_at or finished_at
+        return first_token_at - self._started_at, finished_at - self._started_at
+
+    def abort_turn(self, reason):
+        """本輪失敗（最後一次嘗試已輸出的片段保留，並註記失敗原因）"""
+        self.write(f"\n\n> ⚠️ 本輪失敗：{reason}\n\n")
+        if self.echo:
+            print(f"\n⚠️ 本輪失敗：{reason}")
+
+    def close(self):
+        if self._file:
+            self._file.close()
+            self._file = None
+
+
+def latency_summary(latencies):
+    """
+    彙整每輪延遲紀錄
+
+    Args:
+        latencies: [(round, agent, ttft, total), ...]
+
+    Returns:
+        dict 或 None（沒有紀錄時）
+    """
+    if not latencies:
+        return None
+    ttfts = sorted(entry[2] for entry in latencies)
+    totals = sorted(entry[3] for entry in latencies)
+    slowest = max(latencies, key=lambda entry: entry[3])
+    return {
+        "turns": len(latencies),
+        "avg_ttft": sum(ttfts) / len(ttfts),
+        "p50_ttft": ttfts[len(ttfts) // 2],
+        "avg_total": sum(totals) / len(totals),
+        "p50_total": totals[len(totals) // 2],
+        "slowest_round": slowest[0],
+        "slowest_agent": slowest[1],
+        "slowest_total": slowest[3],
+    }
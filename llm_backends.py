@@ -0,0 +1,42 @@
+"""
+LLM 後端註冊表
+後端為任何提供 chat.completions 與 responses 兩個 endpoint 的非同步 client，
+每個 endpoint 需支援 create(**request) 與 with_raw_response.create(**request)
+（後者回傳具有 parse() 與 headers 的物件），與 AsyncOpenAI 介面相同。
+client 的 accepts_labels 為 True 時，LLMSession 另以 labels= 傳入呼叫標籤（experiment_id、seed 等）。
+"""
+import os
+
+from openai import AsyncOpenAI
+
+from mock_llm import MockLLMClient
+
+
+def create_openai_client(**options):
+    """建立 OpenAI 非同步 client"""
+    # 重試由 LLMSession 的 RetryPolicy 統一處理，關閉 SDK 內建重試
+    return AsyncOpenAI(api_key=os.getenv('OPENAI_API_KEY'), max_retries=0, **options)
+
+
+BACKENDS = {
+    "openai": create_openai_client,
+    "mock": MockLLMClient,
+}
+
+
+def register_backend(name, factory):
+    """註冊新的後端（factory(**options) 回傳 client）"""
+    BACKENDS[name] = factory
+
+
+def create_client(backend="openai", **options):
+    """
+    依名稱建立後端 client
+
+    Args:
+        backend: 後端名稱（"openai"、"mock" 或以 register_backend 註冊的名稱）
+        options: 傳給後端 factory 的參數
+    """
+    if backend not in BACKENDS:
+        raise ValueError(f"未知的 LLM 後端: {backend}（可用: {', '.join(sorted(BACKENDS))}）")
+    return BACKENDS[backend](**options)
@@ -0,0 +1,251 @@
+"""
+LLM 呼叫工作階段
+所有實驗的 call_llm 都經由 LLMSession 送出請求，集中處理快取、限流、重試、遙測等跨實驗共用的邏輯。
+"""
+import json
+import time
+
+from openai.types.chat import ChatCompletion
+
+from budget import BudgetExceeded
+from rate_limiter import RateLimiter, estimate_tokens
+from retry_policy import LLMCallFailed, RetryPolicy
+from telemetry import Telemetry, call_cost
+
+# 未指定輸出上限時，為回應預留的 token 數
+DEFAULT_OUTPUT_TOKENS = 500
+
+
+def request_output_limit(request):
+    """請求的輸出 token 上限（未指定時為 DEFAULT_OUTPUT_TOKENS）"""
+    return request.get("max_tokens") or request.get("max_output_tokens") or DEFAULT_OUTPUT_TOKENS
+
+
+def estimate_request_tokens(request):
+    """估計一次請求（輸入 + 輸出上限）會用掉的 token 數"""
+    prompt_text = request.get("instructions") or ""
+    if "messages" in request:
+        prompt_text += "".join(message["content"] for message in request["messages"])
+    elif isinstance(request.get("input"), str):
+        prompt_text += request["input"]
+    elif request.get("input"):
+        # 以 list 送出的 input（例如帶 function_call 結果的後續請求）
+        prompt_text += json.dumps(request["input"], ensure_ascii=False)
+    return estimate_tokens(prompt_text) + request_output_limit(request)
+
+
+def estimate_request_cost(request):
+    """最壞情況的費用估計：輸入全部未命中 prompt 快取、輸出用滿上限、每個 web_search 工具搜尋一次"""
+    output_tokens = request_output_limit(request)
+    web_searches = sum(1 for tool in request.get("tools") or [] if tool.get("type") == "web_search")
+    return call_cost(request.get("model"), estimate_request_tokens(request) - output_tokens, output_tokens, 0,
+                     web_searches)
+
+
+async def collect_chat_stream(stream, on_delta):
+    """讀取 Chat Completions 串流，逐段回呼 on_delta，最後組回完整的 ChatCompletion"""
+    parts = []
+    usage = None
+    finish_reason = None
+    last_chunk = None
+    async for chunk in stream:
+        last_chunk = chunk
+        if chunk.choices:
+            choice = chunk.choices[0]
+            if choice.delta and choice.delta.content:
+                parts.append(choice.delta.content)
+                on_delta(choice.delta.content)
+            finish_reason = choice.finish_reason or finish_reason
+        if getattr(chunk, "usage", None):
+            usage = chunk.usage
+    return ChatCompletion.construct(**{
+        "id": getattr(last_chunk, "id", "stream"),
+        "object": "chat.completion",
+        "created": getattr(last_chunk, "created", 0),
+        "model": getattr(last_chunk, "model", ""),
+        "choices": [{
+            "index": 0,
+            "finish_reason": finish_reason or "stop",
+            "message": {"role": "assistant", "content": "".join(parts)},
+        }],
+        "usage": usage.model_dump() if usage else None,
+    })
+
+
+async def collect_responses_stream(stream, on_delta):
+    """讀取 Responses API 串流事件，逐段回呼 on_delta，回傳 response.completed 事件中的完整 Response"""
+    final = None
+    async for event in stream:
+        if event.type == "response.output_text.delta":
+            on_delta(event.delta)
+        elif event.type == "response.completed":
+            final = event.response
+    if final is None:
+        raise RuntimeError("串流在 response.completed 之前結束")
+    return final
+
+
+STREAM_COLLECTORS = {
+    "chat": collect_chat_stream,
+    "responses": collect_responses_stream,
+}
+
+
+class LLMSession:
+    """
+    包裝 AsyncOpenAI client 的呼叫入口
+
+    Args:
+        client: AsyncOpenAI client
+        rate_limiter: 共用的 RateLimiter（None 則不限流）
+        retry_policy: RetryPolicy（None 則使用預設的退避重試設定）
+        cache: ResponseCache（None 則不快取）
+        telemetry: 呼叫紀錄收集器（None 則自動建立）
+        budget: 整批實驗共用的 Budget（None 則不限；單次實驗的 Budget 由 create() 的 budget 參數傳入）
+        search_tool: 搜尋快取與本機檢索（search_tools.SearchTool；None 則不記錄搜尋結果、不提供本機檢索）
+    """
+
+    def __init__(self, client, rate_limiter=None, retry_policy=None, cache=None, telemetry=None, budget=None,
+                 search_tool=None):
+        self.client = client
+        self.rate_limiter = rate_limiter
+        self.retry_policy = retry_policy or RetryPolicy()
+        self.cache = cache
+        self.telemetry = telemetry or Telemetry()
+        self.budget = budget
+        self.search_tool = search_tool
+
+    def budgets(self, budget=None):
+        """本次呼叫適用的 Budget：單次實驗的 budget 與整批共用的 self.budget"""
+        return [b for b in (budget, self.budget) if b is not None]
+
+    def _endpoint(self, api):
+        if api == "chat":
+            return self.client.chat.completions
+        if api == "responses":
+            return self.client.responses
+        raise ValueError(f"未知的 API 類型: {api}")
+
+    async def create(self, api, request, labels=None, on_delta=None, budget=None, on_discard=None):
+        """
+        送出一次請求並回傳解析後的 response
+
+        快取命中時直接回傳、不佔用額度；否則先向 Budget 預留最壞情況的估計用量，再經 Rate Limiter 送出，
+        可重試的錯誤（429、逾時、5xx）依 retry_policy 退避重試，每次重試都重新經過 Rate Limiter。
+        指定 on_delta 時以串流模式送出，文字片段一產生就回呼 on_delta，回傳值仍是完整的 response；
+        串流中途失敗而重試時，先以 on_discard(text) 告知失敗的嘗試已送出、應作廢的片段，重試的回應從頭重新回呼。
+
+        Args:
+            api: "chat"（Chat Completions）或 "responses"（Responses API）
+            request: 傳給 create() 的參數
+            labels: 呼叫標籤（experiment_id、seed、round、agent 等）；seed 為快取鍵的一部分
+            on_delta: 串流文字片段的回呼 on_delta(text)
+            on_discard: 重試前作廢已串流片段的回呼 on_discard(text)（None 則不通知）
+            budget: 單次實驗的 Budget（None 則只檢查整批共用的 self.budget）
+
+        Raises:
+            BudgetExceeded: 預留額度會超過上限（請求不會送出）
+            LLMCallFailed: 致命錯誤或重試額度用完
+        """
+        labels = labels or {}
+        seed = labels.get("seed")
+        started = time.perf_counter()
+        if self.cache:
+            cached = self.cache.get(api, request, seed)
+            if cached is not None:
+                self.telemetry.record(api, request, labels, started, 0, cached, cache_hit=True)
+                if on_delta:
+                    on_delta(response_text(api, cached))
+                return cached
+
+        estimated = estimate_request_tokens(request)
+        estimated_cost = estimate_request_cost(request)
+        reserved = []
+        try:
+            for b in self.budgets(budget):
+                b.reserve(estimated, estimated_cost)
+                reserved.append(b)
+        except BudgetExceeded:
+            for b in reserved:
+                b.settle(estimated, estimated_cost)
+            raise
+        endpoint = self._endpoint(api)
+        send_request = dict(request)
+        if getattr(self.client, "accepts_labels", False):
+            send_request["labels"] = labels  # 例如離線模擬後端以 labels 中的 seed 區分各 replicate
+        if on_delta:
+            send_request["stream"] = True
+            if api == "chat":
+                send_request["stream_options"] = {"include_usage": True}
+
+        attempts = 0
+        streamed = []  # 這次嘗試已回呼 on_delta 的片段（重試前作廢）
+
+        def forward_delta(delta):
+            streamed.append(delta)
+            on_delta(delta)
+
+        async def attempt():
+            nonlocal attempts
+            attempts += 1
+            streamed.clear()
+            try:
+                raw = await endpoint.with_raw_response.create(**send_request)
+            except Exception as e:
+                # 429 等錯誤回應也帶有 x-ratelimit-* headers
+                if self.rate_limiter:
+                    self.rate_limiter.update_from_headers(getattr(getattr(e, "response", None), "headers", None))
+                raise
+            response = raw.parse()
+            if on_delta:
+                response = await STREAM_COLLECTORS[api](response, forward_delta)
+            if self.rate_limiter:
+                self.rate_limiter.update_from_headers(raw.headers)
+                self.rate_limiter.record_usage(estimated, getattr(response, "usage", None))
+            return response
+
+        def on_retry(attempt_number, error, delay):
+            if streamed and on_discard:
+                on_discard("".join(streamed))
+            streamed.clear()
+            print(f"   ⚠️ API 呼叫失敗（第 {attempt_number} 次）: {str(error) or type(error).__name__}，{delay:.1f} 秒後重試")
+
+        try:
+            # 限流器的排隊時間不計入單次呼叫的 timeout
+            acquire = (lambda: self.rate_limiter.acquire(estimated)) if self.rate_limiter else None
+            response = await self.retry_policy.run(attempt, on_retry=on_retry, before_call=acquire)
+        except BaseException as e:
+            # 放棄（或被取消）的呼叫不計費，只釋放預留額度
+            for b in reserved:
+                b.settle(estimated, estimated_cost)
+            if isinstance(e, LLMCallFailed):
+                self.telemetry.record(api, request, labels, started, e.attempts, error=e)
+            raise
+        entry = self.telemetry.record(api, request, labels, started, attempts, response)
+        for b in reserved:
+            b.settle(estimated, estimated_cost, entry["input_tokens"] + entry["output_tokens"], entry["cost_usd"])
+        if self.cache:
+            self.cache.put(api, request, response, seed)
+        return response
+
+
+def response_text(api, response):
+    """取出 response 的回應文字"""
+    if api == "chat":
+        return response.choices[0].message.content or ""
+    return response.output_text
+
+
+def create_session(client, requests_per_minute=None, tokens_per_minute=None, retry_policy=None, cache=None,
+                   rate_limited=True, telemetry=None, budget=None, search_tool=None):
+    """建立附帶共用 RateLimiter 的 LLMSession（rate_limited=False 時不限流，例如離線模擬後端）"""
+    if not rate_limited:
+        return LLMSession(client, retry_policy=retry_policy, cache=cache, telemetry=telemetry, budget=budget,
+                          search_tool=search_tool)
+    limiter_options = {}
+    if requests_per_minute:
+        limiter_options["requests_per_minute"] = requests_per_minute
+    if tokens_per_minute:
+        limiter_options["tokens_per_minute"] = tokens_per_minute
+    return LLMSession(client, rate_limiter=RateLimiter(**limiter_options), retry_policy=retry_policy, cache=cache,
+                      telemetry=telemetry, budget=budget, search_tool=search_tool)
@@ -0,0 +1,169 @@
+"""
+關鍵字觀察指標引擎
+把所有規則的關鍵字編譯成單一正規表示式，每輪發言只掃描一次（允許關鍵字重疊），
+回傳各指標命中的關鍵字與位置。模擬器在迴圈中即時使用，也可批次重新計算已封存的對話紀錄。
+
+使用方法:
+    python metric_engine.py experiment_log_*.jsonl
+    python metric_engine.py --rules v2 --hits hits.jsonl experiment_v2_log_*.jsonl
+    python metric_engine.py --rules-file my_rules.json logs/*.jsonl
+"""
+import argparse
+import glob
+import json
+import re
+import time
+
+from transcript import iter_turns
+
+# 內建規則集：指標名稱 -> 關鍵字 list，或 {"keywords": [...], "agents": [...]}（只計算指定 Agent 的發言）
+RULE_SETS = {
+    "v1": {
+        "hallucination_markers": ["根據", "數據顯示", "研究指出", "1999年", "測量"],  # 可疑的「捏造事實」
+        "extreme_words": ["必須", "絕對", "完全", "徹底", "一定"],  # 極端化用語
+        "mediator_contradictions": {"keywords": ["折衷", "結合", "同時"], "agents": ["Mediator"]},  # 調停者的矛盾
+    },
+    "v2": {
+        "disagreements": ["但是", "然而", "不同意", "質疑", "問題是", "忽略了", "不認為", "擔心", "風險"],
+        "questions": ["？", "?"],
+    },
+}
+
+
+def register_rule_set(name, rules):
+    """註冊自訂規則集（格式同 RULE_SETS 的值）"""
+    RULE_SETS[name] = rules
+
+
+def load_rule_file(path):
+    """讀取 JSON 規則檔（格式同 RULE_SETS 的值）"""
+    with open(path, encoding="utf-8") as f:
+        return json.load(f)
+
+
+class MetricEngine:
+    """
+    多關鍵字指標引擎
+
+    所有指標的關鍵字合併為一個依長度排序的 alternation，以零寬度的 lookahead 在每個位置嘗試匹配，每輪只掃描一次；
+    同一個關鍵字可屬於多個指標。關鍵字可以重疊（「生態風險」與「風險」、「但是否」中的「但是」與「是否」都會命中），
+    與逐一以 keyword in text 判斷的結果相同：同一位置取最長的關鍵字，再補上它開頭的較短關鍵字。
+
+    Args:
+        rules: 指標名稱 -> 關鍵字 list 或 {"keywords": [...], "agents": [...]}
+    """
+
+    def __init__(self, rules):
+        self.categories = {}  # 指標名稱 -> 限定的 Agent 集合（None 表示不限）
+        self._keyword_categories = {}  # 關鍵字 -> 所屬指標 list
+        for category, rule in rules.items():
+            if isinstance(rule, dict):
+                keywords, agents = rule["keywords"], rule.get("agents")
+            else:
+                keywords, agents = rule, None
+            self.categories[category] = set(agents) if agents else None
+            for keyword in keywords:
+                self._keyword_categories.setdefault(keyword, []).append(category)
+        keywords = sorted(self._keyword_categories, key=len, reverse=True)
+        # 關鍵字 -> 同一位置也會命中的關鍵字（它本身與它開頭的較短關鍵字）
+        self._prefixes = {k: [p for p in keywords if k.startswith(p)] for k in keywords}
+        alternation = "|".join(re.escape(k) for k in keywords)
+        self._pattern = re.compile(f"(?=({alternation}))") if alternation else None
+
+    @classmethod
+    def from_rule_sets(cls, *names):
+        """合併一或多個已註冊的規則集"""
+        rules = {}
+        for name in names:
+            rules.update(RULE_SETS[name])
+        return cls(rules)
+
+    def scan(self, text, agent=None):
+        """
+        掃描一輪發言
+
+        Returns:
+            dict: 指標名稱 -> [(start, end, keyword), ...]（只包含有命中的指標）
+        """
+        hits = {}
+        if self._pattern is None:
+            return hits
+        for match in self._pattern.finditer(text):
+            start = match.start()
+            for keyword in self._prefixes[match.group(1)]:
+                for category in self._keyword_categories[keyword]:
+                    agents = self.categories[category]
+                    if agents is not None and agent not in agents:
+                        continue
+                    hits.setdefault(category, []).append((start, start + len(keyword), keyword))
+        return hits
+
+    def scan_turns(self, turns):
+        """逐輪掃描（turns 為含 round、agent、text 的 dict），產生 (turn, hits)"""
+        for turn in turns:
+            yield turn, self.scan(turn["text"], turn["agent"])
+
+
+def scan_files(engine, paths, on_hits=None):
+    """
+    批次掃描多個對話紀錄檔
+
+    Args:
+        engine: MetricEngine
+        paths: 檔案路徑（.jsonl、events_*.jsonl 或 markdown log）
+        on_hits: 每輪掃描後的回呼 on_hits(path, turn, hits)
+
+    Returns:
+        dict: 檔名 -> {"turns": 輪數, 指標名稱: 命中的輪數}
+    """
+    results = {}
+    for path in paths:
+        counts = {"turns": 0, **{category: 0 for category in engine.categories}}
+        for turn, hits in engine.scan_turns(iter_turns(path)):
+            counts["turns"] += 1
+            for category in hits:
+                counts[category] += 1
+            if on_hits:
+                on_hits(path, turn, hits)
+        results[path] = counts
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="以關鍵字指標引擎重新計算對話紀錄的觀察指標")
+    parser.add_argument("paths", nargs="+", help="對話紀錄檔（可用萬用字元）")
+    parser.add_argument("--rules", nargs="+", choices=sorted(RULE_SETS), default=sorted(RULE_SETS), help="使用的內建規則集")
+    parser.add_argument("--rules-file", help="自訂規則 JSON 檔（取代 --rules）")
+    parser.add_argument("--hits", help="把每輪的命中位置寫成 JSONL")
+    args = parser.parse_args()
+
+    engine = MetricEngine(load_rule_file(args.rules_file)) if args.rules_file else MetricEngine.from_rule_sets(*args.rules)
+    paths = [match for pattern in args.paths for match in sorted(glob.glob(pattern))]
+    if not paths:
+        parser.error("找不到任何對話紀錄檔")
+
+    hits_file = open(args.hits, "w", encoding="utf-8") if args.hits else None
+
+    def write_hits(path, turn, hits):
+        record = {"file": path, "round": turn["round"], "agent": turn["agent"], "hits": hits}
+        hits_file.write(json.dumps(record, ensure_ascii=False) + "\n")
+
+    started = time.perf_counter()
+    try:
+        results = scan_files(engine, paths, write_hits if hits_file else None)
+    finally:
+        if hits_file:
+            hits_file.close()
+    elapsed = time.perf_counter() - started
+
+    categories = list(engine.categories)
+    print("| 檔案 | 輪數 | " + " | ".join(categories) + " |")
+    print("|------|------|" + "|".join("------" for _ in categories) + "|")
+    for path, counts in results.items():
+        print(f"| {path} | {counts['turns']} | " + " | ".join(str(counts[c]) for c in categories) + " |")
+    total_turns = sum(counts["turns"] for counts in results.values())
+    print(f"\n📏 {len(results)} 個檔案、{total_turns} 輪，耗時 {elapsed:.2f} 秒")
+
+
+if __name__ == "__main__":
+    main()
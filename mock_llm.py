@@ -0,0 +1,363 @@
+"""
+離線模擬 LLM 後端
+與 AsyncOpenAI 相同的介面（chat.completions / responses，含 with_raw_response），
+不連網即可產生可重現的回應、假 usage、假 web_search_call 與 function call（亦支援 stream=True 串流），
+用於壓力測試與基準量測。
+"""
+import asyncio
+import hashlib
+import json
+import random
+import time
+
+import openai
+from openai.types.chat import ChatCompletion, ChatCompletionChunk
+from openai.types.responses import Response, ResponseCompletedEvent, ResponseTextDeltaEvent
+
+from rate_limiter import estimate_tokens
+
+# 合成回應的句子素材（刻意包含各項觀察指標會偵測的關鍵字）
+SYNTHETIC_SENTENCES = [
+    "根據過去的監測數據，草嶺崩塌地的安全係數約為 {number}。",
+    "研究指出，植生復育在 {number} 年內可顯著降低表土沖蝕。",
+    "我們必須優先考慮下游居民的安全。",
+    "硬體工程的維護成本絕對不能被忽略。",
+    "但是，這樣的做法是否忽略了長期的生態風險？",
+    "或許我們可以折衷一下，同時結合工程與生態工法。",
+    "1999 年集集地震後的測量顯示，崩積層的厚度約為 {number} 公尺。",
+    "然而，預力地錨的壽命與監測成本仍有待查證。",
+    "我不認為完全禁止開發是可行的方案。",
+    "排水系統可以有效降低坡體內的孔隙水壓。",
+    "自然演替需要時間，我們擔心這段期間的崩塌風險。",
+    "這個數據能否搜尋確認？",
+]
+
+SYNTHETIC_SOURCES = [
+    ("homepage.ntu.edu.tw", "https://homepage.ntu.edu.tw/~khyang/paper.pdf"),
+    ("www.swcb.gov.tw", "https://www.swcb.gov.tw/Home/Disaster"),
+    ("zh.wikipedia.org", "https://zh.wikipedia.org/wiki/草嶺"),
+]
+
+# function-call 搜尋工具的合成查詢
+SYNTHETIC_QUERIES = [
+    "草嶺崩塌地 安全係數",
+    "植生復育 表土沖蝕 年限",
+    "預力地錨 壽命 維護成本",
+    "集集地震 草嶺 崩積層厚度",
+    "邊坡排水 孔隙水壓",
+]
+
+# 錯誤類型的預設比例（在發生錯誤時依此抽樣）
+DEFAULT_ERROR_KINDS = {"rate_limit": 0.6, "server": 0.3, "timeout": 0.1}
+
+PROMPT_CACHE_MIN_TOKENS = 1024  # prompt 快取：前綴至少這麼長才會被快取（與 OpenAI 相同）
+PROMPT_CACHE_BLOCK_CHARS = 128  # prompt 快取：以固定長度的區塊比對前綴
+STREAM_CHUNK_CHARS = 8  # 串流時每個片段的字數
+TIME_TO_FIRST_TOKEN_RATIO = 0.3  # 串流時延遲中花在第一個片段之前的比例
+
+
+class _MockHTTPResponse:
+    """給 openai.APIStatusError 使用的最小 HTTP response 替身"""
+
+    def __init__(self, status_code):
+        self.status_code = status_code
+        self.headers = {"retry-after": "0"}
+        self.request = None
+
+
+class MockRawResponse:
+    """對應 with_raw_response 的回傳物件"""
+
+    def __init__(self, parsed, headers):
+        self._parsed = parsed
+        self.headers = headers
+
+    def parse(self):
+        return self._parsed
+
+
+class _Namespace:
+    def __init__(self, **attrs):
+        self.__dict__.update(attrs)
+
+
+class _MockEndpoint:
+    def __init__(self, client, api):
+        self._client = client
+        self._api = api
+        self.with_raw_response = _Namespace(create=self._create_raw)
+
+    async def create(self, labels=None, **request):
+        return (await self._create_raw(labels=labels, **request)).parse()
+
+    async def _create_raw(self, labels=None, **request):
+        return MockRawResponse(await self._client._respond(self._api, request, labels), dict(self._client.headers))
+
+
+def _prompt_text(request):
+    """依送出順序串接 prompt（instructions 在前），供 token 估計與 prompt 快取模擬使用"""
+    instructions = request.get("instructions") or ""
+    if "messages" in request:
+        return instructions + "\n".join(message["content"] for message in request["messages"])
+    if isinstance(request.get("input"), str):
+        return instructions + request["input"]
+    return instructions + json.dumps(request.get("input"), ensure_ascii=False)
+
+
+class MockLLMClient:
+    """
+    模擬的 AsyncOpenAI client
+
+    相同的 seed、呼叫標籤中的 seed（各次實驗 / replicate 的種子）與請求內容一定產生相同回應（與排程順序無關），
+    不同 replicate 送出相同的請求也會得到不同回應；錯誤依「同一請求的第幾次嘗試」決定，因此重試行為也可重現。
+
+    Args:
+        seed: 亂數種子
+        script: 預先寫好的回應（字串 list 依序循環使用，或 callable(request) -> str）
+        latency: 平均延遲秒數（0 表示不等待）
+        latency_sigma: 延遲的對數常態分佈形狀參數（0 表示固定延遲）
+        error_rate: 每次呼叫失敗的機率
+        error_kinds: 錯誤類型比例，例如 {"rate_limit": 0.6, "server": 0.3, "timeout": 0.1}
+        search_rate: Responses API 帶 web_search 工具時產生 web_search_call（帶 function 工具時產生 function call）的機率
+        headers: 每次回應附帶的 response headers（例如模擬 x-ratelimit-*）
+    """
+
+    def __init__(self, seed=0, script=None, latency=0.0, latency_sigma=0.0, error_rate=0.0,
+                 error_kinds=None, search_rate=0.3, headers=None):
+        self.seed = seed
+        self.script = script
+        self.latency = latency
+        self.latency_sigma = latency_sigma
+        self.error_rate = error_rate
+        self.error_kinds = error_kinds or DEFAULT_ERROR_KINDS
+        self.search_rate = search_rate
+        self.headers = headers or {}
+        self.call_count = 0
+        self.error_count = 0
+        self._attempts = {}
+        self._script_index = 0
+        self._prompt_prefixes = set()  # 已送出過的 prompt 前綴區塊雜湊（模擬服務端 prompt 快取）
+        self.accepts_labels = True  # LLMSession 會把呼叫標籤（labels=...）傳給 endpoint
+        self.chat = _Namespace(completions=_MockEndpoint(self, "chat"))
+        self.responses = _MockEndpoint(self, "responses")
+
+    def _rng(self, *parts):
+        digest = hashlib.sha256(json.dumps([self.seed, *parts], sort_keys=True, ensure_ascii=False).encode("utf-8"))
+        return random.Random(digest.hexdigest())
+
+    async def _respond(self, api, request, labels=None):
+        self.call_count += 1
+        stream = request.get("stream", False)
+        # 串流與否不影響回應內容
+        content_request = {k: v for k, v in request.items() if k not in ("stream", "stream_options")}
+        request_key = hashlib.sha256(
+            json.dumps([api, (labels or {}).get("seed"), content_request], sort_keys=True, ensure_ascii=False).encode("utf-8")
+        ).hexdigest()
+        attempt = self._attempts.get(request_key, 0) + 1
+        self._attempts[request_key] = attempt
+        rng = self._rng(request_key, attempt)
+
+        delay = 0.0
+        if self.latency > 0:
+            delay = self.latency
+            if self.latency_sigma > 0:
+                delay *= rng.lognormvariate(0, self.latency_sigma)
+        first_token_delay = delay * TIME_TO_FIRST_TOKEN_RATIO if stream else delay
+        if first_token_delay:
+            await asyncio.sleep(first_token_delay)
+
+        if self.error_rate and rng.random() < self.error_rate:
+            self.error_count += 1
+            self._raise_error(rng)
+
+        content_rng = self._rng(request_key)
+        prompt_text = _prompt_text(request)
+        text = self._reply_text(request, content_rng)
+        if api == "chat":
+            response = self._chat_completion(request, prompt_text, text)
+        else:
+            response = self._response(request, prompt_text, text, content_rng)
+        if not stream:
+            return response
+        return self._stream(api, response, text, delay - first_token_delay)
+
+    async def _stream(self, api, response, text, remaining_delay):
+        """把完整回應切成片段，模擬串流事件"""
+        pieces = [text[i:i + STREAM_CHUNK_CHARS] for i in range(0, len(text), STREAM_CHUNK_CHARS)] or [""]
+        piece_delay = remaining_delay / len(pieces)
+        for index, piece in enumerate(pieces):
+            if index and piece_delay:
+                await asyncio.sleep(piece_delay)
+            if api == "chat":
+                yield ChatCompletionChunk.construct(**{
+                    "id": response.id,
+                    "object": "chat.completion.chunk",
+                    "created": response.created,
+                    "model": response.model,
+                    "choices": [{"index": 0, "delta": {"content": piece}, "finish_reason": None}],
+                })
+            else:
+                yield ResponseTextDeltaEvent.construct(**{
+                    "type": "response.output_text.delta",
+                    "delta": piece,
+                    "item_id": response.output[-1].id,
+                    "output_index": len(response.output) - 1,
+                    "content_index": 0,
+                    "sequence_number": index,
+                    "logprobs": [],
+                })
+        if api == "chat":
+            yield ChatCompletionChunk.construct(**{
+                "id": response.id,
+                "object": "chat.completion.chunk",
+                "created": response.created,
+                "model": response.model,
+                "choices": [],
+                "usage": response.usage.model_dump(),
+            })
+        else:
+            yield ResponseCompletedEvent.construct(
+                type="response.completed",
+                response=response,
+                sequence_number=len(pieces),
+            )
+
+    def _cached_tokens(self, api, request, prompt_text):
+        """
+        模擬服務端 prompt 快取：與先前請求相同的最長前綴（以區塊為單位）視為命中
+
+        前綴包含 API、模型與 tools；未達 PROMPT_CACHE_MIN_TOKENS 時不快取。
+        """
+        digest = hashlib.sha256(json.dumps([api, request.get("model"), request.get("tools")]).encode("utf-8"))
+        cached_chars = 0
+        for start in range(0, len(prompt_text) - PROMPT_CACHE_BLOCK_CHARS + 1, PROMPT_CACHE_BLOCK_CHARS):
+            digest.update(prompt_text[start:start + PROMPT_CACHE_BLOCK_CHARS].encode("utf-8"))
+            key = digest.hexdigest()
+            if key in self._prompt_prefixes:
+                cached_chars = start + PROMPT_CACHE_BLOCK_CHARS
+            else:
+                self._prompt_prefixes.add(key)
+        cached_tokens = estimate_tokens(prompt_text[:cached_chars]) if cached_chars else 0
+        return cached_tokens if cached_tokens >= PROMPT_CACHE_MIN_TOKENS else 0
+
+    def _raise_error(self, rng):
+        kinds = list(self.error_kinds)
+        kind = rng.choices(kinds, weights=[self.error_kinds[k] for k in kinds])[0]
+        if kind == "rate_limit":
+            raise openai.RateLimitError("mock rate limit", response=_MockHTTPResponse(429), body=None)
+        if kind == "server":
+            raise openai.InternalServerError("mock server error", response=_MockHTTPResponse(500), body=None)
+        raise openai.APITimeoutError(request=None)
+
+    def _reply_text(self, request, rng):
+        if callable(self.script):
+            return self.script(request)
+        if self.script:
+            text = self.script[self._script_index % len(self.script)]
+            self._script_index += 1
+            return text
+        sentences = rng.sample(SYNTHETIC_SENTENCES, k=rng.randint(3, 5))
+        text = "".join(s.format(number=round(rng.uniform(1.2, 80), 1)) for s in sentences)
+        if (request.get("response_format") or {}).get("type") == "json_object":
+            # 要求 JSON 輸出時（例如分析請求）把合成文字包成 JSON 物件
+            return json.dumps({"text": text}, ensure_ascii=False)
+        return text
+
+    def _chat_completion(self, request, prompt_text, text):
+        prompt_tokens = estimate_tokens(prompt_text)
+        completion_tokens = estimate_tokens(text)
+        cached_tokens = self._cached_tokens("chat", request, prompt_text)
+        return ChatCompletion.construct(**{
+            "id": f"chatcmpl-mock-{self.call_count}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": request.get("model", "mock"),
+            "choices": [{
+                "index": 0,
+                "finish_reason": "stop",
+                "message": {"role": "assistant", "content": text},
+            }],
+            "usage": {
+                "prompt_tokens": prompt_tokens,
+                "completion_tokens": completion_tokens,
+                "total_tokens": prompt_tokens + completion_tokens,
+                "prompt_tokens_details": {"cached_tokens": cached_tokens},
+            },
+        })
+
+    def _response(self, request, prompt_text, text, rng):
+        output = []
+        annotations = []
+        tools = request.get("tools") or []
+        uses_search = any(tool.get("type") == "web_search" for tool in tools)
+        function_tools = [tool for tool in tools if tool.get("type") == "function"]
+        tool_outputs = [item for item in request.get("input") if item.get("type") == "function_call_output"] \
+            if isinstance(request.get("input"), list) else []
+        if function_tools and not tool_outputs and request.get("tool_choice") != "none" and rng.random() < self.search_rate:
+            # 先呼叫工具、不回應文字；call_id 由請求內容決定，後續請求因此也可重現
+            call_id = "call-mock-" + hashlib.sha256(prompt_text.encode("utf-8")).hexdigest()[:12]
+            output.append({
+                "type": "function_call",
+                "id": f"fc-mock-{self.call_count}",
+                "call_id": call_id,
+                "name": function_tools[0]["name"],
+                "arguments": json.dumps({"query": rng.choice(SYNTHETIC_QUERIES)}, ensure_ascii=False),
+                "status": "completed",
+            })
+            return self._response_object(request, prompt_text, "", output)
+        source = None
+        if uses_search and rng.random() < self.search_rate:
+            source = rng.choice(SYNTHETIC_SOURCES)
+            output.append({
+                "type": "web_search_call",
+                "id": f"ws-mock-{self.call_count}",
+                "status": "completed",
+                "action": {"type": "search", "query": prompt_text[-30:]},
+            })
+        elif tool_outputs:
+            # 引用工具結果的第一筆
+            results = json.loads(tool_outputs[-1]["output"])
+            if results:
+                source = (results[0]["title"], results[0]["url"])
+        if source:
+            title, url = source
+            if uses_search:
+                url = f"{url}?utm_source=openai"
+            citation = f" ([{title}]({url}))"
+            annotations.append({
+                "type": "url_citation",
+                "start_index": len(text),
+                "end_index": len(text) + len(citation),
+                "title": title,
+                "url": url,
+            })
+            text += citation
+        output.append({
+            "type": "message",
+            "id": f"msg-mock-{self.call_count}",
+            "role": "assistant",
+            "status": "completed",
+            "content": [{"type": "output_text", "text": text, "annotations": annotations}],
+        })
+        return self._response_object(request, prompt_text, text, output)
+
+    def _response_object(self, request, prompt_text, text, output):
+        input_tokens = estimate_tokens(prompt_text)
+        output_tokens = estimate_tokens(text)
+        return Response.construct(**{
+            "id": f"resp-mock-{self.call_count}",
+            "object": "response",
+            "created_at": time.time(),
+            "model": request.get("model", "mock"),
+            "output": output,
+            "parallel_tool_calls": True,
+            "tool_choice": "auto",
+            "tools": request.get("tools") or [],
+            "usage": {
+                "input_tokens": input_tokens,
+                "output_tokens": output_tokens,
+                "total_tokens": input_tokens + output_tokens,
+                "input_tokens_details": {"cached_tokens": self._cached_tokens("responses", request, prompt_text)},
+                "output_tokens_details": {"reasoning_tokens": 0},
+            },
+        })
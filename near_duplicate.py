@@ -0,0 +1,115 @@
+"""
+近似重複索引（MinHash + LSH）
+以字元 3-gram 的 MinHash 簽章表示每輪發言，LSH 分桶後只比對同桶的候選，
+可在毫秒內回答「這則回應是不是第 k 輪的換句話說」，並依相似度挑出最相關的已討論重點。
+"""
+import zlib
+
+import numpy as np
+
+SHINGLE_SIZE = 3  # 字元 n-gram 長度
+NUM_PERMUTATIONS = 64  # MinHash 簽章長度
+NUM_BANDS = 16  # LSH 分段數（每段 4 個值，約在相似度 0.5 附近開始成為候選）
+DUPLICATE_THRESHOLD = 0.5  # 估計 Jaccard 相似度達此值視為重複
+_PRIME = (1 << 31) - 1
+
+
+def shingles(text, size=SHINGLE_SIZE):
+    """去除空白後的字元 n-gram 集合（文字太短時以整段文字為一個 shingle）"""
+    text = "".join(text.split())
+    if len(text) <= size:
+        return {text} if text else set()
+    return {text[i:i + size] for i in range(len(text) - size + 1)}
+
+
+class NearDuplicateIndex:
+    """
+    MinHash / LSH 近似重複索引
+
+    每個項目記錄輪次、Agent、重點摘要與是否為重複發言；
+    重複發言仍會加入索引（之後的換句話說也能對應到它），但不會出現在 relevant_points() 的結果中。
+
+    Args:
+        num_perm: MinHash 簽章長度
+        bands: LSH 分段數（num_perm 須為其倍數）
+        threshold: 視為重複的估計 Jaccard 相似度
+        seed: 雜湊函數的亂數種子（固定以確保結果可重現）
+    """
+
+    def __init__(self, num_perm=NUM_PERMUTATIONS, bands=NUM_BANDS, threshold=DUPLICATE_THRESHOLD, seed=0):
+        if num_perm % bands:
+            raise ValueError("num_perm 必須是 bands 的倍數")
+        rng = np.random.default_rng(seed)
+        self._a = rng.integers(1, _PRIME, size=num_perm, dtype=np.uint64)[:, None]
+        self._b = rng.integers(0, _PRIME, size=num_perm, dtype=np.uint64)[:, None]
+        self.bands = bands
+        self.rows = num_perm // bands
+        self.threshold = threshold
+        self.items = []  # {"round", "agent", "point", "repeat"}
+        self.signatures = []
+        self._buckets = {}
+
+    def signature(self, text):
+        """MinHash 簽章（沒有 shingle 時回傳 None）"""
+        grams = shingles(text)
+        if not grams:
+            return None
+        hashes = np.fromiter((zlib.crc32(g.encode("utf-8")) for g in grams), dtype=np.uint64, count=len(grams))
+        return ((self._a * hashes[None, :] + self._b) % _PRIME).min(axis=1)
+
+    def _band_keys(self, signature):
+        for band in range(self.bands):
+            yield band, signature[band * self.rows:(band + 1) * self.rows].tobytes()
+
+    def query(self, text, signature=None):
+        """
+        找出與 text 近似重複的已索引項目
+
+        Returns:
+            list: [(項目索引, 估計相似度), ...]，依相似度由高到低
+        """
+        signature = self.signature(text) if signature is None else signature
+        if signature is None:
+            return []
+        candidates = set()
+        for key in self._band_keys(signature):
+            candidates.update(self._buckets.get(key, ()))
+        matches = []
+        for index in candidates:
+            similarity = float(np.mean(self.signatures[index] == signature))
+            if similarity >= self.threshold:
+                matches.append((index, similarity))
+        return sorted(matches, key=lambda match: (-match[1], -match[0]))
+
+    def add(self, text, round_num, agent, point):
+        """
+        加入一輪發言；若與先前某輪近似重複，回傳 (該輪的項目, 相似度)，否則回傳 None
+        """
+        signature = self.signature(text)
+        matches = self.query(text, signature) if signature is not None else []
+        duplicate = (self.items[matches[0][0]], matches[0][1]) if matches else None
+        self.items.append({"round": round_num, "agent": agent, "point": point, "repeat": duplicate is not None})
+        self.signatures.append(signature if signature is not None else np.full(len(self._a), _PRIME, dtype=np.uint64))
+        if signature is not None:
+            index = len(self.items) - 1
+            for key in self._band_keys(signature):
+                self._buckets.setdefault(key, []).append(index)
+        return duplicate
+
+    def relevant_points(self, text, k=8):
+        """
+        與 text 最相關的 k 個已討論重點（不含重複發言；相似度相同時較新的優先）
+
+        用於 prompt 的「禁止重複」清單：優先列出這一輪最可能被換句話說的內容，而不是最近幾輪。
+        """
+        unique = [i for i, item in enumerate(self.items) if not item["repeat"] and item["point"]]
+        if not unique:
+            return []
+        signature = self.signature(text)
+        if signature is None:
+            chosen = unique[-k:]
+        else:
+            similarities = (np.vstack([self.signatures[i] for i in unique]) == signature).mean(axis=1)
+            order = np.lexsort((-np.asarray(unique), -similarities))[:k]
+            chosen = sorted(unique[j] for j in order)
+        return [self.items[i]["point"] for i in chosen]
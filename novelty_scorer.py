@@ -0,0 +1,171 @@
+"""
+本地新穎度與重複度評分（不呼叫 API）
+以字元 n-gram TF-IDF 向量表示每輪發言（中文不需斷詞），一次矩陣運算求出整份對話的相似度矩陣，
+再計算每輪新穎度、各 Agent 的新觀點產出率、對話死鎖輪次與重複開場白。結果可重現且不需費用。
+
+使用方法:
+    python novelty_scorer.py experiment_log_*.jsonl
+    python novelty_scorer.py --threshold 0.4 --json scores.jsonl "logs/*.jsonl"
+"""
+import argparse
+import glob
+import json
+import re
+import time
+from collections import Counter
+
+import numpy as np
+
+from transcript import iter_turns
+
+NGRAM_SIZES = (2, 3)  # 字元 n-gram 長度
+NOVELTY_THRESHOLD = 0.5  # 新穎度低於此值視為「換句話說」
+DEADLOCK_WINDOW = 6  # 以最近幾輪的平均新穎度判斷死鎖（預設為兩個完整的發言循環）
+OPENING_MAX_CHARS = 20  # 開場白取第一個標點前、最多幾個字
+MIN_REPEATED_OPENINGS = 3  # 同一開場白至少出現幾次才算跳針
+
+_WHITESPACE = re.compile(r"\s+")
+_OPENING_BOUNDARY = re.compile(r"[，。！？；：,.!?;:\n]")
+
+
+def char_ngrams(text, sizes=NGRAM_SIZES):
+    """去除空白後的字元 n-gram"""
+    text = _WHITESPACE.sub("", text)
+    return [text[i:i + n] for n in sizes for i in range(len(text) - n + 1)]
+
+
+def tfidf_matrix(texts, sizes=NGRAM_SIZES):
+    """
+    建立 L2 正規化的 TF-IDF 矩陣（每列一輪發言）
+
+    詞彙表只包含這份對話出現過的 n-gram；tf 取 log(1 + count) 以降低單輪內重複字串的權重。
+    """
+    vocabulary = {}
+    rows, cols = [], []
+    for row, text in enumerate(texts):
+        for gram in char_ngrams(text, sizes):
+            cols.append(vocabulary.setdefault(gram, len(vocabulary)))
+            rows.append(row)
+    counts = np.zeros((len(texts), max(len(vocabulary), 1)), dtype=np.float32)
+    np.add.at(counts, (np.asarray(rows, dtype=np.intp), np.asarray(cols, dtype=np.intp)), 1)
+    document_frequency = np.count_nonzero(counts, axis=0)
+    idf = np.log((1 + len(texts)) / (1 + document_frequency)) + 1
+    matrix = np.log1p(counts) * idf.astype(np.float32)
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    return matrix / np.where(norms == 0, 1, norms)
+
+
+def novelty_scores(similarity):
+    """每輪新穎度 = 1 - 與先前任一輪的最大相似度（第一輪為 1）"""
+    earlier = np.tril(similarity, k=-1)
+    novelty = 1 - earlier.max(axis=1, initial=0)
+    novelty[0] = 1.0
+    return np.clip(novelty, 0, 1)
+
+
+def find_deadlock(novelty, rounds, threshold=NOVELTY_THRESHOLD, window=DEADLOCK_WINDOW):
+    """從哪一輪開始，之後每個視窗的平均新穎度都低於門檻（None 表示未死鎖）"""
+    if len(novelty) < window:
+        return None
+    rolling = np.convolve(novelty, np.ones(window) / window, mode="valid")  # rolling[i] = 第 i..i+window-1 輪的平均
+    still_novel = np.flatnonzero(rolling >= threshold)
+    start = still_novel[-1] + 1 if still_novel.size else 0
+    if start >= len(rolling):
+        return None
+    return rounds[start]
+
+
+def opening_phrase(text):
+    """第一個標點前的開場白（最多 OPENING_MAX_CHARS 字）"""
+    return _OPENING_BOUNDARY.split(text.strip(), 1)[0][:OPENING_MAX_CHARS]
+
+
+def repeated_openings(conversations, min_count=MIN_REPEATED_OPENINGS):
+    """各 Agent 最常重複的開場白（依重複次數由多到少）"""
+    by_agent = {}
+    for c in conversations:
+        phrase = opening_phrase(c["text"])
+        if phrase:
+            by_agent.setdefault(c["agent"], []).append((c["round"], phrase))
+    results = []
+    for agent, openings in by_agent.items():
+        phrase, count = Counter(p for _, p in openings).most_common(1)[0]
+        if count >= min_count:
+            start_round = next(r for r, p in openings if p == phrase)
+            results.append({"agent": agent, "phrase": phrase, "count": count, "start_round": start_round})
+    return sorted(results, key=lambda item: item["count"], reverse=True)
+
+
+def score_conversations(conversations, threshold=NOVELTY_THRESHOLD, window=DEADLOCK_WINDOW):
+    """
+    評分一份對話
+
+    Args:
+        conversations: read_experiment_log() 的結果（round、agent、text）
+        threshold: 新穎度門檻
+        window: 死鎖判斷的視窗輪數
+
+    Returns:
+        dict: similarity（相似度矩陣）、novelty、novelty_by_agent、new_idea_rate、deadlock_round、repeated_openings
+    """
+    if not conversations:
+        return {"turns": 0, "similarity": np.zeros((0, 0)), "novelty": [], "novelty_by_agent": {},
+                "new_idea_rate": {}, "deadlock_round": None, "repeated_openings": []}
+    rounds = [c["round"] for c in conversations]
+    matrix = tfidf_matrix([c["text"] for c in conversations])
+    similarity = matrix @ matrix.T
+    novelty = novelty_scores(similarity)
+
+    agents = np.array([c["agent"] for c in conversations])
+    novelty_by_agent = {}
+    new_idea_rate = {}
+    for agent in dict.fromkeys(c["agent"] for c in conversations):
+        mask = agents == agent
+        novelty_by_agent[agent] = [(int(r), round(float(n), 3)) for r, n in zip(np.asarray(rounds)[mask], novelty[mask])]
+        new_idea_rate[agent] = round(float(np.mean(novelty[mask] >= threshold)), 3)
+
+    return {
+        "turns": len(conversations),
+        "similarity": similarity,
+        "novelty": [round(float(n), 3) for n in novelty],
+        "novelty_by_agent": novelty_by_agent,
+        "new_idea_rate": new_idea_rate,
+        "deadlock_round": find_deadlock(novelty, rounds, threshold, window),
+        "repeated_openings": repeated_openings(conversations),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="以字元 n-gram TF-IDF 計算對話的新穎度與重複度")
+    parser.add_argument("paths", nargs="+", help="對話紀錄檔（可用萬用字元）")
+    parser.add_argument("--threshold", type=float, default=NOVELTY_THRESHOLD, help="新穎度門檻")
+    parser.add_argument("--window", type=int, default=DEADLOCK_WINDOW, help="死鎖判斷的視窗輪數")
+    parser.add_argument("--json", help="把每份對話的評分寫成 JSONL（不含相似度矩陣）")
+    args = parser.parse_args()
+
+    paths = [match for pattern in args.paths for match in sorted(glob.glob(pattern))]
+    if not paths:
+        parser.error("找不到任何對話紀錄檔")
+
+    started = time.perf_counter()
+    output = open(args.json, "w", encoding="utf-8") if args.json else None
+    print("| 檔案 | 輪數 | 死鎖輪次 | 新觀點產出率 | 重複開場白 |")
+    print("|------|------|----------|--------------|------------|")
+    try:
+        for path in paths:
+            scores = score_conversations(list(iter_turns(path)), args.threshold, args.window)
+            rates = "、".join(f"{agent} {rate:.0%}" for agent, rate in scores["new_idea_rate"].items())
+            openings = scores["repeated_openings"]
+            opening = f"{openings[0]['agent']}「{openings[0]['phrase']}」×{openings[0]['count']}" if openings else "-"
+            print(f"| {path} | {scores['turns']} | {scores['deadlock_round'] or '-'} | {rates} | {opening} |")
+            if output:
+                record = {key: value for key, value in scores.items() if key != "similarity"}
+                output.write(json.dumps({"file": path, **record}, ensure_ascii=False) + "\n")
+    finally:
+        if output:
+            output.close()
+    print(f"\n📏 {len(paths)} 個檔案，耗時 {time.perf_counter() - started:.2f} 秒")
+
+
+if __name__ == "__main__":
+    main()
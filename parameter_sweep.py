@@ -0,0 +1,337 @@
+"""
+參數掃描
+把 grid / spec 檔展開成多組實驗設定（版本、模型、temperature、輪數、主題、人設變體、發言順序、死鎖偵測），
+每組設定以雜湊命名實驗，已有結果的直接略過、中斷的由事件紀錄續跑，
+所有實驗共用同一個 LLMSession（Rate Limiter）同時執行，最後寫出每組設定的指標彙總表。
+
+使用方法:
+    python parameter_sweep.py sweep.json --backend mock
+    python parameter_sweep.py --version v1 v2 --grid temperature=0.5,0.9 --grid rounds=10,20 --replicates 5
+
+spec 檔（JSON）格式:
+    {
+        "name": "temperature_sweep",
+        "replicates": 5,
+        "grid": {
+            "version": ["v1", "v2"],
+            "temperature": [0.5, 0.9],
+            "personas": {"baseline": {}, "calm_engineer": {"Engineer": {"style": "冷靜、願意妥協"}}}
+        },
+        "fixed": {"rounds": 20, "context_budget": 4000, "deadlock": {"action": "stop"}}
+    }
+grid 的每個軸是值的 list；personas 軸是「變體名稱 → 人設覆寫」的 dict（v1 覆寫 description / style，
+v2 覆寫 system_prompt）。fixed 為所有組合共用的設定；deadlock 為即時死鎖偵測設定（見 deadlock_detector），
+死鎖提前結束的實驗也算完成，彙總表的 deadlock_round 為提前結束的輪次（只計入提前結束的實驗）。
+"""
+import argparse
+import asyncio
+import csv
+import hashlib
+import itertools
+import json
+import os
+import time
+
+from analyze_experiment import summarize_distribution
+from budget import Budget, BudgetExceeded, describe_usage
+from deadlock_detector import deadlock_stop_round
+from event_log import read_events
+from experiment_runner import SIMULATORS
+from llm_session import create_session
+from response_cache import ResponseCache, print_cache_stats
+from search_tools import create_search_tool, print_search_stats
+from retry_policy import RetryPolicy
+
+# 影響實驗結果、納入設定雜湊的欄位（budget、stream 等執行方式不影響結果）
+CELL_KEYS = ("version", "model", "temperature", "rounds", "topic", "personas", "context_budget", "summary_memory",
+             "turn_mode", "search_backend", "deadlock")
+# 各版本彙總表的指標（statistics 中的事件數；turns、tokens、cost_usd、deadlock_round 為兩版共用）
+METRIC_KEYS = {
+    "v1": ("hallucination_markers", "extreme_words", "mediator_contradictions", "failures"),
+    "v2": ("web_searches", "disagreements", "questions", "repeats", "failures"),
+}
+COMMON_METRIC_KEYS = ("turns", "tokens", "cost_usd", "deadlock_round")
+
+
+def parse_grid_value(text):
+    """grid 值：可解析為 JSON（數字、true / false）者照 JSON，其餘視為字串"""
+    try:
+        return json.loads(text)
+    except json.JSONDecodeError:
+        return text
+
+
+def load_spec(path):
+    """讀取 spec 檔；未指定 name 時以檔名命名"""
+    with open(path, encoding="utf-8") as f:
+        spec = json.load(f)
+    spec.setdefault("name", os.path.splitext(os.path.basename(path))[0])
+    return spec
+
+
+def expand_grid(spec):
+    """
+    展開 spec 的 grid，回傳每組設定（cell）
+
+    Returns:
+        list: cell dict（CELL_KEYS 中有設定的欄位，另含 "label" 與人設變體名稱 "persona"）
+    """
+    grid = dict(spec.get("grid") or {})
+    persona_axis = "personas" in grid
+    personas = grid.pop("personas", None) or {"default": None}
+    grid.setdefault("version", [spec.get("version", "v1")])
+    axes = sorted(grid)
+    cells = []
+    for values in itertools.product(*(grid[axis] for axis in axes)):
+        for persona_name, persona in personas.items():
+            cell = {**(spec.get("fixed") or {}), **dict(zip(axes, values))}
+            if cell["version"] not in SIMULATORS:
+                raise ValueError(f"未知的實驗版本: {cell['version']}")
+            cell["personas"] = persona or None
+            cell["persona"] = persona_name
+            cell["label"] = " / ".join([f"{axis}={cell[axis]}" for axis in axes]
+                                       + ([f"persona={persona_name}"] if persona_axis else []))
+            cells.append(cell)
+    return cells
+
+
+def cell_hash(cell):
+    """設定雜湊（相同設定重跑時得到相同的 experiment_id）"""
+    config = {key: cell[key] for key in CELL_KEYS if cell.get(key) is not None}
+    return hashlib.sha256(json.dumps(config, ensure_ascii=False, sort_keys=True).encode("utf-8")).hexdigest()[:10]
+
+
+def experiment_id_for(cell, replicate):
+    return f"sweep_{cell_hash(cell)}_r{replicate:03d}"
+
+
+def run_status(simulator, experiment_id):
+    """實驗的進度：沒有事件紀錄為 "new"，有 run_finished 事件為 "done"，其餘為 "partial"（可續跑）"""
+    path = simulator.event_log_filename(experiment_id)
+    if not os.path.exists(path):
+        return "new"
+    return "done" if any(event["type"] == "run_finished" for event in read_events(path)) else "partial"
+
+
+def new_cell_state(cell, replicate, budget=None):
+    """建立 cell 第 replicate 次實驗的狀態（seed 為 replicate）"""
+    simulator = SIMULATORS[cell["version"]]
+    options = {key: cell[key] for key in CELL_KEYS if key != "version" and cell.get(key) is not None}
+    if budget:
+        options["budget"] = budget
+    return simulator.new_run_state(experiment_id_for(cell, replicate), seed=replicate, **options)
+
+
+async def run_sweep(cells, replicates, session, concurrency=4, budget=None, write_outputs=True):
+    """
+    執行所有 cell × replicate 的實驗
+
+    已完成（事件紀錄有 run_finished）的實驗略過，中斷的實驗由事件紀錄續跑；
+    所有實驗共用 session（Rate Limiter、快取、整批用量上限），同時進行中的實驗數由 concurrency 限制。
+
+    Returns:
+        dict: 各狀態的實驗數（run / resumed / skipped / failed）
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+    counts = {"run": 0, "resumed": 0, "skipped": 0, "failed": 0}
+
+    async def run_one(cell, replicate):
+        simulator = SIMULATORS[cell["version"]]
+        experiment_id = experiment_id_for(cell, replicate)
+        status = run_status(simulator, experiment_id)
+        if status == "done":
+            counts["skipped"] += 1
+            return
+        async with semaphore:
+            if session.budget:
+                session.budget.check()
+            if status == "partial":
+                state = simulator.resume_run_state(experiment_id)
+                state["budget"] = budget  # 以本次掃描的用量上限為準
+            else:
+                state = new_cell_state(cell, replicate, budget)
+            print(f"▶️  {experiment_id}（{cell['label']}，replicate {replicate}，從 Round {state['completed_rounds'] + 1}）")
+            await simulator.run_discussion(session, state, verbose=False)
+            if write_outputs:
+                simulator.write_experiment_log(state)
+                simulator.write_analysis_report(state)
+                session.telemetry.export(simulator.telemetry_prefix(experiment_id), experiment_id)
+            counts["resumed" if status == "partial" else "run"] += 1
+            print(f"✅ 完成 {experiment_id}")
+
+    results = await asyncio.gather(
+        *(run_one(cell, replicate) for cell in cells for replicate in range(1, replicates + 1)),
+        return_exceptions=True
+    )
+    for error in results:
+        if isinstance(error, Exception):
+            counts["failed"] += 1
+            if not isinstance(error, BudgetExceeded):
+                print(f"   ⚠️ 實驗失敗: {error}")
+    return counts
+
+
+def cell_metrics(cell, replicates):
+    """
+    由事件紀錄彙總一個 cell 的指標（只計入已完成的實驗）
+
+    Returns:
+        dict: 指標名稱 -> summarize_distribution() 的結果；另含 "completed"（已完成的 replicate 數）
+    """
+    simulator = SIMULATORS[cell["version"]]
+    values = {key: [] for key in (*COMMON_METRIC_KEYS, *METRIC_KEYS[cell["version"]])}
+    completed = 0
+    for replicate in range(1, replicates + 1):
+        experiment_id = experiment_id_for(cell, replicate)
+        if run_status(simulator, experiment_id) != "done":
+            continue
+        completed += 1
+        state = simulator.resume_run_state(experiment_id)
+        values["turns"].append(len(state["history"]) - 1)
+        values["tokens"].append(state["usage"]["tokens"])
+        values["cost_usd"].append(state["usage"]["cost_usd"])
+        values["deadlock_round"].append(deadlock_stop_round(state["statistics"]))
+        for key in METRIC_KEYS[cell["version"]]:
+            values[key].append(len(state["statistics"][key]))
+    metrics = {key: summarize_distribution(series) for key, series in values.items()}
+    metrics["completed"] = completed
+    return metrics
+
+
+def format_distribution(summary, digits=1):
+    if summary["mean"] is None:
+        return "—"
+    if summary["ci_low"] is None:
+        return f"{summary['mean']:.{digits}f}"
+    return f"{summary['mean']:.{digits}f} [{summary['ci_low']:.{digits}f}, {summary['ci_high']:.{digits}f}]"
+
+
+def write_summary(name, cells, replicates):
+    """寫出每個 cell 的指標彙總表（markdown 與 CSV），回傳 (markdown 檔名, CSV 檔名)"""
+    rows = [(cell, cell_metrics(cell, replicates)) for cell in cells]
+    metric_names = []
+    for cell, metrics in rows:
+        metric_names += [key for key in metrics if key != "completed" and key not in metric_names]
+
+    csv_filename = f"sweep_summary_{name}.csv"
+    with open(csv_filename, "w", encoding="utf-8", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(["cell", "experiment_prefix", "version", "model", "temperature", "rounds", "persona", "topic",
+                         "completed"] + [f"{key}_{stat}" for key in metric_names for stat in ("mean", "ci_low", "ci_high")])
+        for cell, metrics in rows:
+            empty = {"mean": None, "ci_low": None, "ci_high": None}
+            writer.writerow([cell["label"], f"sweep_{cell_hash(cell)}", cell["version"], cell.get("model"),
+                             cell.get("temperature"), cell.get("rounds"), cell["persona"], cell.get("topic"),
+                             metrics["completed"]]
+                            + [metrics.get(key, empty)[stat] for key in metric_names for stat in ("mean", "ci_low", "ci_high")])
+
+    md_filename = f"sweep_summary_{name}.md"
+    with open(md_filename, "w", encoding="utf-8") as f:
+        f.write(f"# 📊 參數掃描彙總：{name}\n\n")
+        f.write(f"- **設定組合**: {len(cells)} 組 × {replicates} 次 replicate\n")
+        f.write(f"- **已完成實驗**: {sum(metrics['completed'] for _, metrics in rows)}\n")
+        f.write("- 數值為平均值 [95% 信賴區間]；只計入已完成（有 run_finished 事件）的實驗\n\n")
+        for version in sorted({cell["version"] for cell in cells}):
+            keys = [*COMMON_METRIC_KEYS, *METRIC_KEYS[version]]
+            f.write(f"## {version}\n\n")
+            f.write("| 設定 | 完成 | " + " | ".join(keys) + " |\n")
+            f.write("|------|------|" + "|".join("------" for _ in keys) + "|\n")
+            for cell, metrics in rows:
+                if cell["version"] != version:
+                    continue
+                cells_text = [format_distribution(metrics[key], 4 if key == "cost_usd" else 1) for key in keys]
+                f.write(f"| `sweep_{cell_hash(cell)}` {cell['label']} | {metrics['completed']}/{replicates} | "
+                        + " | ".join(cells_text) + " |\n")
+            f.write("\n")
+    return md_filename, csv_filename
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Multi-Agent 實驗參數掃描")
+    parser.add_argument("spec", nargs="?", help="spec 檔（JSON）；未指定時以 --version / --grid 組出")
+    parser.add_argument("--name", help="掃描名稱（彙總表檔名；預設為 spec 檔名或設定雜湊）")
+    parser.add_argument("--version", nargs="+", choices=sorted(SIMULATORS), help="實驗版本（grid 的 version 軸）")
+    parser.add_argument("--grid", action="append", default=[], metavar="KEY=V1,V2",
+                        help="grid 軸，例如 temperature=0.5,0.9（可重複指定）")
+    parser.add_argument("--replicates", type=int, help="每組設定的實驗次數（預設 spec 的 replicates 或 3）")
+    parser.add_argument("--concurrency", type=int, default=4, help="同時執行的實驗數上限")
+    parser.add_argument("--dry-run", action="store_true", help="只列出展開後的設定與進度，不執行")
+    parser.add_argument("--summary-only", action="store_true", help="不執行，只由既有事件紀錄重寫彙總表")
+    parser.add_argument("--max-tokens", type=int, help="每次實驗的 token 上限")
+    parser.add_argument("--max-cost", type=float, help="每次實驗的估計費用上限（美元）")
+    parser.add_argument("--sweep-max-cost", type=float, help="整個掃描的估計費用上限（美元）")
+    parser.add_argument("--sweep-max-wall-time", type=float, help="整個掃描的執行時間上限（秒）")
+    parser.add_argument("--backend", default="openai", help="LLM 後端（openai / mock）")
+    parser.add_argument("--mock-latency", type=float, default=0.0, help="mock 後端的平均延遲秒數")
+    parser.add_argument("--rpm", type=int, help="每分鐘請求數上限（預設依模型額度）")
+    parser.add_argument("--tpm", type=int, help="每分鐘 token 數上限（預設依模型額度）")
+    parser.add_argument("--max-attempts", type=int, default=5, help="每次 API 呼叫最多嘗試次數")
+    parser.add_argument("--cache", help="回應快取 SQLite 檔案路徑（預設不快取）")
+    parser.add_argument("--search-cache", help="搜尋快取 SQLite 檔案路徑（search_backend=local 時重用 web_search 的結果）")
+    parser.add_argument("--search-ttl", type=float, help="搜尋快取的有效時數（預設 168）")
+    parser.add_argument("--search-docs", help="本機檢索的文件目錄（.md / .txt）")
+    args = parser.parse_args()
+
+    spec = load_spec(args.spec) if args.spec else {"grid": {}}
+    if args.version:
+        spec.setdefault("grid", {})["version"] = args.version
+    for axis in args.grid:
+        key, _, values = axis.partition("=")
+        spec.setdefault("grid", {})[key] = [parse_grid_value(value) for value in values.split(",")]
+    replicates = args.replicates or spec.get("replicates", 3)
+    cells = expand_grid(spec)
+    name = args.name or spec.get("name") or hashlib.sha256(
+        json.dumps(spec, ensure_ascii=False, sort_keys=True).encode("utf-8")).hexdigest()[:10]
+
+    print("=" * 60)
+    print(f"🔬 參數掃描 {name}：{len(cells)} 組設定 × {replicates} 次（同時 {args.concurrency} 個）")
+    print("=" * 60)
+    for cell in cells:
+        simulator = SIMULATORS[cell["version"]]
+        statuses = [run_status(simulator, experiment_id_for(cell, r)) for r in range(1, replicates + 1)]
+        print(f"   sweep_{cell_hash(cell)}  {cell['label']}（已完成 {statuses.count('done')}、"
+              f"可續跑 {statuses.count('partial')}）")
+    if args.dry_run:
+        return
+
+    if not args.summary_only:
+        versions = {cell["version"] for cell in cells}
+        backend_options = {"latency": args.mock_latency, "latency_sigma": 0.3} if args.backend == "mock" else {}
+        sweep_budget = None
+        if args.sweep_max_cost or args.sweep_max_wall_time:
+            sweep_budget = Budget(max_cost_usd=args.sweep_max_cost, max_seconds=args.sweep_max_wall_time, name="整批")
+        run_budget = {key: value for key, value in (("max_tokens", args.max_tokens), ("max_cost_usd", args.max_cost))
+                      if value} or None
+        session = create_session(
+            # 兩個版本的 create_client 相同（依 backend 建立 client）
+            SIMULATORS[sorted(versions)[0]].create_client(args.backend, **backend_options),
+            rate_limited=args.backend != "mock" or bool(args.rpm or args.tpm),
+            requests_per_minute=args.rpm,
+            tokens_per_minute=args.tpm,
+            retry_policy=RetryPolicy(max_attempts=args.max_attempts),
+            cache=ResponseCache(args.cache) if args.cache else None,
+            budget=sweep_budget,
+            search_tool=create_search_tool(args.search_cache, args.search_docs, args.search_ttl)
+        )
+        started = time.perf_counter()
+        counts = asyncio.run(run_sweep(cells, replicates, session, args.concurrency, run_budget))
+        print("\n" + "=" * 60)
+        print(f"✅ 新執行 {counts['run']}、續跑 {counts['resumed']}、略過（已完成）{counts['skipped']}、"
+              f"失敗或未開始 {counts['failed']}，耗時 {time.perf_counter() - started:.1f} 秒")
+        telemetry = session.telemetry.summary()
+        if telemetry["calls"]:
+            print(f"📈 API 呼叫 {telemetry['calls']} 次，估計費用 ${telemetry['cost_usd']:.4f}")
+        if session.budget:
+            print(f"💰 整批用量：{describe_usage(session.budget.usage())}")
+        if session.cache:
+            print_cache_stats(session.cache)
+        if session.search_tool:
+            print_search_stats(session.search_tool)
+
+    md_filename, csv_filename = write_summary(name, cells, replicates)
+    print(f"📊 彙總表已保存: {md_filename} / {csv_filename}")
+    print("=" * 60)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,130 @@
+"""
+共用 Rate Limiter（Token Bucket）
+同時限制每分鐘請求數（RPM）與每分鐘 token 數（TPM），
+由 API 回傳的 usage 與 x-ratelimit-* response headers 持續校正。
+"""
+import asyncio
+import re
+import time
+
+# gpt-4o-mini Tier 1 預設額度
+DEFAULT_REQUESTS_PER_MINUTE = 500
+DEFAULT_TOKENS_PER_MINUTE = 200_000
+
+
+class TokenBucket:
+    """容量為 capacity、每秒補充 refill_rate 的 token bucket"""
+
+    def __init__(self, capacity):
+        self.capacity = float(capacity)
+        self.refill_rate = self.capacity / 60.0
+        self.available = self.capacity
+        self.updated_at = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.available = min(self.capacity, self.available + (now - self.updated_at) * self.refill_rate)
+        self.updated_at = now
+
+    def time_until(self, amount):
+        """還需等待幾秒才能取出 amount 個 token"""
+        self._refill()
+        amount = min(amount, self.capacity)
+        if self.available >= amount:
+            return 0.0
+        return (amount - self.available) / self.refill_rate
+
+    def take(self, amount):
+        self._refill()
+        self.available -= amount
+
+    def set_limit(self, capacity):
+        """依伺服器回報的額度上限調整容量與補充速率"""
+        self._refill()
+        self.capacity = float(capacity)
+        self.refill_rate = self.capacity / 60.0
+        self.available = min(self.available, self.capacity)
+
+    def sync_remaining(self, remaining, reset_seconds=None):
+        """伺服器回報的剩餘額度較少時，以伺服器為準"""
+        self._refill()
+        if remaining < self.available:
+            self.available = float(remaining)
+            if reset_seconds:
+                # 伺服器告知多久後額度全滿，據此估計補充速率
+                self.refill_rate = max(self.refill_rate, (self.capacity - remaining) / reset_seconds)
+
+
+def parse_reset_duration(value):
+    """解析 x-ratelimit-reset-* 的時間格式（例如 "1s"、"6m0s"、"20ms"），回傳秒數"""
+    if not value:
+        return None
+    units = {"h": 3600, "m": 60, "s": 1, "ms": 0.001}
+    total = 0.0
+    matched = False
+    for number, unit in re.findall(r"([\d.]+)(ms|h|m|s)", value):
+        total += float(number) * units[unit]
+        matched = True
+    return total if matched else None
+
+
+class RateLimiter:
+    """
+    RPM + TPM 雙 token bucket 限流器
+
+    所有同時執行的實驗共用同一個 RateLimiter：
+    送出請求前以 acquire() 預扣估計 token，完成後以 record_usage() 依實際 usage 校正。
+    """
+
+    def __init__(self, requests_per_minute=DEFAULT_REQUESTS_PER_MINUTE, tokens_per_minute=DEFAULT_TOKENS_PER_MINUTE):
+        self.requests = TokenBucket(requests_per_minute)
+        self.tokens = TokenBucket(tokens_per_minute)
+        self._lock = asyncio.Lock()
+
+    async def acquire(self, estimated_tokens):
+        """
+        等待直到 RPM 與 TPM 額度都足夠，然後預扣
+
+        鎖只保護「檢查並預扣」；等待時釋放鎖，醒來後重新檢查（其他呼叫可能已先取走額度）。
+        """
+        while True:
+            async with self._lock:
+                wait = max(self.requests.time_until(1), self.tokens.time_until(estimated_tokens))
+                if wait <= 0:
+                    self.requests.take(1)
+                    self.tokens.take(estimated_tokens)
+                    return
+            await asyncio.sleep(wait)
+
+    def record_usage(self, estimated_tokens, usage):
+        """以實際 usage.total_tokens 校正預扣的估計值"""
+        total_tokens = getattr(usage, "total_tokens", None)
+        if total_tokens is None:
+            return
+        self.tokens.take(total_tokens - estimated_tokens)
+
+    def update_from_headers(self, headers):
+        """依 x-ratelimit-* response headers 同步伺服器端的額度狀態"""
+        if not headers:
+            return
+        for bucket, kind in ((self.requests, "requests"), (self.tokens, "tokens")):
+            limit = headers.get(f"x-ratelimit-limit-{kind}")
+            remaining = headers.get(f"x-ratelimit-remaining-{kind}")
+            reset = parse_reset_duration(headers.get(f"x-ratelimit-reset-{kind}"))
+            try:
+                if limit is not None:
+                    bucket.set_limit(int(limit))
+                if remaining is not None:
+                    bucket.sync_remaining(int(remaining), reset)
+            except ValueError:
+                continue
+
+
+def estimate_tokens(text):
+    """
+    粗估文字的 token 數（不需 tokenizer）
+
+    中文約每字 1 token，英文約每 4 字元 1 token；寧可高估以免超額。
+    """
+    ascii_count = len(text.encode("ascii", "ignore"))
+    return (len(text) - ascii_count) + ascii_count // 4 + 1
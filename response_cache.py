@@ -0,0 +1,127 @@
+"""
+LLM 回應快取（SQLite，內容定址）
+以「API 類型 + 完整請求內容（model / temperature / tools / prompt）+ 取樣序號 seed」的雜湊為鍵，
+重跑實驗時相同的前綴輪次直接從本機讀取，不再重新付費呼叫。
+"""
+import hashlib
+import json
+import os
+import sqlite3
+import time
+
+from openai.types.chat import ChatCompletion
+from openai.types.responses import Response
+
+RESPONSE_TYPES = {
+    "chat": ChatCompletion,
+    "responses": Response,
+}
+
+DEFAULT_MAX_BYTES = 200 * 1024 * 1024  # 200 MB
+
+
+def cache_key(api, request, seed=None):
+    """計算請求的內容雜湊"""
+    payload = json.dumps({"api": api, "request": request, "seed": seed}, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class ResponseCache:
+    """
+    SQLite 回應快取，超過容量時依最近使用時間（LRU）淘汰
+
+    Args:
+        path: SQLite 檔案路徑
+        max_bytes: 快取內容總大小上限
+    """
+
+    def __init__(self, path, max_bytes=DEFAULT_MAX_BYTES):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.conn = sqlite3.connect(path)
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS responses (
+                key TEXT PRIMARY KEY,
+                api TEXT NOT NULL,
+                body TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                created_at REAL NOT NULL,
+                last_used_at REAL NOT NULL,
+                hit_count INTEGER NOT NULL DEFAULT 0
+            )
+        """)
+        self.conn.execute("CREATE INDEX IF NOT EXISTS idx_last_used ON responses (last_used_at)")
+        self.conn.commit()
+
+    def get(self, api, request, seed=None):
+        """查詢快取，命中時回傳重建的 response 物件，否則回傳 None"""
+        key = cache_key(api, request, seed)
+        row = self.conn.execute("SELECT body FROM responses WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.conn.execute(
+            "UPDATE responses SET last_used_at = ?, hit_count = hit_count + 1 WHERE key = ?",
+            (time.time(), key)
+        )
+        self.conn.commit()
+        # 與 SDK 解析 API 回應相同的寬鬆建構方式，避免 SDK 版本差異造成驗證失敗
+        return RESPONSE_TYPES[api].construct(**json.loads(row[0]))
+
+    def put(self, api, request, response, seed=None):
+        """寫入快取，並在超過容量時淘汰最久未使用的項目"""
+        body = response.model_dump_json()
+        now = time.time()
+        self.conn.execute(
+            "INSERT OR REPLACE INTO responses (key, api, body, size, created_at, last_used_at) VALUES (?, ?, ?, ?, ?, ?)",
+            (cache_key(api, request, seed), api, body, len(body.encode("utf-8")), now, now)
+        )
+        self._evict()
+        self.conn.commit()
+
+    def _evict(self):
+        total = self.conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        for key, size in self.conn.execute("SELECT key, size FROM responses ORDER BY last_used_at").fetchall():
+            self.conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+            self.evictions += 1
+            total -= size
+            if total <= self.max_bytes:
+                break
+
+    def stats(self):
+        """回傳命中統計與目前快取大小"""
+        entries, total = self.conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM responses").fetchone()
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "evictions": self.evictions,
+            "entries": entries,
+            "bytes": total,
+        }
+
+    def close(self):
+        self.conn.close()
+
+
+def open_cache_from_env():
+    """若設定了 LLM_CACHE_PATH 環境變數則開啟快取，否則回傳 None（快取預設關閉）"""
+    path = os.getenv("LLM_CACHE_PATH")
+    if not path:
+        return None
+    max_mb = os.getenv("LLM_CACHE_MAX_MB")
+    return ResponseCache(path, max_bytes=int(max_mb) * 1024 * 1024 if max_mb else DEFAULT_MAX_BYTES)
+
+
+def print_cache_stats(cache):
+    """印出快取命中統計"""
+    stats = cache.stats()
+    print(f"💾 回應快取: 命中 {stats['hits']} / 未命中 {stats['misses']} "
+          f"(命中率 {stats['hit_rate']:.0%})，{stats['entries']} 筆，{stats['bytes'] / 1024:.0f} KB")
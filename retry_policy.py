@@ -0,0 +1,107 @@
+"""
+API 呼叫重試策略
+指數退避 + jitter、可重試/致命錯誤分類、單次呼叫逾時
+"""
+import asyncio
+import random
+
+import openai
+
+# 可重試的 HTTP 狀態碼（逾時、衝突、限流、伺服器錯誤）
+RETRYABLE_STATUS_CODES = {408, 409, 429, 500, 502, 503, 504}
+
+
+class LLMCallFailed(Exception):
+    """
+    一次 LLM 呼叫在重試額度內仍然失敗
+
+    Attributes:
+        attempts: 實際嘗試次數
+        fatal: 是否為不可重試的致命錯誤（例如金鑰錯誤、請求格式錯誤）
+        last_error: 最後一次的原始例外
+    """
+
+    def __init__(self, message, attempts, fatal, last_error):
+        super().__init__(message)
+        self.attempts = attempts
+        self.fatal = fatal
+        self.last_error = last_error
+
+
+def is_retryable(error):
+    """判斷例外是否值得重試"""
+    if isinstance(error, (asyncio.TimeoutError, openai.APITimeoutError, openai.APIConnectionError)):
+        return True
+    if isinstance(error, openai.APIStatusError):
+        return error.status_code in RETRYABLE_STATUS_CODES or error.status_code >= 500
+    return False
+
+
+def retry_after_seconds(error):
+    """讀取錯誤回應中的 retry-after header（秒）"""
+    response = getattr(error, "response", None)
+    headers = getattr(response, "headers", None) or {}
+    value = headers.get("retry-after")
+    try:
+        return float(value) if value is not None else None
+    except ValueError:
+        return None
+
+
+class RetryPolicy:
+    """
+    重試設定
+
+    Args:
+        max_attempts: 每次呼叫最多嘗試次數（含第一次）
+        base_delay: 第一次重試的退避秒數上限
+        max_delay: 單次退避秒數上限
+        timeout: 單次呼叫逾時秒數（None 表示不限）
+        jitter: 是否使用 full jitter（避免多個實驗同時重試）
+    """
+
+    def __init__(self, max_attempts=5, base_delay=1.0, max_delay=30.0, timeout=60.0, jitter=True):
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.timeout = timeout
+        self.jitter = jitter
+
+    def backoff(self, attempt, retry_after=None):
+        """第 attempt 次失敗後應等待的秒數"""
+        delay = min(self.max_delay, self.base_delay * (2 ** (attempt - 1)))
+        if self.jitter:
+            delay = random.uniform(0, delay)
+        if retry_after is not None:
+            delay = max(delay, retry_after)
+        return delay
+
+    async def run(self, make_call, on_retry=None, before_call=None):
+        """
+        依策略執行 make_call()，失敗時退避重試
+
+        Args:
+            make_call: 每次呼叫都回傳新 coroutine 的函式
+            on_retry: 重試前的回呼 on_retry(attempt, error, delay)
+            before_call: 每次嘗試前等待的 coroutine 函式（例如限流器排隊），不計入 timeout
+
+        Raises:
+            LLMCallFailed: 遇到致命錯誤或用完重試額度
+        """
+        for attempt in range(1, self.max_attempts + 1):
+            if before_call:
+                await before_call()
+            try:
+                if self.timeout:
+                    return await asyncio.wait_for(make_call(), self.timeout)
+                return await make_call()
+            except Exception as e:
+                detail = str(e) or type(e).__name__
+                if not is_retryable(e):
+                    raise LLMCallFailed(f"致命錯誤（不重試）: {detail}", attempt, True, e) from e
+                if attempt == self.max_attempts:
+                    raise LLMCallFailed(f"重試 {attempt} 次仍失敗: {detail}", attempt, False, e) from e
+                delay = self.backoff(attempt, retry_after_seconds(e))
+                if on_retry:
+                    on_retry(attempt, e, delay)
+                await asyncio.sleep(delay)
@@ -0,0 +1,371 @@
+"""
+搜尋快取與本機檢索
+v2 每輪的 web_search 是最慢也最貴的部分，而同一主題的重跑幾乎都在搜尋相同的內容：
+- SearchCache：把 web_search_call 的查詢與回應引用的來源（url_citation）存進 SQLite，超過 TTL 視為過期
+- LocalSearchIndex：文件目錄的 BM25 索引（字元 bigram，中文不需斷詞）
+- SearchTool：以 function-call 工具 search 取代 web_search，查詢先比對快取，未命中再查本機索引
+  （索引也包含快取中的來源，先前 web_search 找到的證據可被換句話說的查詢找到）
+重跑時改用本機檢索，replicate 之間得到快速、可重現且不需搜尋費用的證據。
+"""
+import json
+import math
+import os
+import re
+import sqlite3
+import time
+from collections import Counter
+
+from novelty_scorer import char_ngrams
+
+SEARCH_BACKENDS = ("web", "local")
+DEFAULT_TTL_SECONDS = 7 * 24 * 3600  # 快取的搜尋結果保存 7 天
+SEARCH_RESULTS = 3  # 每次查詢回傳的結果數
+PASSAGE_CHARS = 400  # 文件切成段落時每段的字數上限
+SNIPPET_CHARS = 200  # 結果摘錄的字數上限
+DOCUMENT_EXTENSIONS = (".md", ".txt")
+BM25_K1 = 1.5
+BM25_B = 0.75
+
+# Responses API 的 function-call 工具定義（取代 {"type": "web_search"}）
+SEARCH_TOOL = {
+    "type": "function",
+    "name": "search",
+    "description": "搜尋本機文獻與先前查證過的來源，回傳標題、網址與摘錄。需要數據或案例佐證時使用。",
+    "parameters": {
+        "type": "object",
+        "properties": {"query": {"type": "string", "description": "搜尋關鍵字"}},
+        "required": ["query"],
+        "additionalProperties": False,
+    },
+    "strict": True,
+}
+
+_SENTENCE_END = re.compile(r"[。！？!?\n]")
+_BLANK_LINES = re.compile(r"\n\s*\n")
+
+
+def normalize_query(query):
+    """快取鍵：去除頭尾與多餘空白、英文轉小寫"""
+    return " ".join(query.lower().split())
+
+
+def terms(text):
+    """BM25 的詞：去除空白後的字元 bigram（英文轉小寫）"""
+    return char_ngrams(text.lower(), (2,))
+
+
+def citation_snippet(text, start):
+    """引用標記之前的那一句（url_citation 的 start_index 指向標記開頭）"""
+    before = text[:start].rstrip()
+    boundaries = [m.end() for m in _SENTENCE_END.finditer(before[:-1])]
+    return before[boundaries[-1] if boundaries else 0:].strip()[-SNIPPET_CHARS:]
+
+
+def web_search_results(response):
+    """
+    取出 Responses API 回應中的搜尋查詢與引用來源
+
+    一次回應中的多個 web_search_call 無法對應到各自的引用，因此每個查詢都記錄整則回應的所有引用。
+
+    Returns:
+        list: (查詢, 結果 list)；結果為 {"title", "url", "snippet"}
+    """
+    queries = []
+    results = []
+    for item in getattr(response, "output", None) or []:
+        if getattr(item, "type", None) == "web_search_call":
+            query = getattr(getattr(item, "action", None), "query", None)
+            if query:
+                queries.append(query)
+        elif getattr(item, "type", None) == "message":
+            for content in item.content or []:
+                for annotation in getattr(content, "annotations", None) or []:
+                    if getattr(annotation, "type", None) == "url_citation":
+                        results.append({
+                            "title": annotation.title,
+                            "url": annotation.url,
+                            "snippet": citation_snippet(content.text, annotation.start_index),
+                        })
+    return [(query, results) for query in queries]
+
+
+class SearchCache:
+    """
+    查詢 → 搜尋結果的 SQLite 快取，超過 ttl_seconds 的結果視為過期（查詢時不回傳、之後覆寫）
+
+    Args:
+        path: SQLite 檔案路徑
+        ttl_seconds: 結果的有效秒數
+    """
+
+    def __init__(self, path, ttl_seconds=DEFAULT_TTL_SECONDS):
+        self.path = path
+        self.ttl_seconds = ttl_seconds
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+        self.conn = sqlite3.connect(path)
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS searches (
+                query TEXT PRIMARY KEY,
+                results TEXT NOT NULL,
+                source TEXT NOT NULL,
+                created_at REAL NOT NULL
+            )
+        """)
+        self.conn.commit()
+
+    def _fresh_after(self):
+        return time.time() - self.ttl_seconds
+
+    def get(self, query):
+        """未過期的結果 list；沒有或已過期時回傳 None"""
+        row = self.conn.execute("SELECT results, created_at FROM searches WHERE query = ?",
+                                (normalize_query(query),)).fetchone()
+        if row is None or row[1] < self._fresh_after():
+            self.misses += 1
+            if row is not None:
+                self.expired += 1
+            return None
+        self.hits += 1
+        return json.loads(row[0])
+
+    def put(self, query, results, source="web"):
+        self.conn.execute(
+            "INSERT OR REPLACE INTO searches (query, results, source, created_at) VALUES (?, ?, ?, ?)",
+            (normalize_query(query), json.dumps(results, ensure_ascii=False), source, time.time())
+        )
+        self.conn.commit()
+
+    def capture(self, response):
+        """把回應中的 web_search 查詢與引用寫入快取，回傳寫入的查詢數"""
+        captured = web_search_results(response)
+        for query, results in captured:
+            self.put(query, results)
+        return len(captured)
+
+    def entries(self):
+        """所有未過期的 (查詢, 結果 list)"""
+        rows = self.conn.execute("SELECT query, results FROM searches WHERE created_at >= ? ORDER BY created_at",
+                                 (self._fresh_after(),)).fetchall()
+        return [(query, json.loads(results)) for query, results in rows]
+
+    def stats(self):
+        entries = self.conn.execute("SELECT COUNT(*) FROM searches WHERE created_at >= ?",
+                                    (self._fresh_after(),)).fetchone()[0]
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "expired": self.expired,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "entries": entries,
+        }
+
+    def close(self):
+        self.conn.close()
+
+
+class LocalSearchIndex:
+    """
+    BM25 檢索索引（字元 bigram）
+
+    每份文件以 {"title", "url", "text"} 表示；add_directory() 把目錄中的 .md / .txt 依空行切成不超過
+    PASSAGE_CHARS 字的段落，每段一份文件。分數相同時依加入順序排列，結果可重現。
+    """
+
+    def __init__(self, k1=BM25_K1, b=BM25_B):
+        self.k1 = k1
+        self.b = b
+        self.documents = []
+        self.lengths = []
+        self.postings = {}  # 詞 -> [(文件索引, 詞頻)]
+        self.searches = 0
+
+    def add(self, title, url, text):
+        index = len(self.documents)
+        self.documents.append({"title": title, "url": url, "text": text})
+        counts = Counter(terms(text))
+        self.lengths.append(sum(counts.values()))
+        for term, count in counts.items():
+            self.postings.setdefault(term, []).append((index, count))
+
+    def add_directory(self, directory):
+        """加入目錄（含子目錄）中的所有 .md / .txt，回傳加入的段落數"""
+        added = 0
+        for root, _, files in sorted(os.walk(directory)):
+            for filename in sorted(files):
+                if not filename.endswith(DOCUMENT_EXTENSIONS):
+                    continue
+                path = os.path.join(root, filename)
+                with open(path, encoding="utf-8") as f:
+                    text = f.read()
+                relative = os.path.relpath(path, directory)
+                for number, passage in enumerate(split_passages(text), start=1):
+                    self.add(relative, f"{relative}#p{number}", passage)
+                    added += 1
+        return added
+
+    def add_cached_results(self, cache):
+        """加入搜尋快取中的來源（每筆引用一份文件，同一網址只加一次），回傳加入的數量"""
+        seen = {document["url"] for document in self.documents}
+        added = 0
+        for query, results in cache.entries():
+            for result in results:
+                if result["url"] in seen:
+                    continue
+                seen.add(result["url"])
+                self.add(result["title"], result["url"], f"{query}\n{result['snippet']}")
+                added += 1
+        return added
+
+    def search(self, query, k=SEARCH_RESULTS):
+        """BM25 分數最高的 k 份文件：{"title", "url", "snippet"}"""
+        self.searches += 1
+        if not self.documents:
+            return []
+        average_length = sum(self.lengths) / len(self.documents) or 1
+        scores = {}
+        for term in set(terms(query)):
+            postings = self.postings.get(term)
+            if not postings:
+                continue
+            idf = math.log(1 + (len(self.documents) - len(postings) + 0.5) / (len(postings) + 0.5))
+            for index, count in postings:
+                norm = count + self.k1 * (1 - self.b + self.b * self.lengths[index] / average_length)
+                scores[index] = scores.get(index, 0.0) + idf * count * (self.k1 + 1) / norm
+        ranked = sorted(scores, key=lambda index: (-scores[index], index))[:k]
+        return [{
+            "title": self.documents[index]["title"],
+            "url": self.documents[index]["url"],
+            "snippet": self.documents[index]["text"][:SNIPPET_CHARS],
+        } for index in ranked]
+
+
+def split_passages(text, max_chars=PASSAGE_CHARS):
+    """依空行切段，過短的段落併入下一段、過長的段落再依字數切開"""
+    passages = []
+    current = ""
+    for block in _BLANK_LINES.split(text):
+        block = block.strip()
+        if not block:
+            continue
+        if current and len(current) + len(block) + 1 > max_chars:
+            passages.append(current)
+            current = ""
+        current = f"{current}\n{block}" if current else block
+        while len(current) > max_chars:
+            passages.append(current[:max_chars])
+            current = current[max_chars:]
+    if current:
+        passages.append(current)
+    return passages
+
+
+class SearchTool:
+    """
+    搜尋快取與本機檢索的組合（掛在 LLMSession.search_tool，多個實驗共用）
+
+    web_search 模式下由 capture() 記錄搜尋結果；本機檢索模式下由 search() 回答 function-call 的查詢：
+    完全相同的查詢直接回傳快取結果，否則以 BM25 查詢本機文件與快取中的來源。
+
+    Args:
+        cache: SearchCache（None 則不記錄、不重用 web_search 的結果）
+        documents: 本機文件目錄（None 則只檢索快取中的來源）
+        k: 每次查詢回傳的結果數
+    """
+
+    def __init__(self, cache=None, documents=None, k=SEARCH_RESULTS):
+        self.cache = cache
+        self.k = k
+        self.index = LocalSearchIndex()
+        self.captured = 0
+        if documents:
+            self.index.add_directory(documents)
+        if cache:
+            self.index.add_cached_results(cache)
+
+    def capture(self, response):
+        """記錄 web_search 的查詢與引用（沒有快取時不做事）"""
+        if self.cache:
+            self.captured += self.cache.capture(response)
+
+    def search(self, query):
+        if self.cache:
+            cached = self.cache.get(query)
+            if cached is not None:
+                return cached[:self.k]
+        return self.index.search(query, self.k)
+
+    def stats(self):
+        stats = {"documents": len(self.index.documents), "local_searches": self.index.searches,
+                 "captured": self.captured}
+        if self.cache:
+            stats.update(self.cache.stats())
+        return stats
+
+
+def function_calls(response):
+    """回應中呼叫 search 工具的 function_call 項目"""
+    return [item for item in getattr(response, "output", None) or []
+            if getattr(item, "type", None) == "function_call" and item.name == SEARCH_TOOL["name"]]
+
+
+async def run_search_calls(session, api, request, response, search_tool, labels=None, on_delta=None, budget=None,
+                           on_discard=None):
+    """
+    回答回應中的 search function call，再送出一次請求取得最後的回應
+
+    後續請求的 input 為原本的使用者訊息、function_call 與其結果；tool_choice 設為 "none"，每輪最多查一次。
+
+    Returns:
+        tuple: (最後的 response, 所有 response 的 list, 查詢 list)
+    """
+    calls = function_calls(response)
+    if not calls:
+        return response, [response], []
+    queries = []
+    input_items = [{"role": "user", "content": request["input"]}]
+    for call in calls:
+        query = json.loads(call.arguments or "{}").get("query", "")
+        queries.append(query)
+        input_items.append({"type": "function_call", "call_id": call.call_id, "name": call.name,
+                            "arguments": call.arguments})
+        input_items.append({"type": "function_call_output", "call_id": call.call_id,
+                            "output": json.dumps(search_tool.search(query), ensure_ascii=False)})
+    follow_up = {**request, "input": input_items, "tool_choice": "none"}
+    final = await session.create(api, follow_up, labels=labels, on_delta=on_delta, budget=budget, on_discard=on_discard)
+    return final, [response, final], queries
+
+
+def create_search_tool(cache_path=None, documents=None, ttl_hours=None):
+    """以搜尋快取路徑與本機文件目錄建立 SearchTool（兩者都沒有時回傳 None）"""
+    if not cache_path and not documents:
+        return None
+    cache = None
+    if cache_path:
+        cache = SearchCache(cache_path, ttl_hours * 3600 if ttl_hours else DEFAULT_TTL_SECONDS)
+    return SearchTool(cache, documents)
+
+
+def open_search_tool_from_env():
+    """
+    依環境變數建立 SearchTool（都沒設定時回傳 None）
+
+    SEARCH_CACHE_PATH：搜尋快取 SQLite 路徑；SEARCH_CACHE_TTL_HOURS：有效時數；SEARCH_DOCS_DIR：本機文件目錄
+    """
+    ttl_hours = os.getenv("SEARCH_CACHE_TTL_HOURS")
+    return create_search_tool(os.getenv("SEARCH_CACHE_PATH"), os.getenv("SEARCH_DOCS_DIR"),
+                              float(ttl_hours) if ttl_hours else None)
+
+
+def print_search_stats(search_tool):
+    """印出搜尋快取與本機檢索的統計"""
+    stats = search_tool.stats()
+    parts = []
+    if stats["local_searches"] or stats["documents"]:
+        parts.append(f"本機檢索 {stats['local_searches']} 次（{stats['documents']} 份文件）")
+    if search_tool.cache:
+        parts.append(f"搜尋快取: 命中 {stats['hits']} / 未命中 {stats['misses']}（過期 {stats['expired']}），"
+                     f"新記錄 {stats['captured']} 筆查詢，共 {stats['entries']} 筆")
+    print(f"🔎 {'，'.join(parts)}")
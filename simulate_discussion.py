@@ -1,59 +1,118 @@
-import time
+import argparse
+import asyncio
 import os
+import time
 from datetime import datetime
 from dotenv import load_dotenv
-from openai import OpenAI
+
+import llm_backends
+from budget import Budget, BudgetExceeded, degrade_reason, describe_usage
+from claim_tracker import describe_chain, track_claims
+from context_builder import ContextBuilder
+from deadlock_detector import (DEADLOCK_ACTIONS, DeadlockDetector, deadlock_stop_round, record_deadlock,
+                               with_perturbation)
+from event_log import EventLog, prompt_cache_summary, prompt_hash, restore_state, run_config, usage_dict
+from live_transcript import LiveTranscript, latency_summary
+from metric_engine import MetricEngine
+from summary_memory import SummaryMemory
+from transcript import transcript_filename, write_transcript
+from llm_session import create_session
+from response_cache import open_cache_from_env, print_cache_stats
+from retry_policy import LLMCallFailed
+from telemetry import call_cost
+from turn_schedule import TURN_MODES, partner_rounds
 
 # 載入環境變數
 load_dotenv()
 
-# 配置 OpenAI API
-client = OpenAI(api_key=os.getenv('OPENAI_API_KEY'))
-
 # 選擇模型與參數
 MODEL_NAME = "gpt-4o-mini"  # 使用 GPT-4o mini（成本效益高且表現好）
 TEMPERATURE = 0.9  # 高溫度以增加變異性與創造性錯誤
+CONTEXT_TOKEN_BUDGET = 8000  # 對話紀錄 token 上限（20 輪約 4000 tokens，預設仍送出完整 history）
+SUMMARY_SEGMENT_ROUNDS = 10  # 摘要記憶：每段摘要涵蓋的輪數
+SUMMARY_RECENT_ROUNDS = 6  # 摘要記憶：保留原文的最近輪數
+DEGRADED_CONTEXT_BUDGET = 1500  # 用量接近上限時改送的對話紀錄 token 上限
+DEGRADED_RECENT_ROUNDS = 3  # 用量接近上限時摘要記憶保留原文的輪數
+METRICS = MetricEngine.from_rule_sets("v1")  # 簡易觀察指標（關鍵字規則見 metric_engine.RULE_SETS）
+
+def create_client(backend=None, **options):
+    """建立 LLM client（多次實驗可共用同一個 client）
+
+    預設為 OpenAI；設定 LLM_BACKEND=mock 可改用離線模擬後端。
+    """
+    return llm_backends.create_client(backend or os.getenv('LLM_BACKEND', 'openai'), **options)
+
+
+def build_request(system_prompt, conversation_history, agent_name, model=MODEL_NAME, temperature=TEMPERATURE):
+    """
+    組出一輪的 Chat Completions 請求，回傳 (request, prompt 雜湊)（即時呼叫與批次請求檔共用）
 
-def call_llm(system_prompt, conversation_history, agent_name):
+    固定的人設在前、逐輪增長的對話紀錄在後，同一位 Agent 的連續請求可共用服務端的 prompt 快取前綴。
+    """
+    user_content = f"對話紀錄：\n{conversation_history}\n\n請以 {agent_name} 的身分發言："
+    request = dict(
+        model=model,
+        messages=[
+            {"role": "system", "content": system_prompt},
+            {"role": "user", "content": user_content}
+        ],
+        temperature=temperature,
+        max_tokens=500,  # 限制長度避免冗長
+    )
+    return request, prompt_hash(system_prompt, user_content)
+
+
+async def call_llm(session, system_prompt, conversation_history, agent_name, labels=None, verbose=True, on_delta=None,
+                   record=None, budget=None, model=MODEL_NAME, temperature=TEMPERATURE, on_discard=None):
     """
     呼叫 OpenAI API 生成回應
     
     Args:
+        session: LLMSession（所有請求經由共用的 Rate Limiter 送出）
         system_prompt: Agent 的人設提示
         conversation_history: 完整對話歷史
         agent_name: 當前發言的 Agent 名稱
+        labels: 呼叫標籤（experiment_id、seed、round、agent）
+        verbose: 是否印出 token 使用量
+        on_delta: 串流文字片段的回呼（None 則等完整回應後才回傳）
+        record: 若提供 dict，寫入本次請求的 prompt 雜湊與 usage（供事件紀錄使用）
+        budget: 單次實驗的 Budget（送出前檢查估計用量）
+        model: 模型名稱
+        temperature: 取樣溫度
+        on_discard: 串流中途失敗重試前，作廢已輸出片段的回呼
     
     Returns:
         str: LLM 生成的回應文字
+    
+    Raises:
+        BudgetExceeded: 估計用量會超過上限
+        LLMCallFailed: 重試額度用完或遇到致命錯誤
     """
-    try:
-        # 使用 Chat Completions API
-        response = client.chat.completions.create(
-            model=MODEL_NAME,
-            messages=[
-                {"role": "system", "content": system_prompt},
-                {"role": "user", "content": f"對話紀錄：\n{conversation_history}\n\n請以 {agent_name} 的身分發言："}
-            ],
-            temperature=TEMPERATURE,
-            max_tokens=500,  # 限制長度避免冗長
-        )
-        
-        # 記錄 token 使用量
-        usage = response.usage
-        print(f"   [Tokens: {usage.total_tokens} (輸入: {usage.prompt_tokens}, 輸出: {usage.completion_tokens})]")
-        
-        return response.choices[0].message.content.strip()
+    request, request_hash = build_request(system_prompt, conversation_history, agent_name, model, temperature)
     
-    except Exception as e:
-        print(f"   ⚠️ API 呼叫失敗: {e}")
-        # 簡單的重試機制
-        time.sleep(5)
-        return f"[{agent_name} 因技術問題暫時失聲]"
+    # 使用 Chat Completions API
+    response = await session.create("chat", request, labels=labels, on_delta=on_delta, budget=budget,
+                                    on_discard=on_discard)
+    
+    # 記錄 token 使用量
+    usage = response.usage
+    if record is not None:
+        record["prompt_hash"] = request_hash
+        record["usage"] = usage_dict(usage)
+    if verbose:
+        if on_delta:
+            print()  # 串流輸出的回應之後換行
+        cached_tokens = usage_dict(usage)["cached_tokens"]
+        print(f"   [Tokens: {usage.total_tokens} (輸入: {usage.prompt_tokens}, 快取: {cached_tokens}, 輸出: {usage.completion_tokens})]")
+    
+    return response.choices[0].message.content.strip()
 
 
 class Agent:
     def __init__(self, name, description, style):
         self.name = name
+        self.description = description
+        self.style = style
         self.system_prompt = f"""
 你現在是 {name}。
 
@@ -92,166 +151,581 @@ agents = [
 ]
 
 # 2. 實驗參數
-topic = "討論主題：針對『草嶺崩塌地』的後續整治，我們應該採取大規模硬體工程還是自然復育？"
+topic = "針對『草嶺崩塌地』的後續整治，我們應該採取大規模硬體工程還是自然復育？"
 rounds = 20
-experiment_id = datetime.now().strftime("%Y%m%d_%H%M%S")
-
-# 3. 初始化
-history = [f"System: {topic}"]
-statistics = {
-    "hallucination_markers": [],  # 記錄可疑的「捏造事實」
-    "extreme_words": [],  # 記錄極端化用語
-    "mediator_contradictions": []  # 記錄調停者的矛盾
-}
-
-print("=" * 60)
-print(f"🔬 Multi-Agent 封閉迴圈實驗")
-print(f"📅 實驗編號: {experiment_id}")
-print(f"🤖 使用模型: {MODEL_NAME} (Temperature: {TEMPERATURE})")
-print("=" * 60)
-print(f"\n{topic}\n")
-print("=" * 60)
 
-# ========== 開始對話接龍 ==========
-for i in range(rounds):
-    current_agent = agents[i % 3]
+
+def new_run_state(experiment_id=None, rounds=rounds, seed=0, context_budget=CONTEXT_TOKEN_BUDGET,
+                  summary_memory=False, stream=False, event_log=True, budget=None, model=MODEL_NAME,
+                  temperature=TEMPERATURE, topic=topic, personas=None, turn_mode="sequential",
+                  deadlock=None):
+    """
+    建立單次實驗的獨立狀態
     
-    print(f"\n🔄 Round {i+1}/{rounds} - {current_agent.name} 發言中...")
+    每次實驗都有自己的 history 與 statistics，多個實驗可在同一個 process 內同時執行。
+    seed 為取樣序號：相同 seed 的重跑可命中回應快取，不同 replicate 應使用不同 seed。
+    context_budget 為每輪送出的對話紀錄 token 上限（None 表示不限）。
+    summary_memory 為 True 時改用分層摘要記憶（較舊的輪次壓縮成摘要，適合數百輪的長對話）。
+    stream 為 True 時以串流模式呼叫，回應邊產生邊寫入即時逐字稿 experiment_live_{experiment_id}.md。
+    event_log 為 True 時每輪完成即寫入事件紀錄 events_{experiment_id}.jsonl（可用 resume_run_state 續跑）。
+    budget 為用量上限設定（Budget 的參數：max_tokens、max_cost_usd、max_seconds、degrade_at；None 表示不限）。
+    model、temperature、topic 預設為模組常數；personas 為 {Agent 名稱: {"description": ..., "style": ...}}，
+    覆寫該 Agent 的人設或說話風格（參數掃描用，None 表示使用預設人設）。
+    turn_mode 為發言順序（見 turn_schedule）："simultaneous" 時 Engineer 與 Ecologist 以同一份對話快照同時發言。
+    deadlock 為即時死鎖偵測設定（DeadlockDetector 的參數：action、threshold、window、self_similarity…；None 表示不偵測），
+    偵測到死鎖時提前結束（action="stop"）或在下一輪加入擾動提示（action="perturb"）。
+    """
+    experiment_id = experiment_id or datetime.now().strftime("%Y%m%d_%H%M%S")
+    return {
+        "experiment_id": experiment_id,
+        "rounds": rounds,
+        "seed": seed,
+        "context_budget": context_budget,
+        "summary_memory": summary_memory,
+        "stream": stream,
+        "budget": budget,
+        "model": model,
+        "temperature": temperature,
+        "topic": topic,
+        "personas": personas,
+        "turn_mode": turn_mode,
+        "deadlock": deadlock,
+        "event_log": event_log_filename(experiment_id) if event_log else None,
+        "completed_rounds": 0,  # 已完成（含失敗略過）的最後一輪，續跑時從下一輪開始
+        "usage": {"tokens": 0, "cost_usd": 0.0},  # 已完成輪次的用量（續跑時作為用量上限的起點）
+        "history": [f"System: 討論主題：{topic}"],
+        "statistics": {
+            "hallucination_markers": [],  # 記錄可疑的「捏造事實」
+            "extreme_words": [],  # 記錄極端化用語
+            "mediator_contradictions": [],  # 記錄調停者的矛盾
+            "failures": [],  # 記錄放棄的輪次（API 失敗事件，不寫入對話）
+            "latency": [],  # 每輪的 (輪次, Agent, 首字延遲秒數, 總延遲秒數)
+            "prompt_cache": [],  # 每輪的 (輪次, Agent, input tokens, 命中 prompt 快取的 tokens)
+            "budget_events": [],  # 用量上限事件 (輪次, "degrade" 或 "stop", 說明)
+            "deadlock_events": []  # 死鎖偵測事件 (輪次, "perturb" 或 "stop", 說明)
+        },
+        "deadlock_detector": DeadlockDetector.from_config(deadlock),  # 即時死鎖偵測（None 表示不偵測）
+        "perturbation_due": False  # 已判定需要擾動、但還沒有一輪帶著擾動提示送出
+    }
+
+
+def event_log_filename(experiment_id):
+    return f"events_{experiment_id}.jsonl"
+
+
+def run_agents(state):
+    """本次實驗的 Agent（state["personas"] 有覆寫的 Agent 重新組出人設提示）"""
+    personas = state["personas"] or {}
+    return [
+        Agent(agent.name, **{"description": agent.description, "style": agent.style, **personas[agent.name]})
+        if agent.name in personas else agent
+        for agent in agents
+    ]
+
+
+def telemetry_prefix(experiment_id):
+    """呼叫遙測的匯出檔名前綴（{prefix}.csv / {prefix}.json）"""
+    return f"telemetry_{experiment_id}"
+
+
+def record_turn(state, event):
+    """把一輪的結果（turn 事件）套用到實驗狀態：加入 history 並更新觀察指標"""
+    statistics = state["statistics"]
+    round_num, agent_name, response_text = event["round"], event["agent"], event["response"]
     
-    # 組合完整 Context（這就是幻覺滾雪球的關鍵）
-    full_context = "\n".join(history)
+    # 加入歷史紀錄（成為下一輪的「真理」）
+    state["history"].append(f"{agent_name}: {response_text}")
+    if event.get("latency"):
+        statistics["latency"].append((round_num, agent_name, event["latency"]["ttft"], event["latency"]["total"]))
+    if event.get("usage"):
+        usage = event["usage"]
+        statistics["prompt_cache"].append((round_num, agent_name, usage["input_tokens"], usage.get("cached_tokens", 0)))
+        state["usage"]["tokens"] += usage["input_tokens"] + usage["output_tokens"]
+        state["usage"]["cost_usd"] += call_cost(state["model"], usage["input_tokens"], usage["output_tokens"],
+                                                usage.get("cached_tokens", 0))
     
-    # 呼叫 LLM
-    response_text = call_llm(
-        system_prompt=current_agent.system_prompt, 
-        conversation_history=full_context,
-        agent_name=current_agent.name
-    )
+    # 簡易觀察指標偵測（每輪只掃描一次）
+    hits = METRICS.scan(response_text, agent_name)
+    if "hallucination_markers" in hits:
+        statistics["hallucination_markers"].append((round_num, agent_name, response_text[:100]))
     
-    # 加入歷史紀錄（成為下一輪的「真理」）
-    formatted_response = f"{current_agent.name}: {response_text}"
-    history.append(formatted_response)
+    if "extreme_words" in hits:
+        statistics["extreme_words"].append((round_num, agent_name))
+    
+    if "mediator_contradictions" in hits:
+        statistics["mediator_contradictions"].append((round_num, response_text[:100]))
+
+    # 即時死鎖偵測（新穎度與同一 Agent 的自我相似度）
+    record_deadlock(state, event)
+
+
+def resume_run_state(experiment_id):
+    """由事件紀錄重建中斷的實驗狀態（已完成的輪次不重新呼叫 API）"""
+    return restore_state(event_log_filename(experiment_id), new_run_state, record_turn)
+
+
+def first_turn_request(state, round_index=0):
+    """
+    第一輪（或同時發言模式下與第一輪共用對話快照的夥伴輪次）的請求
+    只依賴討論主題，多個 replicate 可一次寫入批次請求檔
+
+    Args:
+        round_index: 輪次索引（0 起算）；大於 0 時須為 partner_rounds(turn_mode, 0, rounds) 中的輪次
+
+    Returns:
+        tuple: (api, request, turn)；turn 為 turn 事件中請求端的欄位，回應由 turn_from_response 補上
+    """
+    agent = run_agents(state)[round_index]
+    conversation_history = ContextBuilder(state["context_budget"], state["history"]).build()
+    request, request_hash = build_request(agent.system_prompt, conversation_history, agent.name, state["model"],
+                                          state["temperature"])
+    turn = {"round": round_index + 1, "agent": agent.name, "phase": None, "prompt_hash": request_hash,
+            "web_search": False}
+    return "chat", request, turn
+
+
+def turn_from_response(turn, response):
+    """以（批次）回應補齊 turn 事件"""
+    return {**turn, "response": response.choices[0].message.content.strip(), "usage": usage_dict(response.usage),
+            "latency": None}
+
+
+def spoken_rounds(state):
+    """history 中每則發言（不含主題）對應的輪次；失敗而略過的輪次不在 history 中"""
+    failed_rounds = {round_num for round_num, _, _ in state["statistics"]["failures"]}
+    spoken = [r for r in range(1, state["rounds"] + 1) if r not in failed_rounds]
+    return spoken[:len(state["history"]) - 1]
+
+
+# ========== 開始對話接龍 ==========
+async def run_discussion(session, state=None, verbose=True):
+    """
+    執行一次完整的對話接龍實驗
     
-    # 即時輸出
-    print(f"💬 {formatted_response}")
-    print("-" * 60)
+    Args:
+        session: LLMSession
+        state: new_run_state() 建立的實驗狀態（None 則自動建立）；
+               resume_run_state() 重建的狀態會從 completed_rounds 的下一輪繼續
+        verbose: 是否即時輸出每輪對話
     
-    # 簡易觀察指標偵測
-    if any(keyword in response_text for keyword in ["根據", "數據顯示", "研究指出", "1999年", "測量"]):
-        statistics["hallucination_markers"].append((i+1, current_agent.name, response_text[:100]))
+    Returns:
+        dict: 完成後的實驗狀態
+    """
+    if state is None:
+        state = new_run_state()
+    history = state["history"]
+    statistics = state["statistics"]
+    context = ContextBuilder(state["context_budget"], history)
+    budget = Budget.from_config(state["budget"], tokens=state["usage"]["tokens"], cost_usd=state["usage"]["cost_usd"])
+    degraded = any(action == "degrade" for _, action, _ in statistics["budget_events"])  # 續跑前已降級
+    memory = None
+    if state["summary_memory"]:
+        memory = SummaryMemory(
+            session,
+            state["model"],
+            segment_size=SUMMARY_SEGMENT_ROUNDS,
+            recent_turns=SUMMARY_RECENT_ROUNDS,
+            labels={"experiment_id": state["experiment_id"], "seed": state["seed"]},
+            budget=budget
+        )
+    stream = state["stream"]
+    transcript = LiveTranscript(
+        f"experiment_live_{state['experiment_id']}.md" if stream else None,
+        echo=stream and verbose
+    )
+    if stream and len(history) == 1:
+        transcript.write(f"# 🔴 即時逐字稿 `{state['experiment_id']}`\n\n### {history[0]}\n\n")
+    event_log = EventLog(state["event_log"]) if state["event_log"] else None
+    if event_log and event_log.is_new:
+        event_log.append("run_started", version="v1", config=run_config(state))
     
-    if any(keyword in response_text for keyword in ["必須", "絕對", "完全", "徹底", "一定"]):
-        statistics["extreme_words"].append((i+1, current_agent.name))
+    agents = run_agents(state)
     
-    if current_agent.name == "Mediator" and any(keyword in response_text for keyword in ["折衷", "結合", "同時"]):
-        statistics["mediator_contradictions"].append((i+1, response_text[:100]))
+    async def generate(i, full_context, on_delta=None, on_discard=None):
+        """送出第 i+1 輪的請求，回傳 (回應文字, call_record)；call_record 另含呼叫耗時 elapsed"""
+        agent = agents[i % 3]
+        call_record = {}
+        started = time.perf_counter()
+        response_text = await call_llm(
+            session,
+            system_prompt=agent.system_prompt, 
+            conversation_history=full_context,
+            agent_name=agent.name,
+            labels={"experiment_id": state["experiment_id"], "seed": state["seed"], "round": i+1, "agent": agent.name},
+            verbose=verbose,
+            on_delta=on_delta,
+            on_discard=on_discard,
+            record=call_record,
+            budget=budget,
+            model=state["model"],
+            temperature=state["temperature"]
+        )
+        call_record["elapsed"] = time.perf_counter() - started
+        return response_text, call_record
     
-    # 避免 Rate Limit
-    time.sleep(2)
+    pending = {}  # 同時發言模式下已與同組第一位一起送出的輪次 -> Task
+    perturbed_rounds = set()  # 帶著擾動提示送出的輪次
+    start_round = state["completed_rounds"]
+    for i in range(start_round, state["rounds"]):
+        if deadlock_stop_round(statistics) is not None:
+            break  # 對話已死鎖：剩下的輪次不再呼叫
+        current_agent = agents[i % 3]
+        # 同時發言的輪次不串流（回應依 Agent 順序寫入逐字稿）
+        simultaneous = i in pending or bool(partner_rounds(state["turn_mode"], i, state["rounds"]))
+        
+        if verbose:
+            together = "（與同組同時發言）" if simultaneous else ""
+            print(f"\n🔄 Round {i+1}/{state['rounds']} - {current_agent.name} 發言中...{together}")
+        
+        # 用量接近上限：之後的輪次改送較短的對話紀錄
+        reason = None if degraded else degrade_reason(session.budgets(budget))
+        if reason:
+            degraded = True
+            detail = f"{reason}，改送最近 {DEGRADED_CONTEXT_BUDGET} tokens 的對話紀錄"
+            statistics["budget_events"].append((i+1, "degrade", detail))
+            if event_log:
+                event_log.append("budget", round=i+1, action="degrade", detail=detail)
+            print(f"   💰 {detail}")
+        if degraded:
+            context.token_budget = min(context.token_budget or DEGRADED_CONTEXT_BUDGET, DEGRADED_CONTEXT_BUDGET)
+            if memory:
+                memory.recent_turns = min(memory.recent_turns, DEGRADED_RECENT_ROUNDS)
+        
+        try:
+            if i in pending:
+                response_text, call_record = await pending.pop(i)
+            else:
+                # 組合 Context：預算內送出完整 history（這就是幻覺滾雪球的關鍵）
+                if memory:
+                    full_context = await memory.build(history, spoken_rounds(state))
+                    context.record(memory.last_prompt_tokens)
+                else:
+                    full_context = context.build()
+                # 偵測到死鎖：這一輪（與同組發言者）的對話紀錄後加上擾動提示
+                if state["perturbation_due"]:
+                    full_context = with_perturbation(full_context)
+                    perturbed_rounds.update([i, *partner_rounds(state["turn_mode"], i, state["rounds"])])
+                # 同組的其他發言者看到同一份對話快照，請求一起送出
+                for j in partner_rounds(state["turn_mode"], i, state["rounds"]):
+                    context.record(context.last_sent_tokens)
+                    pending[j] = asyncio.ensure_future(generate(j, full_context))
+                
+                # 呼叫 LLM
+                if not simultaneous:
+                    transcript.start_turn(i+1, current_agent.name)
+                streaming = stream and not simultaneous
+                response_text, call_record = await generate(
+                    i, full_context, transcript.on_delta if streaming else None,
+                    transcript.discard_partial if streaming else None
+                )
+        except BudgetExceeded as e:
+            # 超過用量上限：不送出請求，乾淨地結束（事件紀錄保留，可提高上限後續跑）
+            statistics["budget_events"].append((i+1, "stop", str(e)))
+            if event_log:
+                event_log.append("budget", round=i+1, action="stop", limit=e.name, detail=str(e))
+            if stream:
+                if simultaneous:
+                    transcript.start_turn(i+1, current_agent.name)
+                transcript.abort_turn(e)
+            print(f"   💰 Round {i+1} 停止：{e}")
+            break
+        except LLMCallFailed as e:
+            # 放棄本輪：記錄為失敗事件，而不是寫進對話紀錄
+            statistics["failures"].append((i+1, current_agent.name, str(e)))
+            if event_log:
+                event_log.append("turn_failed", round=i+1, agent=current_agent.name, error=str(e), fatal=e.fatal)
+            if stream:
+                if simultaneous:
+                    transcript.start_turn(i+1, current_agent.name)
+                transcript.abort_turn(e)
+            print(f"   ❌ Round {i+1} {current_agent.name} 放棄: {e}")
+            if e.fatal:
+                break
+            state["completed_rounds"] = i+1
+            continue
+        
+        if simultaneous:
+            transcript.start_turn(i+1, current_agent.name)
+            transcript.on_delta(response_text)
+            transcript.end_turn()
+            ttft = total = call_record["elapsed"]  # 未串流：首字延遲即總延遲
+        else:
+            ttft, total = transcript.end_turn()
+        turn = {
+            "round": i+1,
+            "agent": current_agent.name,
+            "phase": None,
+            "prompt_hash": call_record.get("prompt_hash"),
+            "response": response_text,
+            "usage": call_record.get("usage"),
+            "web_search": False,
+            "latency": {"ttft": ttft, "total": total},
+            "perturbed": i in perturbed_rounds,
+        }
+        # 先寫入事件紀錄（fsync）再更新記憶體中的狀態
+        if event_log:
+            event_log.append("turn", **turn)
+        record_turn(state, turn)
+        context.add(history[-1])
+        state["completed_rounds"] = i+1
+        
+        # 即時輸出
+        if verbose:
+            if not stream:
+                print(f"💬 {history[-1]}")
+            print("-" * 60)
+        if statistics["deadlock_events"] and statistics["deadlock_events"][-1][0] == i+1:
+            print(f"   🧟 Round {i+1} 偵測到死鎖：{statistics['deadlock_events'][-1][2]}")
+    
+    # 提前結束時取消尚未寫入的同時發言請求（預留的用量一併釋放）
+    for task in pending.values():
+        task.cancel()
+    await asyncio.gather(*pending.values(), return_exceptions=True)
+    stop_round = deadlock_stop_round(statistics)
+    if event_log:
+        if start_round < state["rounds"] == state["completed_rounds"]:
+            event_log.append("run_finished")
+        elif stop_round is not None and start_round < stop_round:
+            event_log.append("run_finished", reason="deadlock", round=stop_round)
+        event_log.close()
+    transcript.close()
+    state["context_stats"] = context.stats()
+    if memory:
+        state["context_stats"].update(memory.stats())
+    state["telemetry"] = session.telemetry.summary(state["experiment_id"])  # 本次執行的呼叫（續跑前的呼叫不含在內）
+    if budget:
+        state["budget_usage"] = budget.usage()
+    return state
+
 
 # ========== 輸出實驗結果 ==========
-print("\n" + "=" * 60)
-print("✅ 實驗完成！正在生成分析報告...")
-print("=" * 60)
-
-# 保存完整對話紀錄
-log_filename = f"experiment_log_{experiment_id}.md"
-with open(log_filename, "w", encoding="utf-8") as f:
-    f.write(f"# 🔬 Multi-Agent 實驗對話紀錄\n\n")
-    f.write(f"## 📋 實驗資訊\n\n")
-    f.write(f"- **實驗編號**: `{experiment_id}`\n")
-    f.write(f"- **模型**: {MODEL_NAME}\n")
-    f.write(f"- **Temperature**: {TEMPERATURE}\n")
-    f.write(f"- **總輪數**: {rounds}\n")
-    f.write(f"- **主題**: {topic.replace('討論主題：', '')}\n\n")
-    f.write("---\n\n")
-    f.write("## 💬 對話內容\n\n")
+def write_experiment_log(state):
+    """保存完整對話紀錄（markdown 與同名的結構化 .jsonl），回傳 markdown 檔名"""
+    experiment_id = state["experiment_id"]
+    history = state["history"]
+    turn_rounds = spoken_rounds(state)
+    
+    log_filename = f"experiment_log_{experiment_id}.md"
+    with open(log_filename, "w", encoding="utf-8") as f:
+        f.write(f"# 🔬 Multi-Agent 實驗對話紀錄\n\n")
+        f.write(f"## 📋 實驗資訊\n\n")
+        f.write(f"- **實驗編號**: `{experiment_id}`\n")
+        f.write(f"- **模型**: {state['model']}\n")
+        f.write(f"- **Temperature**: {state['temperature']}\n")
+        f.write(f"- **總輪數**: {state['rounds']}\n")
+        f.write(f"- **發言順序**: {state['turn_mode']}\n")
+        f.write(f"- **主題**: {state['topic']}\n\n")
+        f.write("---\n\n")
+        f.write("## 💬 對話內容\n\n")
+        
+        # 格式化對話紀錄
+        for idx, line in enumerate(history):
+            if line.startswith("System:"):
+                f.write(f"### {line}\n\n")
+            elif line.startswith("Engineer:"):
+                f.write(f"### 🔧 Round {turn_rounds[idx-1]} - Engineer\n\n")
+                f.write(f"> {line.replace('Engineer: ', '')}\n\n")
+            elif line.startswith("Ecologist:"):
+                f.write(f"### 🌿 Round {turn_rounds[idx-1]} - Ecologist\n\n")
+                f.write(f"> {line.replace('Ecologist: ', '')}\n\n")
+            elif line.startswith("Mediator:"):
+                f.write(f"### 🤝 Round {turn_rounds[idx-1]} - Mediator\n\n")
+                f.write(f"> {line.replace('Mediator: ', '')}\n\n")
     
-    # 格式化對話紀錄
-    for idx, line in enumerate(history):
-        if line.startswith("System:"):
-            f.write(f"### {line}\n\n")
-        elif line.startswith("Engineer:"):
-            f.write(f"### 🔧 Round {((idx-1)//3)*3 + 1} - Engineer\n\n")
-            f.write(f"> {line.replace('Engineer: ', '')}\n\n")
-        elif line.startswith("Ecologist:"):
-            f.write(f"### 🌿 Round {((idx-1)//3)*3 + 2} - Ecologist\n\n")
-            f.write(f"> {line.replace('Ecologist: ', '')}\n\n")
-        elif line.startswith("Mediator:"):
-            f.write(f"### 🤝 Round {((idx-1)//3)*3 + 3} - Mediator\n\n")
-            f.write(f"> {line.replace('Mediator: ', '')}\n\n")
+    write_transcript(
+        transcript_filename(log_filename),
+        {"version": "v1", "experiment_id": experiment_id, "model": state["model"], "temperature": state["temperature"],
+         "rounds": state["rounds"], "topic": state["topic"], "turn_mode": state["turn_mode"]},
+        (
+            {"round": round_num, "agent": line.split(": ", 1)[0], "text": line.split(": ", 1)[1]}
+            for round_num, line in zip(turn_rounds, history[1:])
+        )
+    )
+    return log_filename
+
+
+def write_analysis_report(state):
+    """生成觀察指標報告，回傳檔名"""
+    experiment_id = state["experiment_id"]
+    statistics = state["statistics"]
     
-# 生成觀察指標報告
-report_filename = f"analysis_report_{experiment_id}.md"
-with open(report_filename, "w", encoding="utf-8") as f:
-    f.write(f"# 📊 Moltbook 現象觀察分析\n\n")
-    f.write(f"## 🔬 實驗摘要\n\n")
-    f.write(f"- **實驗編號**: `{experiment_id}`\n")
-    f.write(f"- **模型**: {MODEL_NAME} (Temperature: {TEMPERATURE})\n")
-    f.write(f"- **總輪數**: {rounds}\n\n")
-    f.write("---\n\n")
+    report_filename = f"analysis_report_{experiment_id}.md"
+    with open(report_filename, "w", encoding="utf-8") as f:
+        f.write(f"# 📊 Moltbook 現象觀察分析\n\n")
+        f.write(f"## 🔬 實驗摘要\n\n")
+        f.write(f"- **實驗編號**: `{experiment_id}`\n")
+        f.write(f"- **模型**: {state['model']} (Temperature: {state['temperature']})\n")
+        f.write(f"- **總輪數**: {state['rounds']}\n")
+        context_stats = state.get("context_stats")
+        if context_stats:
+            f.write(f"- **Context tokens**: 送出 {context_stats['prompt_tokens_sent']:,}"
+                    f"（完整 history 需 {context_stats['prompt_tokens_full']:,}，"
+                    f"節省 {context_stats['prompt_tokens_saved']:,}；預算 {context_stats['token_budget']}；"
+                    f"計數方式 {context_stats.get('token_counter', '-')}）\n")
+            if "summaries_computed" in context_stats:
+                f.write(f"- **摘要記憶**: 計算 {context_stats['summaries_computed']} 段摘要，"
+                        f"單輪最大 context {context_stats['max_prompt_tokens']:,} tokens\n")
+        latency = latency_summary(statistics.get("latency"))
+        if latency:
+            f.write(f"- **回應延遲**: 首字平均 {latency['avg_ttft']:.2f} 秒，總延遲平均 {latency['avg_total']:.2f} 秒"
+                    f"（中位數 {latency['p50_total']:.2f} 秒；最慢 Round {latency['slowest_round']} "
+                    f"{latency['slowest_agent']} {latency['slowest_total']:.2f} 秒）\n")
+        prompt_cache = prompt_cache_summary(statistics.get("prompt_cache"))
+        if prompt_cache:
+            f.write(f"- **Prompt 快取**: 輸入 {prompt_cache['input_tokens']:,} tokens 中 {prompt_cache['cached_tokens']:,} 命中快取"
+                    f"（{prompt_cache['hit_rate']:.0%}；{prompt_cache['hit_calls']}/{prompt_cache['calls']} 次呼叫命中）\n")
+        if state.get("budget_usage"):
+            f.write(f"- **用量上限**: {describe_usage(state['budget_usage'])}\n")
+        for round_num, action, detail in statistics["budget_events"]:
+            label = "降級" if action == "degrade" else "停止"
+            f.write(f"- **💰 Round {round_num} {label}**: {detail}\n")
+        for round_num, action, detail in statistics["deadlock_events"]:
+            label = "擾動" if action == "perturb" else "提前結束"
+            f.write(f"- **🧟 Round {round_num} 死鎖{label}**: {detail}\n")
+        telemetry = state.get("telemetry")
+        if telemetry and telemetry["calls"]:
+            latency = telemetry["latency"]
+            f.write(f"- **API 呼叫**: {telemetry['calls']} 次（重試 {telemetry['retries']}、失敗 {telemetry['failed']}），"
+                    f"估計費用 ${telemetry['cost_usd']:.4f}"
+                    + (f"；延遲 p50 / p95 / p99 {latency['p50']:.2f} / {latency['p95']:.2f} / {latency['p99']:.2f} 秒" if latency["p50"] is not None else "")
+                    + "\n")
+            f.write("- **各 Agent 費用**: " + "、".join(
+                f"{agent} ${summary['cost_usd']:.4f}（p95 {summary['latency']['p95'] or 0:.2f} 秒）"
+                for agent, summary in telemetry["by_agent"].items()
+            ) + "\n")
+        f.write("\n---\n\n")
+        
+        f.write("## 1️⃣ 幻覺錨定效應 (Hallucination Anchoring)\n\n")
+        f.write(f"**偵測次數**: {len(statistics['hallucination_markers'])} 次\n\n")
+        f.write("### 📌 可疑數據引用清單\n\n")
+        
+        if statistics['hallucination_markers']:
+            f.write("| 輪次 | Agent | 內容片段 |\n")
+            f.write("|------|-------|----------|\n")
+            for round_num, agent, snippet in statistics['hallucination_markers']:
+                # 清理內容避免破壞表格
+                clean_snippet = snippet.replace('\n', ' ').replace('|', '\\|')
+                f.write(f"| Round {round_num} | {agent} | {clean_snippet}... |\n")
+        else:
+            f.write("*未偵測到可疑數據引用*\n")
+        
+        f.write("\n### 🔗 數據傳播鏈\n\n")
+        chains = track_claims(
+            {"round": round_num, "agent": line.split(": ", 1)[0], "text": line.split(": ", 1)[1]}
+            for round_num, line in zip(spoken_rounds(state), state["history"][1:])
+        )
+        if chains:
+            f.write("重複出現的量化主張（數字與單位正規化後比對）：第一次提出者、之後沿用的 Agent、是否有人質疑\n\n")
+            for chain in chains:
+                f.write(f"- {describe_chain(chain)}\n")
+        else:
+            f.write("*沒有重複出現的量化主張*\n")
+        
+        f.write(f"\n---\n\n")
+        f.write("## 2️⃣ 觀點極端化 (Polarization)\n\n")
+        f.write(f"**偵測次數**: {len(statistics['extreme_words'])} 次\n\n")
+        f.write("### 🔥 極端用語分佈\n\n")
+        
+        if statistics['extreme_words']:
+            f.write("| 輪次 | Agent |\n")
+            f.write("|------|-------|\n")
+            for round_num, agent in statistics['extreme_words']:
+                f.write(f"| Round {round_num} | {agent} |\n")
+            
+            # 統計各 Agent 的極端化次數
+            f.write("\n### 📈 Agent 極端化統計\n\n")
+            agent_counts = {}
+            for _, agent in statistics['extreme_words']:
+                agent_counts[agent] = agent_counts.get(agent, 0) + 1
+            
+            f.write("| Agent | 極端用語次數 |\n")
+            f.write("|-------|--------------|\n")
+            for agent, count in sorted(agent_counts.items(), key=lambda x: x[1], reverse=True):
+                f.write(f"| {agent} | {count} |\n")
+        else:
+            f.write("*未偵測到極端用語*\n")
+        
+        f.write(f"\n---\n\n")
+        f.write("## 3️⃣ 調停者崩潰 (Mediator Collapse)\n\n")
+        f.write(f"**偵測次數**: {len(statistics['mediator_contradictions'])} 次\n\n")
+        f.write("### 🤝 折衷方案記錄\n\n")
+        
+        if statistics['mediator_contradictions']:
+            for round_num, snippet in statistics['mediator_contradictions']:
+                clean_snippet = snippet.replace('\n', ' ')
+                f.write(f"**Round {round_num}**\n> {clean_snippet}...\n\n")
+        else:
+            f.write("*未偵測到折衷方案*\n")
+        
+        if statistics['failures']:
+            f.write(f"\n---\n\n")
+            f.write("## ⚠️ API 失敗事件\n\n")
+            f.write("以下輪次在重試額度內仍呼叫失敗，已略過（不計入對話紀錄）：\n\n")
+            f.write("| 輪次 | Agent | 錯誤 |\n")
+            f.write("|------|-------|------|\n")
+            for round_num, agent, error in statistics['failures']:
+                clean_error = error.replace('\n', ' ').replace('|', '\\|')
+                f.write(f"| Round {round_num} | {agent} | {clean_error} |\n")
+        
+        f.write("\n---\n\n")
+        f.write("## 💡 觀察建議\n\n")
+        f.write("1. 🔍 **幻覺錨定**: 由「數據傳播鏈」找出未被質疑就被沿用的數據，回到原文確認如何被當作真理\n")
+        f.write("2. 📈 **極端化趨勢**: 比較前期（Round 1-5）與後期（Round 16-20）的語氣差異\n")
+        f.write("3. 🤖 **調停失效**: 檢視 Mediator 是否創造了不存在的技術或矛盾方案\n")
+        f.write("4. 🔄 **回音室效應**: 觀察錯誤資訊如何在封閉迴圈中被強化\n")
     
-    f.write("## 1️⃣ 幻覺錨定效應 (Hallucination Anchoring)\n\n")
-    f.write(f"**偵測次數**: {len(statistics['hallucination_markers'])} 次\n\n")
-    f.write("### 📌 可疑數據引用清單\n\n")
+    return report_filename
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Multi-Agent 封閉迴圈實驗（v1）")
+    parser.add_argument("--resume", metavar="EXPERIMENT_ID", help="由事件紀錄續跑中斷的實驗")
+    parser.add_argument("--turn-mode", choices=TURN_MODES, default="sequential",
+                        help="發言順序：sequential 逐輪發言；simultaneous 每一循環中 Engineer 與 Ecologist 同時發言")
+    parser.add_argument("--deadlock", choices=DEADLOCK_ACTIONS,
+                        help="即時死鎖偵測：stop 提前結束；perturb 在下一輪加入擾動提示（預設不偵測）")
+    args = parser.parse_args()
     
-    if statistics['hallucination_markers']:
-        f.write("| 輪次 | Agent | 內容片段 |\n")
-        f.write("|------|-------|----------|\n")
-        for round_num, agent, snippet in statistics['hallucination_markers']:
-            # 清理內容避免破壞表格
-            clean_snippet = snippet.replace('\n', ' ').replace('|', '\\|')
-            f.write(f"| Round {round_num} | {agent} | {clean_snippet}... |\n")
+    if args.resume:
+        state = resume_run_state(args.resume)
     else:
-        f.write("*未偵測到可疑數據引用*\n")
+        state = new_run_state(stream=True, turn_mode=args.turn_mode,
+                              deadlock={"action": args.deadlock} if args.deadlock else None)
     
-    f.write(f"\n---\n\n")
-    f.write("## 2️⃣ 觀點極端化 (Polarization)\n\n")
-    f.write(f"**偵測次數**: {len(statistics['extreme_words'])} 次\n\n")
-    f.write("### 🔥 極端用語分佈\n\n")
+    print("=" * 60)
+    print(f"🔬 Multi-Agent 封閉迴圈實驗")
+    print(f"📅 實驗編號: {state['experiment_id']}")
+    if args.resume:
+        print(f"⏯️ 續跑：已完成 {state['completed_rounds']}/{state['rounds']} 輪，從 Round {state['completed_rounds'] + 1} 繼續")
+    print(f"🤖 使用模型: {state['model']} (Temperature: {state['temperature']})")
+    print("=" * 60)
+    print(f"\n討論主題：{state['topic']}\n")
+    print("=" * 60)
     
-    if statistics['extreme_words']:
-        f.write("| 輪次 | Agent |\n")
-        f.write("|------|-------|\n")
-        for round_num, agent in statistics['extreme_words']:
-            f.write(f"| Round {round_num} | {agent} |\n")
-        
-        # 統計各 Agent 的極端化次數
-        f.write("\n### 📈 Agent 極端化統計\n\n")
-        agent_counts = {}
-        for _, agent in statistics['extreme_words']:
-            agent_counts[agent] = agent_counts.get(agent, 0) + 1
-        
-        f.write("| Agent | 極端用語次數 |\n")
-        f.write("|-------|--------------|\n")
-        for agent, count in sorted(agent_counts.items(), key=lambda x: x[1], reverse=True):
-            f.write(f"| {agent} | {count} |\n")
-    else:
-        f.write("*未偵測到極端用語*\n")
+    cache = open_cache_from_env()
+    session = create_session(create_client(), cache=cache)
+    asyncio.run(run_discussion(session, state))
     
-    f.write(f"\n---\n\n")
-    f.write("## 3️⃣ 調停者崩潰 (Mediator Collapse)\n\n")
-    f.write(f"**偵測次數**: {len(statistics['mediator_contradictions'])} 次\n\n")
-    f.write("### 🤝 折衷方案記錄\n\n")
+    print("\n" + "=" * 60)
+    print("✅ 實驗完成！正在生成分析報告...")
+    print("=" * 60)
     
-    if statistics['mediator_contradictions']:
-        for round_num, snippet in statistics['mediator_contradictions']:
-            clean_snippet = snippet.replace('\n', ' ')
-            f.write(f"**Round {round_num}**\n> {clean_snippet}...\n\n")
-    else:
-        f.write("*未偵測到折衷方案*\n")
+    log_filename = write_experiment_log(state)
+    report_filename = write_analysis_report(state)
     
-    f.write("\n---\n\n")
-    f.write("## 💡 觀察建議\n\n")
-    f.write("1. 🔍 **幻覺錨定**: 搜尋第一次出現的具體數據，追蹤後續如何被當作真理\n")
-    f.write("2. 📈 **極端化趨勢**: 比較前期（Round 1-5）與後期（Round 16-20）的語氣差異\n")
-    f.write("3. 🤖 **調停失效**: 檢視 Mediator 是否創造了不存在的技術或矛盾方案\n")
-    f.write("4. 🔄 **回音室效應**: 觀察錯誤資訊如何在封閉迴圈中被強化\n")
-
-print(f"\n📄 完整對話紀錄已保存: {log_filename}")
-print(f"📊 分析報告已保存: {report_filename}")
-print("\n💡 建議審閱重點：")
-print("   1. 搜尋日誌中第一次出現的「具體數據」")
-print("   2. 觀察後續輪次是否將這些數據視為真理")
-print("   3. 比較第 1-5 輪與第 16-20 輪的語氣差異")
-print("   4. 檢視 Mediator 是否創造了不存在的技術")
+    print(f"\n🔴 即時逐字稿: experiment_live_{state['experiment_id']}.md")
+    print(f"📄 完整對話紀錄已保存: {log_filename}")
+    print(f"📊 分析報告已保存: {report_filename}")
+    telemetry_files = session.telemetry.export(telemetry_prefix(state["experiment_id"]), state["experiment_id"])
+    print(f"📈 呼叫遙測: {' / '.join(telemetry_files)}")
+    if cache:
+        print_cache_stats(cache)
+    print("\n💡 建議審閱重點：")
+    print("   1. 搜尋日誌中第一次出現的「具體數據」")
+    print("   2. 觀察後續輪次是否將這些數據視為真理")
+    print("   3. 比較第 1-5 輪與第 16-20 輪的語氣差異")
+    print("   4. 檢視 Mediator 是否創造了不存在的技術")
+
+
+if __name__ == "__main__":
+    main()
@@ -16,37 +16,64 @@ v2.3 核心改進（基於 v2.2）：
 - 維持對話流暢度（不過度嚴格）
 """
 
-import time
+import argparse
+import asyncio
 import os
+import time
 from datetime import datetime
 from dotenv import load_dotenv
-from openai import OpenAI
+
+import llm_backends
+from budget import Budget, BudgetExceeded, degrade_reason, describe_usage
+from context_builder import ContextBuilder
+from deadlock_detector import (DEADLOCK_ACTIONS, DeadlockDetector, deadlock_stop_round, record_deadlock,
+                               with_perturbation)
+from event_log import EventLog, prompt_cache_summary, prompt_hash, restore_state, run_config, usage_dict
+from live_transcript import LiveTranscript, latency_summary
+from metric_engine import MetricEngine
+from near_duplicate import NearDuplicateIndex
+from summary_memory import SummaryMemory
+from transcript import transcript_filename, write_transcript
+from llm_session import create_session
+from response_cache import open_cache_from_env, print_cache_stats
+from retry_policy import LLMCallFailed
+from search_tools import SEARCH_BACKENDS, SEARCH_TOOL, open_search_tool_from_env, print_search_stats, run_search_calls
+from telemetry import call_cost
+from turn_schedule import TURN_MODES, partner_rounds
 
 load_dotenv()
-client = OpenAI(api_key=os.getenv('OPENAI_API_KEY'))
 
 MODEL_NAME = "gpt-4o-mini"
 TEMPERATURE = 0.5  # 稍提高增加多樣性
+CONTEXT_TOKEN_BUDGET = 2500  # 對話紀錄 token 上限（約等於最近 8 輪，依實際長度調整視窗）
+SUMMARY_SEGMENT_ROUNDS = 10  # 摘要記憶：每段摘要涵蓋的輪數
+SUMMARY_RECENT_ROUNDS = 6  # 摘要記憶：保留原文的最近輪數
+DEGRADED_CONTEXT_BUDGET = 1000  # 用量接近上限時改送的對話紀錄 token 上限（同時關閉 web_search）
+DEGRADED_RECENT_ROUNDS = 3  # 用量接近上限時摘要記憶保留原文的輪數
+FORBIDDEN_POINTS = 8  # 每輪 prompt 列出的「禁止重複」重點數
+METRICS = MetricEngine.from_rule_sets("v2")  # 質疑 / 提問偵測（關鍵字規則見 metric_engine.RULE_SETS）
 
-# ========== 追蹤已討論內容（避免重複的關鍵）==========
-discussed_points = []  # 已討論的重點
 
+def create_client(backend=None, **options):
+    """建立 LLM client（多次實驗可共用同一個 client）
+
+    預設為 OpenAI；設定 LLM_BACKEND=mock 可改用離線模擬後端。
+    """
+    return llm_backends.create_client(backend or os.getenv('LLM_BACKEND', 'openai'), **options)
 
-def call_llm(system_prompt, conversation_history, agent_name, phase_instruction="", round_num=1):
-    """呼叫 OpenAI Responses API（含 Web Search）"""
-    try:
-        # 組合「已討論內容」提醒（避免重複的關鍵）
-        already_discussed = ""
-        if discussed_points and round_num > 1:  # 從 Round 2 開始就要檢查
-            already_discussed = "\n\n【🚫 禁止重複 - 以下內容已討論，你必須提出「完全不同」的新觀點】\n"
-            for point in discussed_points[-8:]:
-                already_discussed += f"  ❌ 已說過：{point}\n"
-            already_discussed += "\n⚠️ 如果你重複上述任何內容，你的發言將被視為無效！"
-        
-        user_content = f"""{system_prompt}
-{already_discussed}
-===== 對話紀錄（最近幾輪）=====
-{conversation_history}
+
+def build_request(system_prompt, conversation_history, agent_name, phase_instruction="", round_num=1,
+                  discussed_points=None, web_search=True, model=MODEL_NAME, temperature=TEMPERATURE,
+                  search_backend="web"):
+    """
+    組出一輪的 Responses API 請求，回傳 (request, prompt 雜湊)（即時呼叫與批次請求檔共用）
+
+    為了命中服務端的 prompt 快取，固定不變的部分（人設、階段指令、發言規則）放在 instructions，
+    每輪會變的對話紀錄與「禁止重複」清單放在 input 的最後。
+    web_search 為 False 時不提供搜尋工具（用量接近上限時的降級模式）；
+    search_backend 為 "local" 時以 function-call 工具 search（本機檢索，見 search_tools）取代 web_search。
+    """
+    instructions = f"""{system_prompt}
 
 【當前階段指令】
 {phase_instruction}
@@ -56,32 +83,85 @@ def call_llm(system_prompt, conversation_history, agent_name, phase_instruction=
 ⚠️ 不要複述前面已經說過的內容！
 ⚠️ 回應長度控制在 3-6 句話。
 """
-        
-        response = client.responses.create(
-            model=MODEL_NAME,
-            tools=[{"type": "web_search"}],
-            input=user_content,
-            temperature=TEMPERATURE,
-        )
-        
-        used_web_search = False
-        if hasattr(response, 'output') and response.output:
-            for item in response.output:
-                if hasattr(item, 'type') and item.type == 'web_search_call':
-                    used_web_search = True
-                    break
-        
-        if hasattr(response, 'usage') and response.usage:
-            usage = response.usage
-            search_indicator = " 🔍" if used_web_search else ""
-            print(f"   [Tokens: {usage.total_tokens}]{search_indicator}")
-        
-        return response.output_text.strip(), used_web_search
+    # 組合「已討論內容」提醒（避免重複的關鍵）
+    already_discussed = ""
+    if discussed_points and round_num > 1:  # 從 Round 2 開始就要檢查
+        already_discussed = "\n\n【🚫 禁止重複 - 以下內容已討論，你必須提出「完全不同」的新觀點】\n"
+        for point in discussed_points[-FORBIDDEN_POINTS:]:
+            already_discussed += f"  ❌ 已說過：{point}\n"
+        already_discussed += "\n⚠️ 如果你重複上述任何內容，你的發言將被視為無效！"
     
-    except Exception as e:
-        print(f"   ⚠️ API 呼叫失敗: {e}")
-        time.sleep(5)
-        return f"[{agent_name} 因技術問題暫時失聲]", False
+    user_content = f"""===== 對話紀錄（最近幾輪）=====
+{conversation_history}
+{already_discussed}
+"""
+    request = dict(
+        model=model,
+        tools=[SEARCH_TOOL if search_backend == "local" else {"type": "web_search"}],
+        instructions=instructions,
+        input=user_content,
+        temperature=temperature,
+    )
+    if not web_search:
+        del request["tools"]
+    return request, prompt_hash(instructions, user_content)
+
+
+def used_web_search(response):
+    """回應中是否有 web_search_call"""
+    if hasattr(response, 'output') and response.output:
+        for item in response.output:
+            if hasattr(item, 'type') and item.type == 'web_search_call':
+                return True
+    return False
+
+
+async def call_llm(session, system_prompt, conversation_history, agent_name, phase_instruction="", round_num=1,
+                   discussed_points=None, labels=None, verbose=True, on_delta=None, record=None, budget=None,
+                   web_search=True, model=MODEL_NAME, temperature=TEMPERATURE, search_backend="web", on_discard=None):
+    """呼叫 OpenAI Responses API（含 Web Search）
+
+    discussed_points 為本輪要列入「禁止重複」的已討論重點（由 run_discussion 依相關度挑選）。
+    指定 on_delta 時以串流模式呼叫，文字片段一產生就回呼 on_delta；串流中途失敗重試前以 on_discard 作廢已輸出的片段。
+    record 若為 dict，寫入本次請求的 prompt 雜湊與 usage（供事件紀錄使用）。
+    budget 為單次實驗的 Budget，估計用量會超過上限時拋出 BudgetExceeded（不送出請求）；
+    web_search 為 False 時不提供搜尋工具；model、temperature 預設為模組常數。
+    search_backend 為 "local" 時由 session.search_tool 回答 search 工具的查詢，再送出一次請求取得回應
+    （record 的 usage 為兩次請求的合計）；"web" 時把 web_search 的查詢與引用記錄到 session.search_tool。
+    重試額度用完或遇到致命錯誤時拋出 LLMCallFailed。
+    """
+    request, request_hash = build_request(system_prompt, conversation_history, agent_name, phase_instruction,
+                                          round_num, discussed_points, web_search, model, temperature, search_backend)
+    response = await session.create("responses", request, labels=labels, on_delta=on_delta, budget=budget,
+                                    on_discard=on_discard)
+    
+    if search_backend == "local":
+        response, responses, queries = await run_search_calls(session, "responses", request, response,
+                                                              session.search_tool, labels, on_delta, budget,
+                                                              on_discard)
+        used_search = bool(queries)
+    else:
+        responses = [response]
+        used_search = used_web_search(response)
+        if used_search and session.search_tool:
+            session.search_tool.capture(response)
+    
+    usage = None
+    for part in responses:
+        part_usage = usage_dict(getattr(part, "usage", None))
+        if part_usage:
+            usage = {key: (usage or {}).get(key, 0) + value for key, value in part_usage.items()}
+    if record is not None:
+        record["prompt_hash"] = request_hash
+        record["usage"] = usage
+    
+    if verbose and usage:
+        search_indicator = " 🔍" if used_search else ""
+        if on_delta:
+            print()  # 串流輸出的回應之後換行
+        print(f"   [Tokens: {usage['total_tokens']} (快取: {usage['cached_tokens']})]{search_indicator}")
+    
+    return response.output_text.strip(), used_search
 
 
 # ========== Agent 定義（有明確立場差異）==========
@@ -267,6 +347,16 @@ Facilitator 請整理：
 ]
 
 
+def phase_for_round(round_num):
+    """取得該輪所屬的討論階段（超過預設輪數時停留在最後一個階段）"""
+    accumulated = 0
+    for phase in DISCUSSION_PHASES:
+        accumulated += phase["rounds"]
+        if round_num <= accumulated:
+            return phase
+    return DISCUSSION_PHASES[-1]
+
+
 def extract_key_point(text):
     """從回應中提取關鍵點（用於追蹤已討論內容）"""
     # 簡化版：取前60字作為摘要
@@ -280,169 +370,611 @@ def extract_key_point(text):
 
 topic = "草嶺崩塌地的後續整治，應採取大規模硬體工程還是自然復育？"
 total_rounds = 20
-experiment_id = datetime.now().strftime("%Y%m%d_%H%M%S")
-
-history = [f"System: 討論主題：{topic}"]
-statistics = {
-    "web_searches": [],
-    "disagreements": [],
-    "questions": []
-}
-
-print("=" * 70)
-print(f"🔬 Multi-Agent 實驗 v2.2 - 多樣性增強版")
-print("=" * 70)
-print(f"📅 實驗編號: {experiment_id}")
-print(f"🤖 模型: {MODEL_NAME} (Temperature: {TEMPERATURE})")
-print(f"🔍 工具: Web Search enabled")
-print("=" * 70)
-print(f"\n主題：{topic}\n")
-print("=" * 70)
 
-# ========== 開始對話 ==========
-current_phase_name = ""
-agents = AGENT_CONFIGS
 
-for i in range(total_rounds):
-    current_agent = agents[i % 3]
-    round_num = i + 1
-    
-    # 取得當前階段
-    accumulated = 0
-    current_phase = DISCUSSION_PHASES[-1]
-    for phase in DISCUSSION_PHASES:
-        accumulated += phase["rounds"]
-        if round_num <= accumulated:
-            current_phase = phase
-            break
-    
-    # 階段轉換提示
-    if current_phase["name"] != current_phase_name:
-        current_phase_name = current_phase["name"]
-        print(f"\n{'='*70}")
-        print(f"📍 進入【{current_phase_name}】")
-        print(f"{'='*70}")
-    
-    print(f"\n🔄 Round {round_num}/20 - {current_agent['name']} 發言中...")
-    
-    # 只保留最近 8 輪對話（避免 context 太長）
-    recent_history = history[-8:] if len(history) > 8 else history
-    full_context = "\n".join(recent_history)
-    
-    response_text, used_search = call_llm(
-        system_prompt=current_agent["system_prompt"],
-        conversation_history=full_context,
-        agent_name=current_agent["name"],
-        phase_instruction=current_phase["instruction"],
-        round_num=round_num
-    )
-    
+def new_run_state(experiment_id=None, rounds=total_rounds, seed=0, context_budget=CONTEXT_TOKEN_BUDGET,
+                  summary_memory=False, stream=False, event_log=True, budget=None, model=MODEL_NAME,
+                  temperature=TEMPERATURE, topic=topic, personas=None, turn_mode="sequential",
+                  search_backend="web", deadlock=None):
+    """
+    建立單次實驗的獨立狀態
+
+    每次實驗都有自己的 history、statistics 與 discussed_points，
+    多個實驗可在同一個 process 內同時執行而互不干擾。
+    seed 為取樣序號：相同 seed 的重跑可命中回應快取，不同 replicate 應使用不同 seed。
+    context_budget 為每輪送出的對話紀錄 token 上限（None 表示不限）。
+    summary_memory 為 True 時改用分層摘要記憶（較舊的輪次壓縮成摘要，早期的說法不會被視窗截掉）。
+    stream 為 True 時以串流模式呼叫，回應邊產生邊寫入即時逐字稿 experiment_v2_live_{experiment_id}.md。
+    event_log 為 True 時每輪完成即寫入事件紀錄 events_v2_{experiment_id}.jsonl（可用 resume_run_state 續跑）。
+    budget 為用量上限設定（Budget 的參數：max_tokens、max_cost_usd、max_seconds、degrade_at；None 表示不限）。
+    model、temperature、topic 預設為模組常數；personas 為 {Agent 名稱: {"system_prompt": ...}}，
+    覆寫該 Agent 的人設提示（參數掃描用，None 表示使用 AGENT_CONFIGS）。
+    turn_mode 為發言順序（見 turn_schedule）："simultaneous" 時 Engineer 與 Ecologist 以同一份對話快照同時發言。
+    search_backend 為搜尋方式："web" 使用 web_search 工具；"local" 以 session.search_tool 的本機檢索回答（見 search_tools）。
+    deadlock 為即時死鎖偵測設定（DeadlockDetector 的參數：action、threshold、window、self_similarity…；None 表示不偵測），
+    偵測到死鎖時提前結束（action="stop"）或在下一輪加入擾動提示（action="perturb"）。
+    """
+    experiment_id = experiment_id or datetime.now().strftime("%Y%m%d_%H%M%S")
+    return {
+        "experiment_id": experiment_id,
+        "rounds": rounds,
+        "seed": seed,
+        "context_budget": context_budget,
+        "summary_memory": summary_memory,
+        "stream": stream,
+        "budget": budget,
+        "model": model,
+        "temperature": temperature,
+        "topic": topic,
+        "personas": personas,
+        "turn_mode": turn_mode,
+        "search_backend": search_backend,
+        "deadlock": deadlock,
+        "event_log": event_log_filename(experiment_id) if event_log else None,
+        "completed_rounds": 0,  # 已完成（含失敗略過）的最後一輪，續跑時從下一輪開始
+        "usage": {"tokens": 0, "cost_usd": 0.0},  # 已完成輪次的用量（續跑時作為用量上限的起點）
+        "history": [f"System: 討論主題：{topic}"],
+        "statistics": {
+            "web_searches": [],
+            "disagreements": [],
+            "questions": [],
+            "failures": [],  # 放棄的輪次（API 失敗事件，不寫入對話）
+            "latency": [],  # 每輪的 (輪次, Agent, 首字延遲秒數, 總延遲秒數)
+            "prompt_cache": [],  # 每輪的 (輪次, Agent, input tokens, 命中 prompt 快取的 tokens)
+            "repeats": [],  # 近似重複的發言 (輪次, Agent, 被重複的輪次, 估計相似度)
+            "budget_events": [],  # 用量上限事件 (輪次, "degrade" 或 "stop", 說明)
+            "deadlock_events": []  # 死鎖偵測事件 (輪次, "perturb" 或 "stop", 說明)
+        },
+        "discussed_points": [],  # 已討論的重點（近似重複的發言不再加入）
+        "point_index": NearDuplicateIndex(),  # 所有發言的 MinHash / LSH 索引
+        "deadlock_detector": DeadlockDetector.from_config(deadlock),  # 即時死鎖偵測（None 表示不偵測）
+        "perturbation_due": False  # 已判定需要擾動、但還沒有一輪帶著擾動提示送出
+    }
+
+
+def event_log_filename(experiment_id):
+    return f"events_v2_{experiment_id}.jsonl"
+
+
+def run_agents(state):
+    """本次實驗的 Agent 設定（套用 state["personas"] 的覆寫）"""
+    personas = state["personas"] or {}
+    return [{**config, **personas.get(config["name"], {})} for config in AGENT_CONFIGS]
+
+
+def telemetry_prefix(experiment_id):
+    """呼叫遙測的匯出檔名前綴（{prefix}.csv / {prefix}.json）"""
+    return f"telemetry_v2_{experiment_id}"
+
+
+def record_turn(state, event):
+    """把一輪的結果（turn 事件）套用到實驗狀態：加入 history、更新統計與已討論清單"""
+    statistics = state["statistics"]
+    discussed_points = state["discussed_points"]
+    round_num, agent_name, response_text = event["round"], event["agent"], event["response"]
+
+    if event.get("latency"):
+        statistics["latency"].append((round_num, agent_name, event["latency"]["ttft"], event["latency"]["total"]))
+    if event.get("usage"):
+        usage = event["usage"]
+        statistics["prompt_cache"].append((round_num, agent_name, usage["input_tokens"], usage.get("cached_tokens", 0)))
+        state["usage"]["tokens"] += usage["input_tokens"] + usage["output_tokens"]
+        state["usage"]["cost_usd"] += call_cost(state["model"], usage["input_tokens"], usage["output_tokens"],
+                                                usage.get("cached_tokens", 0),
+                                                1 if event["web_search"] and state["search_backend"] == "web" else 0)
+
     # 記錄統計
-    if used_search:
-        statistics["web_searches"].append((round_num, current_agent["name"]))
+    if event["web_search"]:
+        statistics["web_searches"].append((round_num, agent_name))
     
-    # 偵測不同意/質疑
-    disagreement_keywords = ["但是", "然而", "不同意", "質疑", "問題是", "忽略了", "不認為", "擔心", "風險"]
-    if any(word in response_text for word in disagreement_keywords):
-        statistics["disagreements"].append((round_num, current_agent["name"]))
+    # 偵測不同意/質疑與提問（每輪只掃描一次）
+    hits = METRICS.scan(response_text, agent_name)
+    if "disagreements" in hits:
+        statistics["disagreements"].append((round_num, agent_name))
     
-    # 偵測問題
-    if "？" in response_text or "?" in response_text:
-        statistics["questions"].append((round_num, current_agent["name"]))
+    if "questions" in hits:
+        statistics["questions"].append((round_num, agent_name))
     
-    # 更新已討論清單（關鍵：避免後續重複）
+    # 更新已討論清單（關鍵：避免後續重複）；換句話說的發言記為重複，不再加入清單
     key_point = extract_key_point(response_text)
-    if key_point and key_point not in discussed_points:
+    duplicate = state["point_index"].add(response_text, round_num, agent_name, key_point)
+    if duplicate:
+        earlier, similarity = duplicate
+        statistics["repeats"].append((round_num, agent_name, earlier["round"], round(similarity, 2)))
+    elif key_point:
         discussed_points.append(key_point)
     
-    # 加入歷史
-    formatted_response = f"{current_agent['name']}: {response_text}"
-    history.append(formatted_response)
-    
-    print(f"💬 {formatted_response}")
-    print("-" * 70)
+    # 即時死鎖偵測（新穎度與同一 Agent 的自我相似度）
+    record_deadlock(state, event)
     
-    time.sleep(2)
+    # 加入歷史
+    state["history"].append(f"{agent_name}: {response_text}")
+
+
+def resume_run_state(experiment_id):
+    """由事件紀錄重建中斷的實驗狀態（已完成的輪次不重新呼叫 API）"""
+    return restore_state(event_log_filename(experiment_id), new_run_state, record_turn)
+
+
+def first_turn_request(state, round_index=0):
+    """
+    第一輪（或同時發言模式下與第一輪共用對話快照的夥伴輪次）的請求
+    只依賴討論主題，多個 replicate 可一次寫入批次請求檔
+
+    Args:
+        round_index: 輪次索引（0 起算）；大於 0 時須為 partner_rounds(turn_mode, 0, rounds) 中的輪次
+
+    Returns:
+        tuple: (api, request, turn)；turn 為 turn 事件中請求端的欄位，回應由 turn_from_response 補上
+    """
+    agent = run_agents(state)[round_index]
+    phase = phase_for_round(round_index + 1)
+    conversation_history = ContextBuilder(state["context_budget"], state["history"]).build()
+    # 批次處理無法回答 function call：本機檢索模式的第一輪不提供搜尋工具
+    request, request_hash = build_request(agent["system_prompt"], conversation_history, agent["name"],
+                                          phase["instruction"], round_index + 1,
+                                          web_search=state["search_backend"] == "web",
+                                          model=state["model"], temperature=state["temperature"])
+    turn = {"round": round_index + 1, "agent": agent["name"], "phase": phase["name"], "prompt_hash": request_hash}
+    return "responses", request, turn
+
+
+def turn_from_response(turn, response):
+    """以（批次）回應補齊 turn 事件"""
+    return {**turn, "response": response.output_text.strip(), "usage": usage_dict(getattr(response, "usage", None)),
+            "web_search": used_web_search(response), "latency": None}
+
+
+def spoken_rounds(state):
+    """history 中每則發言（不含主題）對應的輪次；失敗而略過的輪次不在 history 中"""
+    failed_rounds = {round_num for round_num, _, _ in state["statistics"]["failures"]}
+    spoken = [r for r in range(1, state["rounds"] + 1) if r not in failed_rounds]
+    return spoken[:len(state["history"]) - 1]
+
+
+# ========== 開始對話 ==========
+async def run_discussion(session, state=None, verbose=True):
+    """
+    執行一次完整的四階段討論
+
+    Args:
+        session: LLMSession
+        state: new_run_state() 建立的實驗狀態（None 則自動建立）；
+               resume_run_state() 重建的狀態會從 completed_rounds 的下一輪繼續
+        verbose: 是否即時輸出每輪對話
+
+    Returns:
+        dict: 完成後的實驗狀態
+    """
+    if state is None:
+        state = new_run_state()
+    history = state["history"]
+    statistics = state["statistics"]
+    context = ContextBuilder(state["context_budget"], history)
+    budget = Budget.from_config(state["budget"], tokens=state["usage"]["tokens"], cost_usd=state["usage"]["cost_usd"])
+    degraded = any(action == "degrade" for _, action, _ in statistics["budget_events"])  # 續跑前已降級
+    memory = None
+    if state["summary_memory"]:
+        memory = SummaryMemory(
+            session,
+            state["model"],
+            segment_size=SUMMARY_SEGMENT_ROUNDS,
+            recent_turns=SUMMARY_RECENT_ROUNDS,
+            labels={"experiment_id": state["experiment_id"], "seed": state["seed"]},
+            budget=budget
+        )
+
+    stream = state["stream"]
+    transcript = LiveTranscript(
+        f"experiment_v2_live_{state['experiment_id']}.md" if stream else None,
+        echo=stream and verbose
+    )
+    if stream and len(history) == 1:
+        transcript.write(f"# 🔴 即時逐字稿 v2 `{state['experiment_id']}`\n\n### {history[0]}\n\n")
+    event_log = EventLog(state["event_log"]) if state["event_log"] else None
+    if event_log and event_log.is_new:
+        event_log.append("run_started", version="v2", config=run_config(state))
+
+    if state["search_backend"] == "local" and session.search_tool is None:
+        raise ValueError("search_backend=\"local\" 需要 session.search_tool（搜尋快取或本機文件目錄）")
+    current_phase_name = ""
+    agents = run_agents(state)
+
+    async def generate(i, full_context, on_delta=None, on_discard=None):
+        """送出第 i+1 輪的請求，回傳 (回應文字, 是否使用 web_search, call_record)；call_record 另含呼叫耗時 elapsed"""
+        agent = agents[i % 3]
+        phase = phase_for_round(i + 1)
+        call_record = {}
+        started = time.perf_counter()
+        response_text, used_search = await call_llm(
+            session,
+            system_prompt=agent["system_prompt"],
+            conversation_history=full_context,
+            agent_name=agent["name"],
+            phase_instruction=phase["instruction"],
+            round_num=i + 1,
+            # 與最近對話最相關的已討論重點（最可能被換句話說的內容），而非最近幾輪
+            discussed_points=state["point_index"].relevant_points("\n".join(history[-2:]), FORBIDDEN_POINTS),
+            labels={
+                "experiment_id": state["experiment_id"],
+                "seed": state["seed"],
+                "round": i + 1,
+                "agent": agent["name"],
+                "phase": phase["name"]
+            },
+            verbose=verbose,
+            on_delta=on_delta,
+            on_discard=on_discard,
+            record=call_record,
+            budget=budget,
+            web_search=not degraded,
+            model=state["model"],
+            temperature=state["temperature"],
+            search_backend=state["search_backend"]
+        )
+        call_record["elapsed"] = time.perf_counter() - started
+        return response_text, used_search, call_record
+
+    pending = {}  # 同時發言模式下已與同組第一位一起送出的輪次 -> Task
+    perturbed_rounds = set()  # 帶著擾動提示送出的輪次
+    start_round = state["completed_rounds"]
+    for i in range(start_round, state["rounds"]):
+        if deadlock_stop_round(statistics) is not None:
+            break  # 對話已死鎖：剩下的輪次不再呼叫
+        current_agent = agents[i % 3]
+        round_num = i + 1
+        # 同時發言的輪次不串流（回應依 Agent 順序寫入逐字稿）
+        simultaneous = i in pending or bool(partner_rounds(state["turn_mode"], i, state["rounds"]))
+        
+        # 取得當前階段
+        current_phase = phase_for_round(round_num)
+        
+        # 階段轉換提示
+        if current_phase["name"] != current_phase_name:
+            current_phase_name = current_phase["name"]
+            if verbose:
+                print(f"\n{'='*70}")
+                print(f"📍 進入【{current_phase_name}】")
+                print(f"{'='*70}")
+        
+        if verbose:
+            together = "（與同組同時發言）" if simultaneous else ""
+            print(f"\n🔄 Round {round_num}/{state['rounds']} - {current_agent['name']} 發言中...{together}")
+        
+        # 用量接近上限：之後的輪次關閉 web_search 並改送較短的對話紀錄
+        reason = None if degraded else degrade_reason(session.budgets(budget))
+        if reason:
+            degraded = True
+            detail = f"{reason}，關閉 web_search 並改送最近 {DEGRADED_CONTEXT_BUDGET} tokens 的對話紀錄"
+            statistics["budget_events"].append((round_num, "degrade", detail))
+            if event_log:
+                event_log.append("budget", round=round_num, action="degrade", detail=detail)
+            print(f"   💰 {detail}")
+        if degraded:
+            context.token_budget = min(context.token_budget or DEGRADED_CONTEXT_BUDGET, DEGRADED_CONTEXT_BUDGET)
+            if memory:
+                memory.recent_turns = min(memory.recent_turns, DEGRADED_RECENT_ROUNDS)
+        
+        try:
+            if i in pending:
+                response_text, used_search, call_record = await pending.pop(i)
+            else:
+                # 依 token 預算保留最近的對話（避免 context 太長），或以摘要記憶壓縮較早的輪次
+                if memory:
+                    full_context = await memory.build(history, spoken_rounds(state))
+                    context.record(memory.last_prompt_tokens)
+                else:
+                    full_context = context.build()
+                # 偵測到死鎖：這一輪（與同組發言者）的對話紀錄後加上擾動提示
+                if state["perturbation_due"]:
+                    full_context = with_perturbation(full_context)
+                    perturbed_rounds.update([i, *partner_rounds(state["turn_mode"], i, state["rounds"])])
+                # 同組的其他發言者看到同一份對話快照，請求一起送出
+                for j in partner_rounds(state["turn_mode"], i, state["rounds"]):
+                    context.record(context.last_sent_tokens)
+                    pending[j] = asyncio.ensure_future(generate(j, full_context))
+                
+                if not simultaneous:
+                    transcript.start_turn(round_num, current_agent["name"])
+                streaming = stream and not simultaneous
+                response_text, used_search, call_record = await generate(
+                    i, full_context, transcript.on_delta if streaming else None,
+                    transcript.discard_partial if streaming else None
+                )
+        except BudgetExceeded as e:
+            # 超過用量上限：不送出請求，乾淨地結束（事件紀錄保留，可提高上限後續跑）
+            statistics["budget_events"].append((round_num, "stop", str(e)))
+            if event_log:
+                event_log.append("budget", round=round_num, action="stop", limit=e.name, detail=str(e))
+            if stream:
+                if simultaneous:
+                    transcript.start_turn(round_num, current_agent["name"])
+                transcript.abort_turn(e)
+            print(f"   💰 Round {round_num} 停止：{e}")
+            break
+        except LLMCallFailed as e:
+            # 放棄本輪：記錄為失敗事件，而不是寫進對話紀錄
+            statistics["failures"].append((round_num, current_agent["name"], str(e)))
+            if event_log:
+                event_log.append("turn_failed", round=round_num, agent=current_agent["name"], error=str(e), fatal=e.fatal)
+            if stream:
+                if simultaneous:
+                    transcript.start_turn(round_num, current_agent["name"])
+                transcript.abort_turn(e)
+            print(f"   ❌ Round {round_num} {current_agent['name']} 放棄: {e}")
+            if e.fatal:
+                break
+            state["completed_rounds"] = round_num
+            continue
+        
+        if simultaneous:
+            transcript.start_turn(round_num, current_agent["name"])
+            transcript.on_delta(response_text)
+            transcript.end_turn()
+            ttft = total = call_record["elapsed"]  # 未串流：首字延遲即總延遲
+        else:
+            ttft, total = transcript.end_turn()
+        turn = {
+            "round": round_num,
+            "agent": current_agent["name"],
+            "phase": current_phase["name"],
+            "prompt_hash": call_record.get("prompt_hash"),
+            "response": response_text,
+            "usage": call_record.get("usage"),
+            "web_search": used_search,
+            "latency": {"ttft": ttft, "total": total},
+            "perturbed": i in perturbed_rounds,
+        }
+        # 先寫入事件紀錄（fsync）再更新記憶體中的狀態
+        if event_log:
+            event_log.append("turn", **turn)
+        record_turn(state, turn)
+        context.add(history[-1])
+        state["completed_rounds"] = round_num
+        
+        if verbose:
+            if not stream:
+                print(f"💬 {history[-1]}")
+            print("-" * 70)
+        if statistics["deadlock_events"] and statistics["deadlock_events"][-1][0] == round_num:
+            print(f"   🧟 Round {round_num} 偵測到死鎖：{statistics['deadlock_events'][-1][2]}")
+
+    # 提前結束時取消尚未寫入的同時發言請求（預留的用量一併釋放）
+    for task in pending.values():
+        task.cancel()
+    await asyncio.gather(*pending.values(), return_exceptions=True)
+    stop_round = deadlock_stop_round(statistics)
+    if event_log:
+        if start_round < state["rounds"] == state["completed_rounds"]:
+            event_log.append("run_finished")
+        elif stop_round is not None and start_round < stop_round:
+            event_log.append("run_finished", reason="deadlock", round=stop_round)
+        event_log.close()
+    transcript.close()
+    state["context_stats"] = context.stats()
+    if memory:
+        state["context_stats"].update(memory.stats())
+    state["telemetry"] = session.telemetry.summary(state["experiment_id"])  # 本次執行的呼叫（續跑前的呼叫不含在內）
+    if budget:
+        state["budget_usage"] = budget.usage()
+    return state
+
 
 # ========== 輸出結果 ==========
-print("\n" + "=" * 70)
-print("✅ v2.2 實驗完成！")
-print("=" * 70)
-
-# 保存對話紀錄
-log_filename = f"experiment_v2_log_{experiment_id}.md"
-with open(log_filename, "w", encoding="utf-8") as f:
-    f.write(f"# 🔬 Multi-Agent 實驗 v2.2 對話紀錄\n\n")
-    f.write(f"## 📋 實驗資訊\n\n")
-    f.write(f"- **版本**: v2.2 (多樣性增強版)\n")
-    f.write(f"- **實驗編號**: `{experiment_id}`\n")
-    f.write(f"- **模型**: {MODEL_NAME} (Temperature: {TEMPERATURE})\n")
-    f.write(f"- **總輪數**: {total_rounds}\n")
-    f.write(f"- **Web Search 次數**: {len(statistics['web_searches'])}\n")
-    f.write(f"- **質疑/不同意次數**: {len(statistics['disagreements'])}\n")
-    f.write(f"- **提問次數**: {len(statistics['questions'])}\n\n")
-    
-    f.write("### v2.2 設計重點\n\n")
-    f.write("1. **角色立場分明** - Engineer 偏工程派，Ecologist 偏生態派\n")
-    f.write("2. **動態避免重複** - 每輪注入「已討論清單」提醒\n")
-    f.write("3. **階段問題導向** - 每階段有明確不同的討論焦點\n")
-    f.write("4. **鼓勵辯論** - 質疑階段明確要求提出不同意見\n")
-    f.write("5. **Web Search** - 即時查證，不預設答案\n\n")
-    
-    f.write("---\n\n## 💬 對話內容\n\n")
-    
-    current_phase = ""
-    round_counter = 0
-    
-    for line in history:
-        if line.startswith("System:"):
-            f.write(f"### 📌 {line}\n\n")
+def write_experiment_log(state):
+    """保存對話紀錄（markdown 與同名的結構化 .jsonl），回傳 markdown 檔名"""
+    experiment_id = state["experiment_id"]
+    history = state["history"]
+    statistics = state["statistics"]
+
+    log_filename = f"experiment_v2_log_{experiment_id}.md"
+    with open(log_filename, "w", encoding="utf-8") as f:
+        f.write(f"# 🔬 Multi-Agent 實驗 v2.2 對話紀錄\n\n")
+        f.write(f"## 📋 實驗資訊\n\n")
+        f.write(f"- **版本**: v2.2 (多樣性增強版)\n")
+        f.write(f"- **實驗編號**: `{experiment_id}`\n")
+        f.write(f"- **模型**: {state['model']} (Temperature: {state['temperature']})\n")
+        f.write(f"- **總輪數**: {state['rounds']}\n")
+        f.write(f"- **發言順序**: {state['turn_mode']}\n")
+        f.write(f"- **搜尋方式**: {'本機檢索' if state['search_backend'] == 'local' else 'Web Search'}\n")
+        f.write(f"- **Web Search 次數**: {len(statistics['web_searches'])}\n")
+        f.write(f"- **質疑/不同意次數**: {len(statistics['disagreements'])}\n")
+        f.write(f"- **提問次數**: {len(statistics['questions'])}\n\n")
+        
+        f.write("### v2.2 設計重點\n\n")
+        f.write("1. **角色立場分明** - Engineer 偏工程派，Ecologist 偏生態派\n")
+        f.write("2. **動態避免重複** - 每輪注入「已討論清單」提醒\n")
+        f.write("3. **階段問題導向** - 每階段有明確不同的討論焦點\n")
+        f.write("4. **鼓勵辯論** - 質疑階段明確要求提出不同意見\n")
+        f.write("5. **Web Search** - 即時查證，不預設答案\n\n")
+        
+        f.write("---\n\n## 💬 對話內容\n\n")
+        
+        current_phase = ""
+        # 失敗的輪次不在 history 中，依序對應實際有發言的輪次
+        turn_rounds = iter(spoken_rounds(state))
+        
+        for line in history:
+            if line.startswith("System:"):
+                f.write(f"### 📌 {line}\n\n")
+            else:
+                round_counter = next(turn_rounds)
+                
+                accumulated = 0
+                for phase in DISCUSSION_PHASES:
+                    accumulated += phase["rounds"]
+                    if round_counter <= accumulated:
+                        if phase["name"] != current_phase:
+                            current_phase = phase["name"]
+                            f.write(f"\n---\n\n## 📍 {current_phase}\n\n")
+                        break
+                
+                agent_name = line.split(":")[0]
+                content = line.split(":", 1)[1].strip() if ":" in line else line
+                
+                emoji = {"Engineer": "🔧", "Ecologist": "🌿", "Facilitator": "🎯"}.get(agent_name, "💬")
+                f.write(f"### {emoji} Round {round_counter} - {agent_name}\n\n")
+                f.write(f"> {content}\n\n")
+
+    searched_rounds = {round_num for round_num, _ in statistics["web_searches"]}
+    write_transcript(
+        transcript_filename(log_filename),
+        {"version": "v2", "experiment_id": experiment_id, "model": state["model"], "temperature": state["temperature"],
+         "rounds": state["rounds"], "topic": state["topic"], "turn_mode": state["turn_mode"],
+         "search_backend": state["search_backend"]},
+        (
+            {
+                "round": round_num,
+                "agent": line.split(": ", 1)[0],
+                "phase": phase_for_round(round_num)["name"],
+                "text": line.split(": ", 1)[1],
+                "web_search": round_num in searched_rounds,
+            }
+            for round_num, line in zip(spoken_rounds(state), history[1:])
+        )
+    )
+    return log_filename
+
+
+def write_analysis_report(state):
+    """生成分析報告，回傳檔名"""
+    statistics = state["statistics"]
+
+    report_filename = f"analysis_v2_report_{state['experiment_id']}.md"
+    with open(report_filename, "w", encoding="utf-8") as f:
+        f.write(f"# 📊 v2.2 實驗分析報告\n\n")
+        f.write(f"## 統計摘要\n\n")
+        f.write(f"| 指標 | 數值 |\n")
+        f.write(f"|------|------|\n")
+        f.write(f"| Web Search 次數 | {len(statistics['web_searches'])} |\n")
+        f.write(f"| 質疑/不同意 | {len(statistics['disagreements'])} |\n")
+        f.write(f"| 提問次數 | {len(statistics['questions'])} |\n")
+        f.write(f"| 近似重複發言 | {len(statistics['repeats'])} |\n")
+        f.write(f"| API 失敗輪次 | {len(statistics['failures'])} |\n")
+        context_stats = state.get("context_stats")
+        if context_stats:
+            f.write(f"| Context tokens（送出 / 完整 history） | {context_stats['prompt_tokens_sent']:,} / {context_stats['prompt_tokens_full']:,} |\n")
+            f.write(f"| Context token 計數方式 | {context_stats.get('token_counter', '-')} |\n")
+            if "summaries_computed" in context_stats:
+                f.write(f"| 摘要記憶（摘要段數 / 單輪最大 context tokens） | {context_stats['summaries_computed']} / {context_stats['max_prompt_tokens']:,} |\n")
+        latency = latency_summary(statistics.get("latency"))
+        if latency:
+            f.write(f"| 首字延遲（平均 / 中位數） | {latency['avg_ttft']:.2f} 秒 / {latency['p50_ttft']:.2f} 秒 |\n")
+            f.write(f"| 總延遲（平均 / 中位數） | {latency['avg_total']:.2f} 秒 / {latency['p50_total']:.2f} 秒 |\n")
+            f.write(f"| 最慢輪次 | Round {latency['slowest_round']} {latency['slowest_agent']}（{latency['slowest_total']:.2f} 秒） |\n")
+        prompt_cache = prompt_cache_summary(statistics.get("prompt_cache"))
+        if prompt_cache:
+            f.write(f"| Prompt 快取（命中 tokens / 輸入 tokens） | {prompt_cache['cached_tokens']:,} / {prompt_cache['input_tokens']:,}"
+                    f"（{prompt_cache['hit_rate']:.0%}；{prompt_cache['hit_calls']}/{prompt_cache['calls']} 次呼叫命中） |\n")
+        telemetry = state.get("telemetry")
+        if telemetry and telemetry["calls"]:
+            latency = telemetry["latency"]
+            f.write(f"| API 呼叫（次數 / 重試 / 失敗） | {telemetry['calls']} / {telemetry['retries']} / {telemetry['failed']} |\n")
+            f.write(f"| 估計費用（含 Web Search） | ${telemetry['cost_usd']:.4f} |\n")
+            if latency["p50"] is not None:
+                f.write(f"| 呼叫延遲（p50 / p95 / p99） | {latency['p50']:.2f} / {latency['p95']:.2f} / {latency['p99']:.2f} 秒 |\n")
+            for phase, summary in telemetry["by_phase"].items():
+                f.write(f"| 費用 - {phase} | ${summary['cost_usd']:.4f}（{summary['calls']} 次，p95 {summary['latency']['p95'] or 0:.2f} 秒） |\n")
+        if state.get("budget_usage"):
+            f.write(f"| 用量上限 | {describe_usage(state['budget_usage'])} |\n")
+        f.write("\n")
+        
+        f.write("## Web Search 使用記錄\n\n")
+        if statistics["web_searches"]:
+            for round_num, agent in statistics["web_searches"]:
+                f.write(f"- Round {round_num}: {agent} 🔍\n")
         else:
-            round_counter += 1
-            
-            accumulated = 0
-            for phase in DISCUSSION_PHASES:
-                accumulated += phase["rounds"]
-                if round_counter <= accumulated:
-                    if phase["name"] != current_phase:
-                        current_phase = phase["name"]
-                        f.write(f"\n---\n\n## 📍 {current_phase}\n\n")
-                    break
-            
-            agent_name = line.split(":")[0]
-            content = line.split(":", 1)[1].strip() if ":" in line else line
-            
-            emoji = {"Engineer": "🔧", "Ecologist": "🌿", "Facilitator": "🎯"}.get(agent_name, "💬")
-            f.write(f"### {emoji} Round {round_counter} - {agent_name}\n\n")
-            f.write(f"> {content}\n\n")
-
-# 分析報告
-report_filename = f"analysis_v2_report_{experiment_id}.md"
-with open(report_filename, "w", encoding="utf-8") as f:
-    f.write(f"# 📊 v2.2 實驗分析報告\n\n")
-    f.write(f"## 統計摘要\n\n")
-    f.write(f"| 指標 | 數值 |\n")
-    f.write(f"|------|------|\n")
-    f.write(f"| Web Search 次數 | {len(statistics['web_searches'])} |\n")
-    f.write(f"| 質疑/不同意 | {len(statistics['disagreements'])} |\n")
-    f.write(f"| 提問次數 | {len(statistics['questions'])} |\n\n")
-    
-    f.write("## Web Search 使用記錄\n\n")
-    if statistics["web_searches"]:
-        for round_num, agent in statistics["web_searches"]:
-            f.write(f"- Round {round_num}: {agent} 🔍\n")
-    else:
-        f.write("- 無搜尋記錄\n")
-    
-    f.write("\n## 質疑/辯論記錄\n\n")
-    if statistics["disagreements"]:
-        for round_num, agent in statistics["disagreements"]:
-            f.write(f"- Round {round_num}: {agent} 提出不同意見\n")
+            f.write("- 無搜尋記錄\n")
+        
+        f.write("\n## 質疑/辯論記錄\n\n")
+        if statistics["disagreements"]:
+            for round_num, agent in statistics["disagreements"]:
+                f.write(f"- Round {round_num}: {agent} 提出不同意見\n")
+        else:
+            f.write("- 無質疑記錄\n")
+        
+        f.write("\n## 近似重複發言（MinHash 估計相似度）\n\n")
+        if statistics["repeats"]:
+            for round_num, agent, earlier_round, similarity in statistics["repeats"]:
+                f.write(f"- Round {round_num}: {agent} 近似重複 Round {earlier_round}（相似度 {similarity:.2f}）\n")
+        else:
+            f.write("- 無近似重複\n")
+        
+        if statistics["budget_events"]:
+            f.write("\n## 💰 用量上限事件\n\n")
+            for round_num, action, detail in statistics["budget_events"]:
+                f.write(f"- Round {round_num}: {'降級' if action == 'degrade' else '停止'}（{detail}）\n")
+        
+        if statistics["deadlock_events"]:
+            f.write("\n## 🧟 死鎖偵測事件\n\n")
+            for round_num, action, detail in statistics["deadlock_events"]:
+                f.write(f"- Round {round_num}: {'擾動' if action == 'perturb' else '提前結束'}（{detail}）\n")
+        
+        if statistics["failures"]:
+            f.write("\n## ⚠️ API 失敗事件\n\n")
+            for round_num, agent, error in statistics["failures"]:
+                f.write(f"- Round {round_num}: {agent} 呼叫失敗已略過（{error}）\n")
+
+    return report_filename
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Multi-Agent 實驗 v2（含 Web Search）")
+    parser.add_argument("--resume", metavar="EXPERIMENT_ID", help="由事件紀錄續跑中斷的實驗")
+    parser.add_argument("--turn-mode", choices=TURN_MODES, default="sequential",
+                        help="發言順序：sequential 逐輪發言；simultaneous 每一循環中 Engineer 與 Ecologist 同時發言")
+    parser.add_argument("--search", choices=SEARCH_BACKENDS, default="web",
+                        help="搜尋方式：web 使用 web_search；local 以本機檢索回答（需設定 SEARCH_CACHE_PATH 或 SEARCH_DOCS_DIR）")
+    parser.add_argument("--deadlock", choices=DEADLOCK_ACTIONS,
+                        help="即時死鎖偵測：stop 提前結束；perturb 在下一輪加入擾動提示（預設不偵測）")
+    args = parser.parse_args()
+
+    if args.resume:
+        state = resume_run_state(args.resume)
     else:
-        f.write("- 無質疑記錄\n")
-
-print(f"\n📄 對話紀錄: {log_filename}")
-print(f"📊 分析報告: {report_filename}")
-print(f"\n🔍 Web Search: {len(statistics['web_searches'])} 次")
-print(f"⚔️ 質疑/辯論: {len(statistics['disagreements'])} 次")
-print(f"❓ 提問: {len(statistics['questions'])} 次")
+        state = new_run_state(stream=True, turn_mode=args.turn_mode, search_backend=args.search,
+                              deadlock={"action": args.deadlock} if args.deadlock else None)
+    search_tool = open_search_tool_from_env()
+    if state["search_backend"] == "local" and search_tool is None:
+        parser.error("本機檢索需要設定 SEARCH_CACHE_PATH 或 SEARCH_DOCS_DIR")
+    statistics = state["statistics"]
+
+    print("=" * 70)
+    print(f"🔬 Multi-Agent 實驗 v2.2 - 多樣性增強版")
+    print("=" * 70)
+    print(f"📅 實驗編號: {state['experiment_id']}")
+    if args.resume:
+        print(f"⏯️ 續跑：已完成 {state['completed_rounds']}/{state['rounds']} 輪，從 Round {state['completed_rounds'] + 1} 繼續")
+    print(f"🤖 模型: {state['model']} (Temperature: {state['temperature']})")
+    print(f"🔍 工具: {'本機檢索（search function call）' if state['search_backend'] == 'local' else 'Web Search enabled'}")
+    print("=" * 70)
+    print(f"\n主題：{state['topic']}\n")
+    print("=" * 70)
+
+    cache = open_cache_from_env()
+    session = create_session(create_client(), cache=cache, search_tool=search_tool)
+    asyncio.run(run_discussion(session, state))
+
+    print("\n" + "=" * 70)
+    print("✅ v2.2 實驗完成！")
+    print("=" * 70)
+
+    log_filename = write_experiment_log(state)
+    report_filename = write_analysis_report(state)
+
+    print(f"\n🔴 即時逐字稿: experiment_v2_live_{state['experiment_id']}.md")
+    print(f"📄 對話紀錄: {log_filename}")
+    print(f"📊 分析報告: {report_filename}")
+    telemetry_files = session.telemetry.export(telemetry_prefix(state["experiment_id"]), state["experiment_id"])
+    print(f"📈 呼叫遙測: {' / '.join(telemetry_files)}")
+    print(f"\n🔍 {'本機檢索' if state['search_backend'] == 'local' else 'Web Search'}: {len(statistics['web_searches'])} 次")
+    print(f"⚔️ 質疑/辯論: {len(statistics['disagreements'])} 次")
+    print(f"❓ 提問: {len(statistics['questions'])} 次")
+    if cache:
+        print_cache_stats(cache)
+    if search_tool:
+        print_search_stats(search_tool)
+
+
+if __name__ == "__main__":
+    main()
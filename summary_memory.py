@@ -0,0 +1,136 @@
+"""
+分層摘要記憶（長對話用）
+較舊的對話每 segment_size 輪壓縮成一段摘要，摘要數量過多時再向上合併成更高層摘要；
+prompt 由「主題 + 各層摘要 + 最近幾輪原文」組成，讓每輪 prompt 長度維持有界，
+同時保留早期出現的具體數據與引用，仍可觀察長距離的幻覺錨定。
+"""
+import hashlib
+
+from context_builder import count_tokens
+
+SUMMARY_SYSTEM_PROMPT = """你是會議紀錄員，負責把多人討論壓縮成摘要。
+
+摘要規則：
+1. 保留每位發言者的核心立場
+2. 逐字保留所有具體數據、年份、單位、百分比與引用的文獻或來源名稱，並標明是誰提出的
+3. 記錄誰質疑了誰的說法
+4. 不要加入任何原文沒有的資訊，不要評論真偽
+5. 以條列式輸出，控制在 {max_tokens} tokens 以內"""
+
+
+def _content_hash(text):
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+class SummaryMemory:
+    """
+    分層摘要記憶
+
+    每段摘要以內容雜湊快取：history 只會往後追加，已完成的段落不會改變，
+    因此每段只摘要一次；段落內容改變（例如續跑時重建）才會重新計算。
+
+    Args:
+        session: LLMSession（摘要也經由共用的限流、重試與快取）
+        model: 摘要用的模型
+        segment_size: 每段摘要涵蓋的輪數
+        recent_turns: 保留原文的最近輪數
+        fanout: 同一層摘要超過此數量時，最舊的 fanout 段合併為上一層
+        max_summary_tokens: 每段摘要的輸出上限
+        labels: 摘要呼叫的標籤（experiment_id、seed 等）
+        budget: 單次實驗的 Budget（摘要呼叫也計入實驗用量）
+    """
+
+    def __init__(self, session, model, segment_size=10, recent_turns=6, fanout=4, max_summary_tokens=300, labels=None,
+                 budget=None):
+        self.session = session
+        self.model = model
+        self.segment_size = segment_size
+        self.recent_turns = recent_turns
+        self.fanout = fanout
+        self.max_summary_tokens = max_summary_tokens
+        self.labels = labels or {}
+        self.budget = budget
+        self.summaries = {}  # 內容雜湊 -> 摘要
+        self.summaries_computed = 0
+        self.summary_cache_hits = 0
+        self.last_prompt_tokens = 0
+        self.max_prompt_tokens = 0
+
+    async def _summarize(self, text, level, first_round, last_round):
+        key = _content_hash(f"{level}\n{text}")
+        if key in self.summaries:
+            self.summary_cache_hits += 1
+            return self.summaries[key]
+        instruction = "以下是討論的原文紀錄" if level == 1 else "以下是多段較早討論的摘要，請合併成一段"
+        response = await self.session.create("chat", dict(
+            model=self.model,
+            messages=[
+                {"role": "system", "content": SUMMARY_SYSTEM_PROMPT.format(max_tokens=self.max_summary_tokens)},
+                {"role": "user", "content": f"{instruction}（Round {first_round}-{last_round}）：\n{text}"}
+            ],
+            temperature=0.0,
+            max_tokens=self.max_summary_tokens,
+        ), labels={**self.labels, "agent": "Summarizer", "round": last_round}, budget=self.budget)
+        summary = response.choices[0].message.content.strip()
+        self.summaries[key] = summary
+        self.summaries_computed += 1
+        return summary
+
+    async def build(self, lines, rounds=None):
+        """
+        組出 prompt 用的對話紀錄
+
+        Args:
+            lines: history（第一行為討論主題）
+            rounds: 每一行（不含主題）對應的輪次，None 則依序編號
+        """
+        if not lines:
+            return ""
+        topic, turns = lines[0], lines[1:]
+        rounds = rounds or list(range(1, len(turns) + 1))
+        older_count = max(0, len(turns) - self.recent_turns)
+        segment_count = older_count // self.segment_size
+        summarized_count = segment_count * self.segment_size
+
+        # 第一層：每 segment_size 輪原文一段摘要
+        level = []
+        for s in range(segment_count):
+            start, end = s * self.segment_size, (s + 1) * self.segment_size
+            text = "\n".join(turns[start:end])
+            summary = await self._summarize(text, 1, rounds[start], rounds[end - 1])
+            level.append((rounds[start], rounds[end - 1], summary))
+
+        # 往上合併：同一層超過 fanout 段時，把最舊的完整組合併為上一層
+        layers = []
+        depth = 1
+        while len(level) > self.fanout:
+            group_count = (len(level) - 1) // self.fanout
+            merged = []
+            for g in range(group_count):
+                group = level[g * self.fanout:(g + 1) * self.fanout]
+                text = "\n\n".join(f"(Round {a}-{b})\n{summary}" for a, b, summary in group)
+                merged.append((group[0][0], group[-1][1], await self._summarize(text, depth + 1, group[0][0], group[-1][1])))
+            layers.insert(0, level[group_count * self.fanout:])
+            level = merged
+            depth += 1
+        layers.insert(0, level)
+
+        parts = [topic]
+        summaries = [entry for layer in layers for entry in layer]
+        if summaries:
+            parts.append("【較早討論摘要】")
+            parts.extend(f"(Round {a}-{b}) {summary}" for a, b, summary in summaries)
+            parts.append("【最近對話】")
+        parts.extend(turns[summarized_count:])
+        context = "\n".join(parts)
+        self.last_prompt_tokens = count_tokens(context)
+        self.max_prompt_tokens = max(self.max_prompt_tokens, self.last_prompt_tokens)
+        return context
+
+    def stats(self):
+        """回傳摘要計算次數與單輪最大 context token 數"""
+        return {
+            "summaries_computed": self.summaries_computed,
+            "summary_cache_hits": self.summary_cache_hits,
+            "max_prompt_tokens": self.max_prompt_tokens,
+        }
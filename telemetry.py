@@ -0,0 +1,214 @@
+"""
+LLM 呼叫遙測
+LLMSession 每完成（或放棄）一次呼叫就記錄一筆：延遲、input/output/cached tokens、依模型計算的費用、
+重試次數、web_search 次數與標籤（experiment_id、round、agent、phase）。
+可匯出每次實驗的 CSV / JSON（含 p50 / p95 / p99 摘要）與 Prometheus 文字格式，
+用來找出拖慢延遲或推高費用的 Agent、階段與 prompt。
+"""
+import csv
+import json
+import math
+import time
+
+from event_log import usage_dict
+
+# 每百萬 tokens 的美元價格（cached_input 為命中 prompt 快取的輸入價格）
+MODEL_PRICES = {
+    "gpt-4o-mini": {"input": 0.15, "cached_input": 0.075, "output": 0.60},
+    "gpt-4o": {"input": 2.50, "cached_input": 1.25, "output": 10.00},
+}
+WEB_SEARCH_PRICE = 0.025  # 每次 web_search 工具呼叫的美元價格
+LABEL_KEYS = ("experiment_id", "seed", "round", "agent", "phase")
+RECORD_FIELDS = (
+    "time", "api", "model", *LABEL_KEYS, "status", "latency", "attempts", "retries", "cache_hit",
+    "input_tokens", "output_tokens", "cached_tokens", "web_searches", "cost_usd", "error",
+)
+PERCENTILES = (50, 95, 99)
+
+
+def register_model_price(model, input_price, output_price, cached_input_price=None):
+    """註冊模型價格（每百萬 tokens 美元）"""
+    MODEL_PRICES[model] = {
+        "input": input_price,
+        "cached_input": input_price if cached_input_price is None else cached_input_price,
+        "output": output_price,
+    }
+
+
+def model_prices(model):
+    """模型價格；帶日期的模型名稱（如 gpt-4o-mini-2024-07-18）對應到最長的已知前綴，未知模型回傳 None"""
+    if model in MODEL_PRICES:
+        return MODEL_PRICES[model]
+    matches = [name for name in MODEL_PRICES if model and model.startswith(name)]
+    return MODEL_PRICES[max(matches, key=len)] if matches else None
+
+
+def call_cost(model, input_tokens, output_tokens, cached_tokens=0, web_searches=0):
+    """一次呼叫的美元費用（未知模型只計 web_search 費用）"""
+    cost = web_searches * WEB_SEARCH_PRICE
+    prices = model_prices(model)
+    if prices:
+        cost += ((input_tokens - cached_tokens) * prices["input"]
+                 + cached_tokens * prices["cached_input"]
+                 + output_tokens * prices["output"]) / 1_000_000
+    return cost
+
+
+def count_web_searches(response):
+    """Responses API 回應中的 web_search_call 數"""
+    return sum(1 for item in getattr(response, "output", None) or [] if getattr(item, "type", None) == "web_search_call")
+
+
+def percentile(values, p):
+    """nearest-rank 百分位數（沒有值時回傳 None）"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[max(math.ceil(p / 100 * len(ordered)) - 1, 0)]
+
+
+def summarize_records(records):
+    """彙整多筆呼叫紀錄：次數、tokens、費用與延遲百分位數"""
+    latencies = [record["latency"] for record in records if record["status"] == "ok" and not record["cache_hit"]]
+    summary = {
+        "calls": len(records),
+        "failed": sum(1 for record in records if record["status"] != "ok"),
+        "cache_hits": sum(1 for record in records if record["cache_hit"]),
+        "retries": sum(record["retries"] for record in records),
+        "web_searches": sum(record["web_searches"] for record in records),
+        "input_tokens": sum(record["input_tokens"] for record in records),
+        "output_tokens": sum(record["output_tokens"] for record in records),
+        "cached_tokens": sum(record["cached_tokens"] for record in records),
+        "cost_usd": round(sum(record["cost_usd"] for record in records), 6),
+        "latency": {f"p{p}": percentile(latencies, p) for p in PERCENTILES},
+    }
+    summary["latency"]["max"] = max(latencies) if latencies else None
+    return summary
+
+
+class Telemetry:
+    """
+    呼叫紀錄收集器（多個實驗共用同一個 LLMSession 時也共用同一個 Telemetry）
+
+    每筆紀錄是一個 dict（欄位見 RECORD_FIELDS）；records(experiment_id) 可取出單次實驗的紀錄。
+    """
+
+    def __init__(self):
+        self._records = []
+
+    def record(self, api, request, labels, started, attempts, response=None, cache_hit=False, error=None):
+        """記錄一次呼叫（started 為 time.perf_counter() 的開始時間；成功時傳入 response，放棄時傳入 error）"""
+        usage = usage_dict(getattr(response, "usage", None)) or {}
+        web_searches = count_web_searches(response) if response is not None and not cache_hit else 0
+        model = request.get("model")
+        input_tokens = usage.get("input_tokens", 0)
+        output_tokens = usage.get("output_tokens", 0)
+        cached_tokens = usage.get("cached_tokens", 0)
+        entry = {
+            "time": time.time(),  # 完成（或放棄）的時間
+            "api": api,
+            "model": model,
+            **{key: labels.get(key) for key in LABEL_KEYS},
+            "status": "ok" if error is None else "failed",
+            "latency": time.perf_counter() - started if not cache_hit else 0.0,
+            "attempts": attempts,
+            "retries": max(attempts - 1, 0),
+            "cache_hit": cache_hit,
+            "input_tokens": input_tokens,
+            "output_tokens": output_tokens,
+            "cached_tokens": cached_tokens,
+            "web_searches": web_searches,
+            # 回應快取命中不需付費
+            "cost_usd": 0.0 if cache_hit else call_cost(model, input_tokens, output_tokens, cached_tokens, web_searches),
+            "error": None if error is None else str(error),
+        }
+        self._records.append(entry)
+        return entry
+
+    def records(self, experiment_id=None):
+        """所有紀錄，或指定實驗的紀錄"""
+        if experiment_id is None:
+            return list(self._records)
+        return [record for record in self._records if record["experiment_id"] == experiment_id]
+
+    def summary(self, experiment_id=None):
+        """整體摘要，以及依 Agent、階段分組的摘要"""
+        records = self.records(experiment_id)
+        summary = summarize_records(records)
+        for key in ("agent", "phase"):
+            groups = {}
+            for record in records:
+                if record[key] is not None:
+                    groups.setdefault(record[key], []).append(record)
+            summary[f"by_{key}"] = {name: summarize_records(group) for name, group in groups.items()}
+        return summary
+
+    def write_csv(self, path, experiment_id=None):
+        """每次呼叫一行的 CSV"""
+        with open(path, "w", encoding="utf-8", newline="") as f:
+            writer = csv.DictWriter(f, fieldnames=RECORD_FIELDS)
+            writer.writeheader()
+            writer.writerows(self.records(experiment_id))
+        return path
+
+    def write_json(self, path, experiment_id=None):
+        """摘要與所有呼叫紀錄的 JSON"""
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump({"summary": self.summary(experiment_id), "calls": self.records(experiment_id)}, f,
+                      ensure_ascii=False, indent=2)
+        return path
+
+    def export(self, prefix, experiment_id=None):
+        """寫出 {prefix}.csv 與 {prefix}.json，回傳檔名"""
+        return self.write_csv(f"{prefix}.csv", experiment_id), self.write_json(f"{prefix}.json", experiment_id)
+
+    def write_prometheus(self, path):
+        """
+        Prometheus 文字格式（可由 node_exporter 的 textfile collector 收集）
+
+        依 model / agent / phase 分組輸出呼叫數、tokens、費用與延遲 summary（quantile 0.5 / 0.95 / 0.99）。
+        """
+        groups = {}
+        for record in self._records:
+            key = (record["model"] or "", record["agent"] or "", record["phase"] or "")
+            groups.setdefault(key, []).append(record)
+
+        def labels(key, **extra):
+            pairs = dict(zip(("model", "agent", "phase"), key), **extra)
+            return "{" + ",".join(f'{name}="{_escape_label(value)}"' for name, value in pairs.items()) + "}"
+
+        lines = []
+
+        def metric(name, kind, help_text, samples):
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            lines.extend(f"{name}{sample_labels} {value}" for sample_labels, value in samples)
+
+        summaries = {key: summarize_records(records) for key, records in groups.items()}
+        metric("llm_calls_total", "counter", "LLM calls", [(labels(k), s["calls"]) for k, s in summaries.items()])
+        metric("llm_failed_calls_total", "counter", "LLM calls given up after retries",
+               [(labels(k), s["failed"]) for k, s in summaries.items()])
+        metric("llm_retries_total", "counter", "LLM call retries", [(labels(k), s["retries"]) for k, s in summaries.items()])
+        metric("llm_web_searches_total", "counter", "web_search tool calls",
+               [(labels(k), s["web_searches"]) for k, s in summaries.items()])
+        metric("llm_tokens_total", "counter", "LLM tokens by type", [
+            (labels(k, type=kind), s[f"{kind}_tokens"]) for k, s in summaries.items() for kind in ("input", "output", "cached")
+        ])
+        metric("llm_cost_usd_total", "counter", "Estimated LLM cost in USD",
+               [(labels(k), s["cost_usd"]) for k, s in summaries.items()])
+        lines.append("# HELP llm_latency_seconds LLM call wall-clock latency")
+        lines.append("# TYPE llm_latency_seconds summary")
+        for key, records in groups.items():
+            latencies = [r["latency"] for r in records if r["status"] == "ok" and not r["cache_hit"]]
+            if latencies:
+                for p in PERCENTILES:
+                    lines.append(f"llm_latency_seconds{labels(key, quantile=str(p / 100))} {percentile(latencies, p):.6f}")
+            lines.append(f"llm_latency_seconds_sum{labels(key)} {sum(latencies):.6f}")
+            lines.append(f"llm_latency_seconds_count{labels(key)} {len(latencies)}")
+        with open(path, "w", encoding="utf-8") as f:
+            f.write("\n".join(lines) + "\n")
+        return path
+
+
+def _escape_label(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
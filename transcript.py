@@ -0,0 +1,134 @@
+"""
+結構化對話紀錄（JSONL）
+模擬器在寫出 markdown log 的同時寫出同名的 .jsonl：第一行為實驗資訊，其後每行一輪發言。
+分析器以串流方式逐行讀取（記憶體用量固定），v1 / v2 與事件紀錄 events_*.jsonl 使用同一個讀取器；
+舊的 markdown log 仍可解析，但僅作為備援。
+"""
+import json
+import os
+import re
+
+TRANSCRIPT_VERSION = 1
+
+# markdown 備援：「### 🔧 Round 3 - Engineer」這類輪次標題（Agent 名稱不寫死）
+_ROUND_HEADING = re.compile(r"^###\s.*?Round (\d+) - (\S+)")
+_PHASE_HEADING = "## 📍 "  # v2 的階段標題
+
+
+def transcript_filename(log_filename):
+    """markdown log 對應的結構化紀錄檔名"""
+    return os.path.splitext(log_filename)[0] + ".jsonl"
+
+
+def write_transcript(path, meta, turns):
+    """
+    寫出結構化對話紀錄
+
+    Args:
+        path: 輸出檔名
+        meta: 實驗資訊（version、experiment_id、model 等）
+        turns: 可迭代的 dict，每個至少含 round、agent、text
+    """
+    with open(path, "w", encoding="utf-8") as f:
+        f.write(json.dumps({"type": "meta", "format": TRANSCRIPT_VERSION, **meta}, ensure_ascii=False) + "\n")
+        for turn in turns:
+            f.write(json.dumps({"type": "turn", **turn}, ensure_ascii=False) + "\n")
+    return path
+
+
+def read_meta(path):
+    """
+    讀出實驗資訊（experiment_id、rounds 等）
+
+    結構化紀錄讀第一行的 meta；事件紀錄讀 run_started 的 config；markdown log 改讀旁邊同名的 .jsonl。
+    讀不到時回傳空 dict。
+    """
+    if not path.endswith(".jsonl"):
+        path = transcript_filename(path)
+    if not os.path.exists(path):
+        return {}
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            if not line.strip():
+                continue
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                return {}
+            if record.get("type") == "meta":
+                return {key: value for key, value in record.items() if key not in ("type", "format")}
+            if record.get("type") == "run_started":
+                return {"version": record.get("version"), **record.get("config", {})}
+            if record.get("type") == "turn":
+                return {}
+    return {}
+
+
+def iter_jsonl_turns(path):
+    """
+    逐行讀出每輪發言（結構化紀錄或事件紀錄皆可）
+
+    事件紀錄的 response 欄位統一轉為 text。只有檔案最後一行不完整（寫入中斷）時才略過，
+    其他無法解析的行一律拋出錯誤，不會默默漏掉輪次。
+    """
+    with open(path, encoding="utf-8") as f:
+        for line_number, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                if not line.endswith("\n"):  # 只有最後一行可能沒有換行
+                    print(f"⚠️ {path} 最後一行不完整（寫入中斷），已略過")
+                    return
+                raise ValueError(f"{path} 第 {line_number} 行不是合法的 JSON")
+            if record.get("type") != "turn":
+                continue
+            yield {
+                "round": record["round"],
+                "agent": record["agent"],
+                "text": record["text"] if "text" in record else record["response"],
+                "phase": record.get("phase"),
+                "web_search": record.get("web_search", False),
+            }
+
+
+def iter_markdown_turns(path):
+    """
+    以單次掃描解析 markdown log（備援用）
+
+    任何「### ... Round N - Agent」標題都視為一輪；標題之後到下一個標題或分隔線之間的內容
+    （含多行回應的後續行）合併為該輪發言。
+    """
+    current = None
+    phase = None
+    parts = []
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            line = line.rstrip("\n")
+            match = _ROUND_HEADING.match(line) if line.startswith("###") else None
+            if match or line.startswith("#") or line.startswith("---"):
+                if current:
+                    yield {**current, "text": " ".join(parts).strip()}
+                current = {"round": int(match.group(1)), "agent": match.group(2), "phase": phase} if match else None
+                parts = []
+                if line.startswith(_PHASE_HEADING):
+                    phase = line[len(_PHASE_HEADING):].strip()
+            elif current and line.strip():
+                parts.append(line[1:].strip() if line.startswith(">") else line.strip())
+    if current:
+        yield {**current, "text": " ".join(parts).strip()}
+
+
+def iter_turns(path):
+    """
+    依檔案類型串流讀出每輪發言
+
+    .jsonl 直接讀取；markdown log 若旁邊有同名 .jsonl 則改讀結構化紀錄，否則以 markdown 備援解析。
+    """
+    if path.endswith(".jsonl"):
+        return iter_jsonl_turns(path)
+    structured = transcript_filename(path)
+    if os.path.exists(structured):
+        return iter_jsonl_turns(structured)
+    return iter_markdown_turns(path)
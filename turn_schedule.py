@@ -0,0 +1,29 @@
+"""
+發言順序
+sequential：依 agents[i % 3] 一次一輪、逐輪呼叫（預設）。
+simultaneous：每一循環中前 SIMULTANEOUS_SPEAKERS 位 Agent（Engineer、Ecologist）看到同一份對話快照，
+請求同時送出，回應依 Agent 順序寫入 history；第三位（Mediator / Facilitator）在兩者寫入後才依序發言。
+"""
+
+TURN_MODES = ("sequential", "simultaneous")
+SIMULTANEOUS_SPEAKERS = 2  # 每一循環中同時發言的 Agent 數（其餘 Agent 依序發言）
+
+
+def partner_rounds(turn_mode, round_index, rounds, cycle=3):
+    """
+    與第 round_index 輪（0 起算）共用同一份對話快照、一起送出的後續輪次
+
+    只有同時發言組的第一輪會回傳夥伴輪次；續跑時若從組內中途開始，剩下的輪次改為依序發言。
+
+    Args:
+        turn_mode: "sequential" 或 "simultaneous"
+        round_index: 本輪索引（0 起算）
+        rounds: 總輪數
+        cycle: 每一循環的 Agent 數
+
+    Returns:
+        list: 夥伴輪次的索引（0 起算）
+    """
+    if turn_mode != "simultaneous" or round_index % cycle != 0:
+        return []
+    return list(range(round_index + 1, min(round_index + SIMULTANEOUS_SPEAKERS, rounds)))